@@ -0,0 +1,177 @@
+from benchmarks.workload import Workload, blocks_of, summarize, scratch_driver, load_contracts_from
+from contractdb.engine import Engine
+from contractdb.interfaces import StateInterface
+from contractdb.chain import SQLLiteBlockStorageDriver
+from contractdb.client.network import AsyncChainCmds
+from contractdb.server import Server
+from contractdb import utils
+from contracting.compilation.compiler import ContractingCompiler
+
+import tempfile
+import asyncio
+import time
+import os
+
+import zmq.asyncio
+
+SERVER_ADDRESS = 'inproc://contractdb-benchmark'
+
+
+# Block files live in a temporary directory that is removed once the layer is done
+class ScratchBlocks:
+    def __enter__(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'blocks.db')
+        return self
+
+    def __exit__(self, *args):
+        self.directory.cleanup()
+
+
+def failures(block: dict):
+    return sum(1 for tx in block['transactions'] if tx['output']['status'] != 0)
+
+
+# Engine.run on one transaction at a time, including its signature check
+def bench_engine(workload: Workload, txs: int, block_size: int, clients: int):
+    driver = scratch_driver()
+    workload.setup(driver)
+
+    engine = Engine(driver=driver, verify_workers=None)
+    load_contracts_from(driver)
+    latencies, failed = [], 0
+
+    start = time.perf_counter()
+    for tx in workload.transfers(txs):
+        t = time.perf_counter()
+        output = engine.run(tx)
+        latencies.append(time.perf_counter() - t)
+
+        failed += output['status'] != 0
+
+    seconds = time.perf_counter() - start
+    engine.shutdown()
+
+    return summarize(latencies, txs, seconds, failed, unit='tx')
+
+
+# StateInterface.run_all on whole blocks: batch signature checks, execution, hashing and storing the block
+def bench_interface(workload: Workload, txs: int, block_size: int, clients: int):
+    driver = scratch_driver()
+    workload.setup(driver)
+
+    with ScratchBlocks() as scratch:
+        interface = StateInterface(driver=driver,
+                                   compiler=ContractingCompiler(),
+                                   engine=Engine(driver=driver),
+                                   blocks=SQLLiteBlockStorageDriver(filename=scratch.filename))
+        load_contracts_from(driver)
+        latencies, failed = [], 0
+
+        start = time.perf_counter()
+        for block in blocks_of(workload.transfers(txs), block_size):
+            t = time.perf_counter()
+            stored = interface.run_all(block)
+            latencies.append(time.perf_counter() - t)
+
+            failed += failures(stored)
+
+        seconds = time.perf_counter() - start
+        interface.engine.shutdown()
+
+    return summarize(latencies, txs, seconds, failed, unit='block')
+
+
+# SQLLiteBlockStorageDriver.store_txs alone, with outputs made up so no execution is timed
+def bench_blocks(workload: Workload, txs: int, block_size: int, clients: int):
+    finalized = []
+    for i, tx in enumerate(workload.transfers(txs)):
+        output = {
+            'status': 0,
+            'updates': {'currency.balances:{}'.format(tx['sender']): '1'},
+            'result': None
+        }
+
+        tx['index'] = i % block_size
+        result = utils.make_finalized_tx(tx, output)
+        result['hash'] = utils.hash_bytes(str(i).encode() + result.encoded_input)
+        finalized.append(result)
+
+    with ScratchBlocks() as scratch:
+        blocks = SQLLiteBlockStorageDriver(filename=scratch.filename)
+        latencies = []
+
+        start = time.perf_counter()
+        for block in blocks_of(finalized, block_size):
+            t = time.perf_counter()
+            blocks.store_txs(block)
+            latencies.append(time.perf_counter() - t)
+
+        seconds = time.perf_counter() - start
+        blocks.conn.close()
+
+    return summarize(latencies, txs, seconds, 0, unit='block')
+
+
+# The full server: run_all requests from clients on the same ZMQ context over inproc, through the dispatcher's writer
+async def serve_blocks(workload: Workload, txs: int, block_size: int, clients: int, blocks_filename: str):
+    ctx = zmq.asyncio.Context()
+
+    driver = scratch_driver()
+    workload.setup(driver)
+
+    server = Server(port=0, ctx=ctx, poll_timeout=100, blocks_filename=blocks_filename, driver=driver)
+    load_contracts_from(driver)
+    server.address = SERVER_ADDRESS
+    serving = asyncio.ensure_future(server.serve())
+    await asyncio.sleep(0)
+
+    # Nothing is retried, so a timed out block shows up as failed instead of being run twice
+    connections = [AsyncChainCmds(socket_id=SERVER_ADDRESS, ctx=ctx, timeout=600000, retries=0)
+                   for _ in range(clients)]
+
+    latencies, failed = [], 0
+    queue = blocks_of(workload.transfers(txs), block_size)
+
+    async def client(connection):
+        nonlocal failed
+
+        while len(queue) > 0:
+            block = queue.pop(0)
+
+            t = time.perf_counter()
+            stored = await connection.server_call({'command': 'run_all', 'arguments': {'transactions': block}})
+            latencies.append(time.perf_counter() - t)
+
+            failed += len(block) if stored is None else failures(stored)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(c) for c in connections])
+    seconds = time.perf_counter() - start
+
+    for c in connections:
+        c.close()
+
+    server.running = False
+    await serving
+
+    server.dispatcher.shutdown()
+    server.interface.engine.shutdown()
+    ctx.term()
+
+    return summarize(latencies, txs, seconds, failed, unit='block')
+
+
+def bench_server(workload: Workload, txs: int, block_size: int, clients: int):
+    with ScratchBlocks() as scratch:
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(serve_blocks(workload, txs, block_size, clients, scratch.filename))
+
+
+# In the order they are run
+LAYERS = {
+    'engine': bench_engine,
+    'interface': bench_interface,
+    'blocks': bench_blocks,
+    'server': bench_server
+}
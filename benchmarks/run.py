@@ -0,0 +1,110 @@
+# Transaction throughput benchmarks for each layer of the pipeline, from Engine.run up to the ZMQ server.
+#
+#   python -m benchmarks.run --out baseline.json
+#   python -m benchmarks.run --compare baseline.json
+#
+# State is kept in a scratch Mongo collection (workload.SCRATCH_DB) which is flushed before every layer. A baseline is
+# only compared against a run with the same config.
+from benchmarks.layers import LAYERS
+from benchmarks.workload import Workload
+
+import platform
+import click
+import json
+import sys
+
+# Relative change past which a layer counts as regressed: throughput lower, or p99 latency higher, by more than this
+DEFAULT_THRESHOLD = 0.1
+
+
+def run_benchmarks(layers: list, txs: int, block_size: int, accounts: int, clients: int):
+    workload = Workload(accounts=accounts)
+
+    results = {}
+    for name in layers:
+        click.echo('Running {} ..'.format(name), err=True)
+        results[name] = LAYERS[name](workload, txs=txs, block_size=block_size, clients=clients)
+
+    return {
+        'config': {
+            'transactions': txs,
+            'block_size': block_size,
+            'accounts': accounts,
+            'clients': clients,
+            'python': platform.python_version()
+        },
+        'layers': results
+    }
+
+
+# Settings that change what is measured. Two reports are only comparable when all of them match.
+COMPARED_CONFIG = ('transactions', 'block_size', 'accounts', 'clients')
+
+
+def config_differences(config: dict, baseline: dict):
+    return {k: {'baseline': baseline['config'].get(k), 'current': config[k]}
+            for k in COMPARED_CONFIG if baseline['config'].get(k) != config[k]}
+
+
+# Lists every layer in both reports whose throughput fell or p99 latency rose by more than threshold
+def regressions(report: dict, baseline: dict, threshold: float=DEFAULT_THRESHOLD):
+    found = []
+
+    for name, result in report['layers'].items():
+        base = baseline['layers'].get(name)
+
+        if base is None:
+            continue
+
+        if result['tps'] < base['tps'] * (1 - threshold):
+            found.append({'layer': name, 'metric': 'tps', 'baseline': base['tps'], 'current': result['tps']})
+
+        if base['p99_ms'] is not None and result['p99_ms'] is not None and \
+                result['p99_ms'] > base['p99_ms'] * (1 + threshold):
+            found.append({'layer': name, 'metric': 'p99_ms', 'baseline': base['p99_ms'], 'current': result['p99_ms']})
+
+    return found
+
+
+@click.command()
+@click.option('--layer', 'layers', multiple=True, type=click.Choice(list(LAYERS)), help='Layers to run, default all')
+@click.option('--txs', default=2000, help='Transactions per layer')
+@click.option('--block-size', default=100, help='Transactions per block')
+@click.option('--accounts', default=100, help='Number of sending accounts')
+@click.option('--clients', default=4, help='Concurrent clients for the server layer')
+@click.option('--out', type=click.Path(), help='Write the report to this file as well')
+@click.option('--compare', type=click.Path(exists=True), help='Baseline report to check for regressions')
+@click.option('--threshold', default=DEFAULT_THRESHOLD, help='Relative change counted as a regression')
+def main(layers, txs, block_size, accounts, clients, out, compare, threshold):
+    baseline = None
+
+    # Checked before running so that a mismatched baseline doesn't cost a whole run
+    if compare is not None:
+        with open(compare) as f:
+            baseline = json.load(f)
+
+        config = {'transactions': txs, 'block_size': block_size, 'accounts': accounts, 'clients': clients}
+        differences = config_differences(config, baseline)
+
+        if len(differences) > 0:
+            raise click.ClickException('The baseline was run with a different config: {}'.format(
+                json.dumps(differences)))
+
+    report = run_benchmarks(list(layers) or list(LAYERS), txs, block_size, accounts, clients)
+
+    if baseline is not None:
+        report['regressions'] = regressions(report, baseline, threshold)
+
+    text = json.dumps(report, indent=2)
+    click.echo(text)
+
+    if out is not None:
+        with open(out, 'w') as f:
+            f.write(text)
+
+    if len(report.get('regressions', [])) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+from contractdb.dispatch import LatencyTracker
+from contractdb.driver import ContractDBDriver
+from contractdb.utils import make_tx
+from contracting.compilation.compiler import ContractingCompiler
+from contracting.db.driver import Driver, ContractDriver
+from contracting.execution.module import install_database_loader
+
+import random
+import ecdsa
+import os
+
+CURRENCY_PATH = os.path.join(os.path.dirname(__file__), '..', 'tests', 'unit', 'test_sys_contracts', 'currency.s.py')
+
+# Balance given to every sending account. Large enough that no transfer in a run fails for lack of funds.
+STARTING_BALANCE = 1000000000
+
+
+# Mongo database and collection the benchmarks keep their state in, so that a node's state is never flushed
+SCRATCH_DB = 'contractdb_benchmark'
+SCRATCH_COLLECTION = 'state'
+
+
+def scratch_driver():
+    return ContractDBDriver(driver=Driver(db=SCRATCH_DB, collection=SCRATCH_COLLECTION))
+
+
+# Creating an Engine points contracting's module loader at the default database, so this points it back at the scratch
+# one once the engines of a layer exist
+def load_contracts_from(driver: ContractDBDriver):
+    install_database_loader(driver=ContractDriver(driver=driver.driver))
+
+
+# The contract is trusted test code, so it isn't linted. It's compiled under its own name so that its variables are
+# stored under 'currency.'.
+def deploy_currency(driver):
+    with open(CURRENCY_PATH) as f:
+        code = ContractingCompiler(module_name='currency').parse_to_code(f.read(), lint=False)
+
+    driver.set_contract(name='currency', code=code)
+    driver.clear_sets()
+
+
+# Signed currency transfers between a fixed set of funded accounts. The same seed gives the same senders, recipients
+# and amounts, though the signatures differ from run to run.
+class Workload:
+    def __init__(self, accounts=100, seed=0):
+        self.keys = [ecdsa.SigningKey.generate(curve=ecdsa.NIST256p) for _ in range(accounts)]
+        self.addresses = [k.get_verifying_key().to_string().hex() for k in self.keys]
+
+        self.seed = seed
+
+    # Flushes the scratch state, then deploys the currency contract and funds every account
+    def setup(self, driver):
+        driver.flush()
+        deploy_currency(driver)
+
+        driver.set_many({'currency.balances:{}'.format(a): STARTING_BALANCE for a in self.addresses})
+
+    def transfers(self, n: int):
+        rng = random.Random(self.seed)
+        txs = []
+
+        for _ in range(n):
+            sender = rng.randrange(len(self.keys))
+            txs.append(make_tx(self.keys[sender],
+                               contract='currency',
+                               func='transfer',
+                               arguments={'to': rng.choice(self.addresses), 'amount': rng.randint(1, 100)}))
+
+        return txs
+
+
+def blocks_of(txs: list, size: int):
+    return [txs[i:i + size] for i in range(0, len(txs), size)]
+
+
+# Throughput over the whole run and latency percentiles, in milliseconds, of the timed operations. An operation is a
+# transaction or a block depending on the layer.
+def summarize(latencies: list, transactions: int, seconds: float, failed: int, unit: str):
+    ordered = sorted(latencies)
+
+    return {
+        'transactions': transactions,
+        'failed': failed,
+        'seconds': seconds,
+        'tps': transactions / seconds if seconds > 0 else 0,
+        'unit': unit,
+        'operations': len(ordered),
+        'p50_ms': LatencyTracker.percentile(ordered, 0.50) * 1000 if len(ordered) > 0 else None,
+        'p99_ms': LatencyTracker.percentile(ordered, 0.99) * 1000 if len(ordered) > 0 else None
+    }
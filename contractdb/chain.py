@@ -1,11 +1,81 @@
 from contracting.db.encoder import encode, decode
-from contractdb.utils import hash_bytes
+from contractdb.utils import FinalizedTx
+from contractdb import utils
 from contractdb.driver import ContractDBDriver
 
 import sqlite3
-import json
+import logging
 import os
 
+# Lowest limit on bound parameters per statement across SQLite versions
+MAX_SQL_VARIABLES = 999
+
+GENESIS_HEIGHT = -1
+GENESIS_HASH = '0' * 64
+
+# Each entry moves the block storage schema up by one version. The version of a database is kept in its user_version
+# pragma, so files written by older releases are upgraded in place when they are opened.
+SCHEMA_MIGRATIONS = [
+    # 1: Block and transaction tables
+    [
+        'create table if not exists blocks (hash text primary key, idx integer unique)',
+
+        'create table if not exists transaction_inputs'
+        '(hash text primary key, parent_block text, block_index integer, sender text, '
+        'signature text, contract text, function text, arguments text)',
+
+        'create table if not exists transaction_outputs (hash text primary key,'
+        'parent_block text, block_index integer, status integer, updates text, result text)',
+
+        # Single row table holding the height and hash of the latest block
+        'create table if not exists chain_tip (id integer primary key check (id = 0), height integer, hash text)'
+    ],
+    # 2: Indexes for reading the transactions of a block and looking them up by sender or contract
+    [
+        'create index if not exists transaction_inputs_parent_block on transaction_inputs (parent_block)',
+        'create index if not exists transaction_outputs_parent_block on transaction_outputs (parent_block)',
+        'create index if not exists transaction_inputs_sender on transaction_inputs (sender)',
+        'create index if not exists transaction_inputs_contract on transaction_inputs (contract)'
+    ],
+    # 3: One row per transaction holding both its input and output. Rows from the old split tables are copied over.
+    [
+        'create table if not exists transactions (hash text primary key, parent_block text, block_index integer, '
+        'sender text, signature text, contract text, function text, arguments text, '
+        'status integer, updates text, result text)',
+
+        'insert or ignore into transactions '
+        'select i.hash, i.parent_block, i.block_index, i.sender, i.signature, i.contract, i.function, i.arguments, '
+        'o.status, o.updates, o.result '
+        'from transaction_inputs i join transaction_outputs o on o.hash = i.hash',
+
+        'drop table transaction_inputs',
+        'drop table transaction_outputs',
+
+        'create index if not exists transactions_parent_block on transactions (parent_block, block_index)',
+        'create index if not exists transactions_sender on transactions (sender)',
+        'create index if not exists transactions_contract on transactions (contract)'
+    ],
+    # 4: Merkle root over the transaction hashes of each block. Blocks stored before this have none.
+    [
+        'alter table blocks add column merkle_root text'
+    ],
+    # 5: Root of the state tree after each block. Blocks stored before this have none.
+    [
+        'alter table blocks add column state_root text'
+    ]
+]
+
+# Reads a block and all of its transactions in order with a single query. Empty blocks return one row with no
+# transaction columns.
+BLOCK_QUERY = 'select blocks.hash, blocks.idx, blocks.merkle_root, blocks.state_root, transactions.* from blocks ' \
+              'left join transactions on transactions.parent_block = blocks.hash ' \
+              'where blocks.{} = ? order by transactions.block_index'
+
+# Same as BLOCK_QUERY but for a range of block indexes, in block order
+BLOCK_RANGE_QUERY = 'select blocks.hash, blocks.idx, blocks.merkle_root, blocks.state_root, transactions.* from blocks ' \
+                    'left join transactions on transactions.parent_block = blocks.hash ' \
+                    'where blocks.idx >= ? and blocks.idx < ? order by blocks.idx, transactions.block_index'
+
 
 class BlockHashAlreadyExistsError(Exception):
     pass
@@ -20,7 +90,9 @@ class BlockIndexNotSequentialError(Exception):
 
 
 class TransactionHashAlreadyExistsError(Exception):
-    pass
+    def __init__(self, hashes: list=None):
+        self.hashes = hashes or []
+        super().__init__('Transaction hashes already exist: {}'.format(self.hashes))
 
 
 class BlockStorageDriver:
@@ -30,13 +102,23 @@ class BlockStorageDriver:
     def get_block_by_index(self, i: int):
         raise NotImplementedError
 
+    # Yields the blocks from start up to but not including end, in order. If end is None, reads through the latest block.
+    def get_blocks(self, start: int, end: int=None, batch_size: int=100):
+        raise NotImplementedError
+
     def get_transaction_by_hash(self, h: str):
         raise NotImplementedError
 
+    def get_tx_proof(self, tx_hash: str):
+        raise NotImplementedError
+
     def insert_block(self, b: dict):
         raise NotImplementedError
 
-    def store_txs(self, txs: list):
+    def store_txs(self, txs: list, merkle_root: str=None, state_root: str=None):
+        raise NotImplementedError
+
+    def most_used_contracts(self, limit: int):
         raise NotImplementedError
 
     @property
@@ -50,125 +132,78 @@ class BlockStorageDriver:
 
 class SQLLiteBlockStorageDriver(BlockStorageDriver):
     def __init__(self, filename=os.path.expanduser('~/blocks.db')):
-        self.conn = sqlite3.connect(filename)
+        # Block reads are served from several threads. Each read uses its own cursor and writes come from one thread.
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
         self.cursor = self.conn.cursor()
         self.setup()
 
-    def setup(self):
-        self.cursor.execute('create table if not exists blocks (hash text primary key, idx integer unique)')
-
-        self.cursor.execute('create table if not exists transaction_inputs'
-                            '(hash text primary key, parent_block text, block_index integer, sender text, '
-                            'signature text, contract text, function text, arguments text)')
+        self.log = logging.getLogger('SQLLiteBlockStorageDriver')
 
-        self.cursor.execute('create table if not exists transaction_outputs (hash text primary key,'
-                            'parent_block text, block_index integer, status integer, updates text, result text)')
-
-    def height(self):
-        self.cursor.execute('select idx from blocks order by idx desc')
-        h = self.cursor.fetchone()
-        if h is None:
-            return -1
-        return h[0]
-
-    def latest_hash(self):
-        self.cursor.execute('select hash from blocks order by idx desc')
-        h = self.cursor.fetchone()
-        if h is None:
-            return '0' * 64
-        return h[0]
-
-    def flush(self):
-        self.cursor.execute('drop table blocks')
-        self.cursor.execute('drop table transaction_inputs')
-        self.cursor.execute('drop table transaction_outputs')
-
-    @staticmethod
-    def _build_block(block, tx_inputs, tx_outputs):
-        block_dict = {
-            'hash': block[0],
-            'index': block[1],
-            'transactions': []
-        }
+    def setup(self):
+        self.migrate()
+        self.tip = self.load_tip()
 
-        # Iterate through all transactions fetched
-        for i in range(len(tx_inputs)):
-            # Unpack the arguments in a concise way
-            tx_hash, _, idx, sender, sig, contract, func, args = tx_inputs[i]
-            args_unpacked = json.loads(args)
-
-            _, _, _, status, updates, result = tx_outputs[i]
-            updates_unpacked = json.loads(updates)
-
-            # Build the dict
-            tx = {
-                'hash': tx_hash,
-                'input': {
-                    'index': idx,
-                    'sender': sender,
-                    'signature': sig,
-                    'payload': {
-                        'contract': contract,
-                        'function': func,
-                        'arguments': args_unpacked
-                    }
-                },
-                'output': {
-                    'status': status,
-                    'updates': updates_unpacked,
-                    'result': decode(result)
-                }
-            }
+    def schema_version(self):
+        self.cursor.execute('pragma user_version')
+        return self.cursor.fetchone()[0]
 
-            # Add the dict to the transactions list
-            block_dict['transactions'].append(tx)
+    # Applies every migration newer than the database's schema version. Each one is applied in its own transaction
+    # along with the version bump, so an interrupted upgrade resumes from the last completed version.
+    def migrate(self):
+        for version in range(self.schema_version(), len(SCHEMA_MIGRATIONS)):
+            with self.conn:
+                self.cursor.execute('begin')
 
-        # Sort transactions by index
-        sorted(block_dict['transactions'], key=lambda t: t['input']['index'])
+                for statement in SCHEMA_MIGRATIONS[version]:
+                    self.cursor.execute(statement)
 
-        return block_dict
+                self.cursor.execute('pragma user_version = {}'.format(version + 1))
 
-    def get_block_by_hash(self, h: str):
-        self.cursor.execute('select * from blocks where hash=?', (h,))
-        block = self.cursor.fetchone()
+    # Reads the stored tip and checks it against the blocks table with two indexed lookups. The tip is only rebuilt from
+    # the blocks table if it is missing or out of date, such as on a database written before the tip was stored.
+    def load_tip(self):
+        self.cursor.execute('select height, hash from chain_tip where id = 0')
+        tip = self.cursor.fetchone()
 
-        self.cursor.execute('select * from transaction_inputs where parent_block=?', (h,))
-        tx_inputs = self.cursor.fetchall()
+        if tip is not None:
+            height, h = tip
 
-        self.cursor.execute('select * from transaction_outputs where parent_block=?', (h,))
-        tx_outputs = self.cursor.fetchall()
+            self.cursor.execute('select hash from blocks where idx = ?', (height,))
+            stored = self.cursor.fetchone()
+            stored_hash = GENESIS_HASH if stored is None else stored[0]
 
-        return self._build_block(block, tx_inputs, tx_outputs)
+            self.cursor.execute('select 1 from blocks where idx = ?', (height + 1,))
 
-    def get_block_by_index(self, i: int):
-        self.cursor.execute('select * from blocks where idx=?', (i,))
+            if stored_hash == h and self.cursor.fetchone() is None:
+                return height, h
 
-        block = self.cursor.fetchone()
+        self.cursor.execute('select idx, hash from blocks order by idx desc limit 1')
+        tip = self.cursor.fetchone() or (GENESIS_HEIGHT, GENESIS_HASH)
 
-        h = block[0]
-        self.cursor.execute('select * from transaction_inputs where parent_block=?', (h,))
-        tx_inputs = self.cursor.fetchall()
+        with self.conn:
+            self.cursor.execute('insert or replace into chain_tip values (0, ?, ?)', tip)
 
-        self.cursor.execute('select * from transaction_outputs where parent_block=?', (h,))
-        tx_outputs = self.cursor.fetchall()
+        return tip
 
-        return self._build_block(block, tx_inputs, tx_outputs)
+    def height(self):
+        return self.tip[0]
 
-    def get_transaction_by_hash(self, h: str):
-        self.cursor.execute('select * from transaction_inputs where hash=?', (h,))
-        tx_input = self.cursor.fetchone()
+    def latest_hash(self):
+        return self.tip[1]
 
-        self.cursor.execute('select * from transaction_outputs where hash=?', (h,))
-        tx_output = self.cursor.fetchone()
+    def flush(self):
+        self.cursor.execute('drop table blocks')
+        self.cursor.execute('drop table transactions')
+        self.cursor.execute('drop table chain_tip')
+        self.cursor.execute('pragma user_version = 0')
 
-        tx_hash, _, idx, sender, sig, contract, func, args = tx_input
-        args_unpacked = json.loads(args)
+        self.tip = (GENESIS_HEIGHT, GENESIS_HASH)
 
-        _, _, _, status, updates, result = tx_output
-        updates_unpacked = json.loads(updates)
+    @staticmethod
+    def _build_transaction(row):
+        tx_hash, _, idx, sender, sig, contract, func, args, status, updates, result = row
 
-        # Build the dict
-        tx = {
+        return {
             'hash': tx_hash,
             'input': {
                 'index': idx,
@@ -177,58 +212,175 @@ class SQLLiteBlockStorageDriver(BlockStorageDriver):
                 'payload': {
                     'contract': contract,
                     'function': func,
-                    'arguments': args_unpacked
+                    'arguments': decode(args)
                 }
             },
             'output': {
                 'status': status,
-                'updates': updates_unpacked,
+                'updates': decode(updates),
                 'result': decode(result)
             }
         }
 
-        return tx
+    # Builds a block from the rows of BLOCK_QUERY, which are already ordered by transaction index
+    def _build_block(self, rows):
+        if len(rows) == 0:
+            return None
+
+        block_hash, index, merkle_root, state_root = rows[0][:4]
+
+        transactions = []
+        if rows[0][4] is not None:
+            transactions = [self._build_transaction(row[4:]) for row in rows]
+
+        block = {
+            'hash': block_hash,
+            'index': index,
+            'transactions': transactions
+        }
+
+        if merkle_root is not None:
+            block['merkle_root'] = merkle_root
+
+        if state_root is not None:
+            block['state_root'] = state_root
+
+        return block
+
+    def get_block_by_hash(self, h: str):
+        cursor = self.conn.execute(BLOCK_QUERY.format('hash'), (h,))
+        return self._build_block(cursor.fetchall())
+
+    def get_block_by_index(self, i: int):
+        cursor = self.conn.execute(BLOCK_QUERY.format('idx'), (i,))
+        return self._build_block(cursor.fetchall())
+
+    # Streams the range from its own cursor, batch_size rows at a time, so only the block being built is held in memory
+    def get_blocks(self, start: int, end: int=None, batch_size: int=100):
+        if end is None:
+            end = self.height() + 1
+
+        cursor = self.conn.cursor()
+        cursor.execute(BLOCK_RANGE_QUERY, (start, end))
+
+        rows = []
+        try:
+            while True:
+                batch = cursor.fetchmany(batch_size)
+
+                if len(batch) == 0:
+                    break
+
+                for row in batch:
+                    # A new block index means every row of the previous block has been read
+                    if len(rows) > 0 and row[1] != rows[0][1]:
+                        yield self._build_block(rows)
+                        rows = []
+
+                    rows.append(row)
+
+            if len(rows) > 0:
+                yield self._build_block(rows)
+        finally:
+            cursor.close()
+
+    def get_transaction_by_hash(self, h: str):
+        cursor = self.conn.execute('select * from transactions where hash=?', (h,))
+        row = cursor.fetchone()
+
+        if row is None:
+            return None
+
+        return self._build_transaction(row)
+
+    # Proves that a transaction is in its block with the sibling hashes on its path to the block's Merkle root, which
+    # is log2 of the block size long. Blocks stored before Merkle roots have their root worked out from their
+    # transactions, but their block hash doesn't commit to it.
+    def get_tx_proof(self, tx_hash: str):
+        cursor = self.conn.execute('select blocks.hash, blocks.idx, blocks.merkle_root from transactions '
+                                   'join blocks on blocks.hash = transactions.parent_block '
+                                   'where transactions.hash = ?', (tx_hash,))
+        row = cursor.fetchone()
+
+        if row is None:
+            return None
+
+        parent, index, merkle_root = row
+
+        cursor = self.conn.execute('select hash from transactions where parent_block = ? order by block_index',
+                                   (parent,))
+        hashes = [r[0] for r in cursor.fetchall()]
+
+        return {
+            'tx_hash': tx_hash,
+            'block_hash': parent,
+            'block_index': index,
+            'merkle_root': merkle_root or utils.merkle_root(hashes),
+            'proof': utils.merkle_proof(hashes, hashes.index(tx_hash))
+        }
 
     def insert_block(self, b: dict):
         self.validate_block(b)
 
-        self.cursor.execute('insert into blocks values (?, ?)', (b['hash'], b['index']))
+        # Build every row up front so the inserts are a single executemany call
+        rows = []
 
         for transaction in b['transactions']:
-
-            args = json.dumps(transaction['input']['payload']['arguments'])
-            self.cursor.execute('insert into transaction_inputs values (?, ?, ?, ?, ?, ?, ?, ?)',
-                                (transaction['hash'],
-                                 b['hash'],
-                                 transaction['input']['index'],
-                                 transaction['input']['sender'],
-                                 transaction['input']['signature'],
-                                 transaction['input']['payload']['contract'],
-                                 transaction['input']['payload']['function'],
-                                 args))
-
-            updates = json.dumps(transaction['output']['updates'])
-            self.cursor.execute('insert into transaction_outputs values (?, ?, ?, ?, ?, ?)',
-                                (transaction['hash'],
-                                 b['hash'],
-                                 transaction['input']['index'],
-                                 transaction['output']['status'],
-                                 updates,
-                                 encode(transaction['output']['result'])))
-
-        self.conn.commit()
-
-    def store_txs(self, txs: list):
+            tx_input = transaction['input']
+            payload = tx_input['payload']
+            tx_output = transaction['output']
+
+            # Every column is stored with contracting's encoder. Finalized transactions already hold the encoded
+            # arguments, updates and result.
+            if isinstance(transaction, FinalizedTx) and transaction.payload_fields is not None:
+                arguments = transaction.payload_fields['arguments']
+                updates = transaction.output_fields['updates']
+                result = transaction.output_fields['result']
+            else:
+                arguments = encode(payload['arguments'])
+                updates = encode(tx_output['updates'])
+                result = encode(tx_output['result'])
+
+            rows.append((transaction['hash'],
+                         b['hash'],
+                         tx_input['index'],
+                         tx_input['sender'],
+                         tx_input['signature'],
+                         payload['contract'],
+                         payload['function'],
+                         arguments,
+                         tx_output['status'],
+                         updates,
+                         result))
+
+        # Write the whole block in one transaction. It is committed on success and rolled back if any insert fails.
+        with self.conn:
+            self.cursor.execute('insert into blocks values (?, ?, ?, ?)',
+                                (b['hash'], b['index'], b.get('merkle_root'), b.get('state_root')))
+            self.cursor.executemany('insert into transactions values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.cursor.execute('insert or replace into chain_tip values (0, ?, ?)', (b['index'], b['hash']))
+
+        self.tip = (b['index'], b['hash'])
+
+    # merkle_root can be passed in when the caller built it while producing the transactions. state_root is the root of
+    # the state tree once the transactions have been applied, and the block hash commits to it when it is given.
+    def store_txs(self, txs: list, merkle_root: str=None, state_root: str=None):
         # Calculate the new hash, index, and return the results after storing
-        block_hash = hash_bytes(encode(txs).encode())
+        if merkle_root is None:
+            merkle_root = utils.merkle_root([tx['hash'] for tx in txs])
+
         index = self.height() + 1
 
         block_dict = {
-            'hash': block_hash,
+            'hash': utils.block_hash(self.latest_hash(), index, merkle_root, state_root),
             'index': index,
+            'merkle_root': merkle_root,
             'transactions': txs
         }
 
+        if state_root is not None:
+            block_dict['state_root'] = state_root
+
         self.insert_block(block_dict)
 
         return block_dict
@@ -245,19 +397,84 @@ class SQLLiteBlockStorageDriver(BlockStorageDriver):
         if b['index'] != self.height() + 1:
             raise BlockIndexNotSequentialError
 
-        for tx in b['transactions']:
-            res_inp = self.cursor.execute('select * from transaction_inputs where hash = ?', (tx['hash'],))
-            res_out = self.cursor.execute('select * from transaction_outputs where hash = ?', (tx['hash'],))
-            if res_inp.fetchone() is not None or res_out.fetchone() is not None:
-                raise TransactionHashAlreadyExistsError
+        hashes = [tx['hash'] for tx in b['transactions']]
+
+        duplicates = self.existing_transaction_hashes(hashes)
+
+        # Hashes repeated within the block would collide with each other on insert
+        seen = set()
+        for h in hashes:
+            if h in seen:
+                duplicates.add(h)
+            seen.add(h)
+
+        if len(duplicates) > 0:
+            raise TransactionHashAlreadyExistsError([h for h in dict.fromkeys(hashes) if h in duplicates])
+
+    # Returns which of the given transaction hashes are already stored. Checks all of them with IN queries in chunks
+    # instead of one query per hash.
+    def existing_transaction_hashes(self, hashes: list):
+        found = set()
+
+        for i in range(0, len(hashes), MAX_SQL_VARIABLES):
+            chunk = hashes[i:i + MAX_SQL_VARIABLES]
+            query = 'select hash from transactions where hash in ({})'.format(', '.join('?' * len(chunk)))
+
+            self.cursor.execute(query, chunk)
+            found.update(row[0] for row in self.cursor.fetchall())
+
+        return found
+
+    # Names of the limit contracts with the most stored transactions, most used first
+    def most_used_contracts(self, limit: int):
+        cursor = self.conn.execute('select contract from transactions group by contract '
+                                   'order by count(*) desc limit ?', (limit,))
+
+        try:
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
 
     def sync_state(self, state_driver: ContractDBDriver):
-        for i in range(state_driver.height + 1, self.height() + 1):
-            block = self.get_block_by_index(i)
+        for block in self.get_blocks(state_driver.height + 1):
+            i = block['index']
 
             for tx in block['transactions']:
-                for k, v in tx['output']['updates'].items():
-                    state_driver.set(k, v)
+                state_driver.apply_sets(tx['output']['updates'])
 
             state_driver.height = i
             state_driver.latest_hash = block['hash']
+
+    # Rebuilds state much faster than sync_state for long ranges. Only the last value written to each key within a run of
+    # checkpoint_interval blocks is kept, and those values are written in bulk along with the height and latest hash of
+    # the run's last block. Because the height is only advanced at checkpoints, an interrupted rebuild resumes from the
+    # last completed checkpoint. progress is called with (height, target height) after every checkpoint.
+    def rebuild_state(self, state_driver: ContractDBDriver, checkpoint_interval: int=1000, progress=None):
+        target = self.height()
+
+        latest = {}
+        block = None
+
+        for block in self.get_blocks(state_driver.height + 1, target + 1):
+            for tx in block['transactions']:
+                latest.update(tx['output']['updates'])
+
+            if (block['index'] + 1) % checkpoint_interval == 0:
+                self._checkpoint_state(state_driver, latest, block, target, progress)
+                latest = {}
+
+        if block is not None and state_driver.height != block['index']:
+            self._checkpoint_state(state_driver, latest, block, target, progress)
+
+    # Updates hold values encoded the way apply_sets takes them, so they are decoded before being written
+    def _checkpoint_state(self, state_driver: ContractDBDriver, latest: dict, block: dict, target: int, progress):
+        values = {k: decode(v) for k, v in latest.items()}
+        values[state_driver.height_key] = block['index']
+        values[state_driver.latest_hash_key] = block['hash']
+
+        state_driver.set_many(values)
+
+        self.log.info('Rebuilt state to block {} of {}'.format(block['index'], target))
+
+        if progress is not None:
+            progress(block['index'], target)
@@ -1,7 +1,14 @@
 import zmq
+import zmq.asyncio
 import time
+import queue
+import asyncio
+import threading
+from contextlib import contextmanager
 from zcomm import services
-from contracting.db.encoder import encode, decode
+from contractdb import wire
+from contractdb.dispatch import Dispatcher, READ
+from contractdb.requestlog import Truncated
 
 import logging
 
@@ -16,7 +23,8 @@ def get(socket_id: services.SocketStruct,
         timeout=500,
         linger=2000,
         retries=10,
-        dealer=False):
+        dealer=False,
+        fmt=None):
 
     if retries < 0:
         return None
@@ -30,32 +38,259 @@ def get(socket_id: services.SocketStruct,
     try:
         socket.connect(str(socket_id))
         #time.sleep(5)
-        emsg = encode(msg).encode()
-        #print("encoded msg :", emsg)
-        socket.send(emsg)
-        #print("waiting for rcv")
-        response = socket.recv()
-        #print("rcv msg ->", response)
-        dres = decode(response.decode())
+        # Without a format the message goes as a single JSON frame, which every server version understands
+        if fmt is None:
+            socket.send(wire.pack(msg))
+            dres = wire.unpack(socket.recv())
+        else:
+            socket.send_multipart([fmt, wire.pack(msg, fmt)])
+            header, response = socket.recv_multipart()
+            dres = wire.unpack(response, header)
+
         socket.close()
 
         return dres
 
-    except Exception as e:
-        print(e)
+    except Exception:
         socket.close()
-        return get(socket_id, msg, ctx, timeout, linger, retries-1, dealer=True)
+        return get(socket_id, msg, ctx, timeout, linger, retries-1, dealer=True, fmt=fmt)
+
+
+# Exponential backoff between retries, capped so a long outage doesn't push the next attempt out indefinitely
+def backoff_delay(attempt: int, backoff=100, max_backoff=2000):
+    return min(max_backoff, backoff * 2 ** attempt)
+
+
+# Only reads and pings are sent again after a timeout. The server may have run a write whose reply was lost, and a
+# retry would run it a second time.
+def retryable(msg: dict):
+    return Dispatcher.command_class(msg) == READ or (isinstance(msg, dict) and msg.get('command') == 'ping')
+
+
+def correlation_id(n: int):
+    return n.to_bytes(8, 'big')
+
+
+# A long lived DEALER socket. Every request is tagged with a correlation id so that several can be in flight at once
+# and their replies, which the server may send in any order, can be matched back up.
+class Connection:
+    def __init__(self, socket_id: services.SocketStruct, ctx: zmq.Context, fmt=wire.JSON):
+        self.fmt = fmt
+
+        self.socket = ctx.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(str(socket_id))
+
+        self.next_id = 0
+        self.replies = {}
+
+    def send(self, msg: dict):
+        self.next_id += 1
+        corr = correlation_id(self.next_id)
+
+        self.socket.send_multipart([corr, self.fmt, wire.pack(msg, self.fmt)])
+
+        return corr
+
+    # Waits up to timeout milliseconds in total for the replies to all of the given ids. Replies nobody is waiting for
+    # anymore are dropped.
+    def receive(self, corrs: list, timeout: int):
+        waiting = set(corrs)
+        deadline = time.monotonic() + timeout / 1000
+
+        while not waiting.issubset(self.replies):
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0 or not self.socket.poll(timeout=int(remaining * 1000) + 1):
+                raise TimeoutError('No reply within {}ms'.format(timeout))
+
+            corr, header, response = self.socket.recv_multipart()
+
+            if corr in waiting:
+                self.replies[corr] = wire.unpack(response, header)
+
+        return [self.replies.pop(corr) for corr in corrs]
+
+    def close(self):
+        self.socket.close()
+
+
+# Hands out connections to one thread at a time, opening up to size of them. A connection that fails is closed
+# instead of going back into the pool, which also throws away any requests still queued on it so that a retry can't
+# be delivered twice.
+class ConnectionPool:
+    def __init__(self, socket_id: services.SocketStruct, ctx: zmq.Context, size=4, fmt=wire.JSON):
+        self.socket_id = socket_id
+        self.ctx = ctx
+        self.size = size
+        self.fmt = fmt
+
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and self.opened < self.size:
+                self.opened += 1
+                return Connection(self.socket_id, self.ctx, fmt=self.fmt)
+
+        return self.idle.get()
+
+    def discard(self, conn: Connection):
+        conn.close()
+
+        with self.lock:
+            self.opened -= 1
+
+        # Make room for a waiting thread to open a fresh one
+        self.idle.put(None)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+
+        if conn is None:
+            with self.lock:
+                self.opened += 1
+            conn = Connection(self.socket_id, self.ctx, fmt=self.fmt)
+
+        try:
+            yield conn
+        except Exception:
+            self.discard(conn)
+            raise
+        else:
+            self.idle.put(conn)
+
+    def close(self):
+        while not self.idle.empty():
+            conn = self.idle.get()
+            if conn is not None:
+                conn.close()
+
+        self.opened = 0
 
 
 class ChainCmds:
-    def __init__(self, socket_id=DEFAULT_SOCKET, ctx=zmq.Context()):
+    def __init__(self, socket_id=DEFAULT_SOCKET, ctx=zmq.Context(), fmt=wire.JSON, pool_size=4, timeout=2000,
+                 retries=3, backoff=100, max_backoff=2000):
         self.log = logging.getLogger('Client')
 
         self.socket = socket_id
         self.ctx = ctx
 
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.pool = ConnectionPool(socket_id, ctx, size=pool_size, fmt=fmt)
+
     def server_call(self, msg: dict):
-        self.log.info("Server call msg -> {}".format(msg))
-        res = get(self.socket, msg, self.ctx, retries=0, dealer=True)
-        self.log.info("Server Res {}".format(res))
-        return res
\ No newline at end of file
+        return self.server_calls([msg])[0]
+
+    # Sends all of the messages before waiting on any reply. Returns a None for each message if the server doesn't
+    # answer within the retries. Messages are only retried if every one of them can be.
+    def server_calls(self, msgs: list):
+        self.log.debug('Server call msgs -> %s', Truncated(msgs))
+
+        retries = self.retries if all(retryable(msg) for msg in msgs) else 0
+
+        for attempt in range(retries + 1):
+            try:
+                with self.pool.connection() as conn:
+                    corrs = [conn.send(msg) for msg in msgs]
+                    res = conn.receive(corrs, self.timeout)
+
+                self.log.debug('Server Res %s', Truncated(res))
+                return res
+
+            except (TimeoutError, zmq.error.ZMQError) as e:
+                self.log.warning('Server call attempt {} failed: {}'.format(attempt + 1, e))
+
+            if attempt < retries:
+                time.sleep(backoff_delay(attempt, self.backoff, self.max_backoff) / 1000)
+
+        return [None] * len(msgs)
+
+    def close(self):
+        self.pool.close()
+
+
+# The same calls for asyncio code. One socket carries every request and a reader task resolves the future waiting on
+# each reply, so any number of calls can be in flight at once.
+class AsyncChainCmds:
+    def __init__(self, socket_id=DEFAULT_SOCKET, ctx=None, fmt=wire.JSON, timeout=2000, retries=3, backoff=100,
+                 max_backoff=2000):
+        self.log = logging.getLogger('AsyncClient')
+
+        self.socket_id = socket_id
+        self.ctx = ctx or zmq.asyncio.Context.instance()
+        self.fmt = fmt
+
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.socket = None
+        self.reader = None
+
+        self.next_id = 0
+        self.pending = {}
+
+    def connect(self):
+        self.socket = self.ctx.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(str(self.socket_id))
+
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        while True:
+            corr, header, response = await self.socket.recv_multipart()
+
+            future = self.pending.pop(corr, None)
+            if future is not None and not future.done():
+                future.set_result(wire.unpack(response, header))
+
+    async def server_call(self, msg: dict):
+        if self.socket is None:
+            self.connect()
+
+        retries = self.retries if retryable(msg) else 0
+
+        for attempt in range(retries + 1):
+            self.next_id += 1
+            corr = correlation_id(self.next_id)
+
+            future = asyncio.get_event_loop().create_future()
+            self.pending[corr] = future
+
+            try:
+                await self.socket.send_multipart([corr, self.fmt, wire.pack(msg, self.fmt)])
+                return await asyncio.wait_for(future, self.timeout / 1000)
+
+            except (asyncio.TimeoutError, zmq.error.ZMQError) as e:
+                self.pending.pop(corr, None)
+                self.log.warning('Server call attempt {} failed: {}'.format(attempt + 1, e))
+
+            if attempt < retries:
+                await asyncio.sleep(backoff_delay(attempt, self.backoff, self.max_backoff) / 1000)
+
+        return None
+
+    async def server_calls(self, msgs: list):
+        return await asyncio.gather(*[self.server_call(msg) for msg in msgs])
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+
+        if self.socket is not None:
+            self.socket.close()
+
+        self.socket = None
+        self.reader = None
+        self.pending = {}
@@ -0,0 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import threading
+import asyncio
+import logging
+import time
+
+READ = 'read'
+WRITE = 'write'
+OTHER = 'other'
+
+# Commands that read state or blocks. They run on the read pool and may run at the same time as each other.
+READ_COMMANDS = {
+    'get_contract',
+    'get_var',
+    'get_vars',
+    'get_vars_bulk',
+    'iter_var',
+    'get_block_by_hash',
+    'get_block_by_index',
+    'get_blocks',
+    'get_tx_proof',
+    'block_height',
+    'block_hash',
+    'state_root'
+}
+
+# Commands that change state. They run one at a time on the writer thread.
+WRITE_COMMANDS = {
+    'run',
+    'run_all'
+}
+
+# Anything else (ping, lint, compile) doesn't touch state and runs on the read pool without taking the state lock.
+
+# A batch takes the class of the strongest command in it, so that the lock is held across the whole batch
+BATCH_COMMAND = 'batch'
+
+
+# Many readers or one writer. Waiting writers block new readers so a steady stream of reads can't starve them.
+class ReadWriteLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writers_waiting = 0
+        self.writing = False
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writing or self.writers_waiting > 0:
+                self.condition.wait()
+            self.readers += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writing or self.readers > 0:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writing = True
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+# Keeps the most recent samples per command class and reports latency percentiles in milliseconds
+class LatencyTracker:
+    def __init__(self, size=10000):
+        self.samples = defaultdict(lambda: deque(maxlen=size))
+
+    def record(self, command_class: str, seconds: float):
+        self.samples[command_class].append(seconds)
+
+    @staticmethod
+    def percentile(ordered: list, p: float):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def percentiles(self):
+        report = {}
+
+        for command_class, samples in self.samples.items():
+            ordered = sorted(samples)
+
+            if len(ordered) == 0:
+                continue
+
+            report[command_class] = {
+                'count': len(ordered),
+                'p50': self.percentile(ordered, 0.50) * 1000,
+                'p90': self.percentile(ordered, 0.90) * 1000,
+                'p99': self.percentile(ordered, 0.99) * 1000
+            }
+
+        return report
+
+
+# Runs RPC commands off the event loop. Reads share a thread pool, writes go through a single writer thread, and a
+# read-write lock keeps reads from seeing a block that is still being executed.
+class Dispatcher:
+    def __init__(self, interface, read_workers=4, after_write=None):
+        self.interface = interface
+
+        # Called on the writer thread after every write, while still holding the write lock
+        self.after_write = after_write
+
+        self.read_pool = ThreadPoolExecutor(max_workers=read_workers)
+        self.write_pool = ThreadPoolExecutor(max_workers=1)
+
+        self.lock = ReadWriteLock()
+        self.latency = LatencyTracker()
+
+        self.log = logging.getLogger('Dispatcher')
+
+    @staticmethod
+    def command_class(payload):
+        command = payload.get('command') if isinstance(payload, dict) else None
+
+        if command == BATCH_COMMAND:
+            return Dispatcher.batch_class(payload)
+
+        if command in WRITE_COMMANDS:
+            return WRITE
+
+        if command in READ_COMMANDS:
+            return READ
+
+        return OTHER
+
+    @staticmethod
+    def batch_class(payload):
+        arguments = payload.get('arguments')
+        commands = arguments.get('commands') if isinstance(arguments, dict) else None
+
+        if not isinstance(commands, list):
+            return OTHER
+
+        classes = {Dispatcher.command_class(command) for command in commands}
+
+        if WRITE in classes:
+            return WRITE
+
+        if READ in classes:
+            return READ
+
+        return OTHER
+
+    def read(self, payload):
+        with self.lock.read():
+            return self.interface.process_json_rpc_command(payload)
+
+    def write(self, payload):
+        with self.lock.write():
+            try:
+                return self.interface.process_json_rpc_command(payload)
+            finally:
+                if self.after_write is not None:
+                    self.after_write()
+
+    async def dispatch(self, payload):
+        command_class = self.command_class(payload)
+
+        if command_class == WRITE:
+            pool, func = self.write_pool, self.write
+        elif command_class == READ:
+            pool, func = self.read_pool, self.read
+        else:
+            pool, func = self.read_pool, self.interface.process_json_rpc_command
+
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(pool, func, payload)
+        finally:
+            self.latency.record(command_class, time.perf_counter() - start)
+
+    def shutdown(self):
+        self.read_pool.shutdown(wait=False)
+        self.write_pool.shutdown(wait=False)
@@ -1,21 +1,301 @@
-from contracting.db.encoder import encode
+from contracting.db.encoder import encode, decode
 from contracting import config
 from contracting.db.driver import ContractDriver
+from contractdb.statetree import StateTree, pack_lanes, unpack_lanes
+
+import logging
+import pymongo
+import re
+
+# Most keys sent to the backing store in a single multi-get query
+MULTI_GET_CHUNK = 10000
+
+# Keys starting with this hold the driver's own bookkeeping (height, latest hash, state tree) and aren't part of the
+# state root
+INTERNAL_KEY_PREFIX = '__'
+
+# The state tree's layout and its bucket hashes are kept in the backing store. When they are missing, or were written
+# for another layout, the tree has to be built from the whole state with build_state_tree.
+STATE_TREE_KEY = '__S'
+STATE_BUCKET_PREFIX = '__S:'
+
+
+class StateTreeMissingError(Exception):
+    pass
 
 
 class ContractDBDriver(ContractDriver):
-    def __init__(self):
-        super().__init__()
+    # driver is the backing store. contracting's default is used when it isn't given.
+    def __init__(self, driver=None):
+        if driver is None:
+            super().__init__()
+        else:
+            super().__init__(driver=driver)
 
         # Tests if access to the DB is available
         self.sets = {}
         self.height_key = '__H'
         self.latest_hash_key = '__L'
 
+        # In speculative mode writes are only recorded in sets and never reach the cache, so every transaction sees the
+        # same snapshot. Keys read from the snapshot are recorded in read_keys for conflict detection.
+        self.speculative = False
+        self.read_keys = set()
+
+        # Called with the name, code and owner of every contract set through set_contract
+        self.after_set_contract = None
+
+        # Loaded from the backing store on first use
+        self.state_tree = None
+        self.state_tree_saved = True
+
+        self.log = logging.getLogger('ContractDBDriver')
+
+    def get(self, key, **kwargs):
+        if self.speculative:
+            if key in self.sets:
+                return decode(self.sets[key])
+
+            self.read_keys.add(key)
+
+        return super().get(key, **kwargs)
+
+    # Reads many keys in one pass and returns their values in the same order. Keys in the cache come from there. The
+    # rest are fetched together with one $in query per chunk when the backing store is Mongo, and one at a time
+    # otherwise. Nothing is added to the cache or marked as read.
+    def get_many(self, keys: list):
+        if self.speculative:
+            return [self.get(k) for k in keys]
+
+        values = {k: self.cache[k] for k in keys if k in self.cache}
+        missing = list({k for k in keys if k not in values})
+
+        values.update(zip(missing, self.fetch_many(missing)))
+
+        return [values[k] for k in keys]
+
+    def fetch_many(self, keys: list):
+        collection = getattr(self.driver, 'db', None)
+
+        if not isinstance(collection, pymongo.collection.Collection):
+            return [self.driver.get(k) for k in keys]
+
+        found = {}
+        for i in range(0, len(keys), MULTI_GET_CHUNK):
+            for entry in collection.find({'_id': {'$in': keys[i:i + MULTI_GET_CHUNK]}}):
+                found[entry['_id']] = decode(entry['v'])
+
+        return [found.get(k) for k in keys]
+
+    # Returns up to limit (key, value) pairs whose keys start with prefix and sort after start_after, in key order,
+    # along with the key to pass as start_after for the next page, or None after the last page. Uncommitted writes in
+    # the cache are merged over the stored values so the page matches what get would return.
+    def iter_page(self, prefix: str, start_after: str=None, limit: int=100):
+        stored = self.scan(prefix, start_after, limit)
+
+        # Cache entries past the last stored key belong to a later page
+        bound = stored[-1][0] if len(stored) == limit else None
+
+        items = dict(stored)
+        for k, v in self.cache.items():
+            if k.startswith(prefix) and (start_after is None or k > start_after) and (bound is None or k <= bound):
+                items[k] = v
+
+        page = sorted((kv for kv in items.items() if kv[1] is not None), key=lambda kv: kv[0])
+
+        if len(page) > limit:
+            page = page[:limit]
+            bound = page[-1][0]
+
+        return page, bound
+
+    # Ordered key scan of the backing store. Mongo serves the page straight off the _id index. Other stores list the
+    # matching keys and read the values for the page one at a time.
+    def scan(self, prefix: str, start_after: str=None, limit: int=100):
+        collection = getattr(self.driver, 'db', None)
+
+        if not isinstance(collection, pymongo.collection.Collection):
+            keys = [k for k in self.driver.iter(prefix) if start_after is None or k > start_after][:limit]
+            return [(k, self.driver.get(k)) for k in keys]
+
+        query = {'$regex': '^' + re.escape(prefix)}
+        if start_after is not None:
+            query['$gt'] = start_after
+
+        cursor = collection.find({'_id': query}).sort('_id', pymongo.ASCENDING).limit(limit)
+
+        return [(entry['_id'], decode(entry['v'])) for entry in cursor]
+
     def set(self, key, value, **kwargs):
         self.sets[key] = encode(value)
+
+        if not self.speculative:
+            self.write(key, value, **kwargs)
+
+    # Writes to the cache and moves the state tree from the value the key had to the new one. The old value comes from
+    # the cache or straight from the backing store, so it isn't charged as a read.
+    def write(self, key, value, **kwargs):
+        if key.startswith(INTERNAL_KEY_PREFIX):
+            super().set(key, value, **kwargs)
+            return
+
+        tree = self.get_state_tree()
+        old = self.cache[key] if key in self.cache else self.driver.get(key)
+
         super().set(key, value, **kwargs)
 
+        tree.update(key, old, self.cache[key])
+
+    # Writes a set of encoded updates produced elsewhere without recording them as sets of the current transaction
+    def apply_sets(self, sets: dict):
+        for k, v in sets.items():
+            self.write(k, decode(v))
+
+    # Writes many values with a single commit without recording them as sets of the current transaction
+    def set_many(self, items: dict):
+        for k, v in items.items():
+            self.write(k, v)
+
+        self.commit()
+
+    # Writes what was set since the last commit and nothing older. The state is written first, then the bucket hashes
+    # changed since the last commit, then the driver's own keys with the height last. A process that waits for the
+    # height, like a replica, then finds the state and buckets it goes with.
+    def commit(self):
+        writes = self.pending_writes
+        self.pending_writes = {}
+
+        internal = {}
+
+        for k, v in writes.items():
+            if k.startswith(INTERNAL_KEY_PREFIX):
+                internal[k] = v
+            else:
+                self.store(k, v)
+
+        self.commit_state_tree()
+
+        height = internal.pop(self.height_key, None)
+
+        for k, v in internal.items():
+            self.store(k, v)
+
+        if height is not None:
+            self.store(self.height_key, height)
+
+    def store(self, key, value):
+        if value is None:
+            self.driver.delete(key)
+        else:
+            self.driver.set(key, value)
+
+    def commit_state_tree(self):
+        if self.state_tree is None:
+            return
+
+        changed = self.state_tree.commit()
+
+        if not self.state_tree_saved:
+            self.save_state_tree()
+            return
+
+        for b, v in changed.items():
+            self.driver.set(STATE_BUCKET_PREFIX + str(b), unpack_lanes(v).hex())
+
+    def save_state_tree(self):
+        for b, v in enumerate(self.state_tree.buckets):
+            self.driver.set(STATE_BUCKET_PREFIX + str(b), unpack_lanes(v).hex())
+
+        self.driver.set(STATE_TREE_KEY, self.state_tree.layout)
+        self.state_tree_saved = True
+
+    # Forgets everything read from the backing store, including the state tree, so that the next reads see what another
+    # process has committed since
+    def refresh(self):
+        self.clear_pending_state()
+        self.state_tree = None
+
+    def clear_pending_state(self):
+        super().clear_pending_state()
+
+        if self.state_tree is not None:
+            self.state_tree.rollback()
+
+    def flush(self):
+        super().flush()
+        self.state_tree = None
+
+    def get_state_tree(self):
+        if self.state_tree is None:
+            self.state_tree = self.load_state_tree()
+
+        return self.state_tree
+
+    # The stored tree, or an empty one if the backing store holds no state yet. Raises StateTreeMissingError if there is
+    # state but no tree for this layout, since building one reads every key.
+    def load_state_tree(self):
+        tree = StateTree()
+
+        if self.driver.get(STATE_TREE_KEY) == tree.layout:
+            stored = self.fetch_many([STATE_BUCKET_PREFIX + str(b) for b in range(tree.size)])
+            tree.load([0 if v is None else pack_lanes(bytes.fromhex(v)) for v in stored])
+            return tree
+
+        if self.has_state():
+            raise StateTreeMissingError('No state tree is stored for {}. Build it with build_state_tree.'.format(
+                tree.layout))
+
+        # Written in full with the next commit
+        self.state_tree_saved = False
+
+        return tree
+
+    # Loads the state tree, first building it if it is missing. Servers call this at startup so that no transaction
+    # pays for the scan.
+    def prepare_state_tree(self):
+        try:
+            return self.get_state_tree()
+        except StateTreeMissingError:
+            return self.build_state_tree()
+
+    # Hashes every committed key into a new state tree and stores it straight away
+    def build_state_tree(self):
+        tree = StateTree()
+        keys = [k for k in self.driver.iter(prefix='') if not k.startswith(INTERNAL_KEY_PREFIX)]
+
+        self.log.info('Building the state tree over {} keys'.format(len(keys)))
+
+        for i in range(0, len(keys), MULTI_GET_CHUNK):
+            chunk = keys[i:i + MULTI_GET_CHUNK]
+            for k, v in zip(chunk, self.fetch_many(chunk)):
+                tree.update(k, None, v)
+
+            self.log.info('Hashed {} of {} keys'.format(i + len(chunk), len(keys)))
+
+        tree.commit()
+
+        self.state_tree = tree
+        self.save_state_tree()
+
+        return tree
+
+    # Whether the backing store holds any key that is part of the state root
+    def has_state(self):
+        collection = getattr(self.driver, 'db', None)
+
+        if not isinstance(collection, pymongo.collection.Collection):
+            return any(not k.startswith(INTERNAL_KEY_PREFIX) for k in self.driver.iter(prefix=''))
+
+        internal = re.compile('^' + re.escape(INTERNAL_KEY_PREFIX))
+        return collection.find_one({'_id': {'$not': internal}}) is not None
+
+    # Root hash over everything set so far, including writes that are not committed yet
+    def state_root(self):
+        return self.get_state_tree().root()
+
+    def state_node(self, depth: int, index: int):
+        return self.get_state_tree().node(depth, index)
+
     def clear_sets(self):
         self.sets = {}
 
@@ -23,6 +303,9 @@ class ContractDBDriver(ContractDriver):
         super().set_contract(name, code, owner, overwrite, **kwargs)
         self.commit()
 
+        if self.after_set_contract is not None:
+            self.after_set_contract(name, code, owner)
+
     def get_key(self, contract, variable, key):
         if key is None:
             response = self.get('{}.{}'.format(contract, variable))
@@ -31,11 +314,13 @@ class ContractDBDriver(ContractDriver):
 
         return response
 
+    # The height and latest hash aren't recorded as sets, or they would show up in the updates of the next transaction
+    # the engine runs
     def get_height(self):
         return self.get(self.height_key) or -1
 
     def set_height(self, v):
-        self.set(self.height_key, v)
+        self.write(self.height_key, v)
 
     height = property(get_height, set_height)
 
@@ -43,6 +328,6 @@ class ContractDBDriver(ContractDriver):
         return self.get(self.latest_hash_key) or '0' * 64
 
     def set_latest_hash(self, v):
-        self.set(self.latest_hash_key, v)
+        self.write(self.latest_hash_key, v)
 
     latest_hash = property(get_latest_hash, set_latest_hash)
@@ -1,12 +1,21 @@
 import importlib
 from contracting.execution import runtime
 from contractdb.driver import ContractDBDriver
-from contracting.execution.module import install_database_loader
+from contracting.execution.module import install_database_loader, MODULE_CACHE
 from contracting.db.encoder import encode
+from contracting.db.driver import OWNER_KEY
+from contractdb.requestlog import Truncated
+from contractdb.timing import EngineTimings
+from contractdb.utils import LRUCache
 
+import multiprocessing
 import ecdsa
 import logging
 import hashlib
+import inspect
+import types
+import sys
+import os
 
 ## Create new executor that takes a transaction JSON thing and executes it. It also enforces the stamps, etc.
 # if that is set in the environment variables
@@ -19,9 +28,95 @@ MALFORMED_TX = 1
 INVALID_SIG = 2
 PY_EXCEPTION = 3
 
+# Batches smaller than this are verified in process. Forking work out to the pool costs more than it saves.
+MIN_PARALLEL_VERIFY_BATCH = 64
+
+# Worker pools start their processes with spawn. Pools are created from the server's writer thread, and forking a
+# process that has other threads running, or that holds a MongoClient, isn't safe.
+WORKER_CONTEXT = multiprocessing.get_context('spawn')
+
+# Suffix of the key holding a contract's code. A write to it means the contract was deployed or overwritten.
+CODE_KEY_SUFFIX = '.__code__'
+
+
+# The namespaces the functions of the given contract modules read their globals from. The loader runs a contract in a
+# dict of its own and copies that onto the module afterwards, so the module's own dict doesn't reach its functions.
+# Functions from outside contracts, such as the stdlib, are left alone.
+def contract_scopes(modules: list):
+    scopes = {}
+
+    for module in modules:
+        namespace = vars(module)
+        scopes[id(namespace)] = namespace
+
+        for v in namespace.values():
+            # Exported functions are wrapped by the export decorator
+            if isinstance(v, types.FunctionType):
+                v = inspect.unwrap(v)
+
+            if isinstance(v, types.FunctionType) and v.__globals__.get('__contract__') is True:
+                scopes[id(v.__globals__)] = v.__globals__
+
+    return list(scopes.values())
+
+
+# Bounded LRU of parsed verifying keys keyed by the hex sender. Building a key from a string decompresses and validates
+# the curve point, which is wasted work for senders that show up over and over.
+class VerifyingKeyCache(LRUCache):
+    def get(self, sender: str):
+        vk = super().get(sender)
+
+        if vk is None:
+            pk = bytes.fromhex(sender)
+            vk = ecdsa.VerifyingKey.from_string(pk, curve=ecdsa.NIST256p, hashfunc=hashlib.sha256)
+
+            self.put(sender, vk)
+
+        return vk
+
+
+def verify_signature(tx: dict, key_cache: VerifyingKeyCache=None):
+    tx_payload = encode(tx['payload'])
+    tx_payload_bytes = tx_payload.encode()
+
+    signature = bytes.fromhex(tx['signature'])
+
+    if key_cache is not None:
+        vk = key_cache.get(tx['sender'])
+    else:
+        pk = bytes.fromhex(tx['sender'])
+        vk = ecdsa.VerifyingKey.from_string(pk, curve=ecdsa.NIST256p, hashfunc=hashlib.sha256)
+
+    try:
+        vk.verify(signature, tx_payload_bytes)
+    except ecdsa.BadSignatureError:
+        return False
+    return True
+
+    # key = nacl.signing.VerifyKey(pk)
+    # try:
+    #     key.verify(tx_payload_bytes, signature)
+    # except nacl.exceptions.BadSignatureError:
+    #     return False
+    # return True
+
+
+# Each verification pool process keeps its own key cache
+process_key_cache = VerifyingKeyCache()
+
+
+# Module level so that it can be pickled and sent to the verification pool. Anything that is not a well formed, validly
+# signed transaction is reported as unverified instead of raising.
+def verify_signature_or_false(tx: dict, key_cache: VerifyingKeyCache=process_key_cache):
+    try:
+        return verify_signature(tx, key_cache)
+    except Exception:
+        return False
+
 
 class Engine:
-    def __init__(self, stamps_enabled=False, timestamps_enabled=False, driver=ContractDBDriver()):
+    def __init__(self, stamps_enabled=False, timestamps_enabled=False, driver=ContractDBDriver(),
+                 verify_workers=os.cpu_count(), key_cache_size=1024, timings_enabled=False):
         install_database_loader()
 
         self.driver = driver
@@ -30,6 +125,25 @@ class Engine:
         self.stamps_enabled = stamps_enabled
         self.timestamps_enabled = timestamps_enabled
 
+        # Process pool for batch signature verification. Created on first use so idle engines don't spawn processes
+        self.verify_workers = verify_workers
+        self.verify_pool = None
+
+        self.key_cache = VerifyingKeyCache(size=key_cache_size)
+
+        # Imported contract modules and contract owners, kept between transactions until a contract's code is written.
+        # Modules hold on to the driver they were imported with, so they are only good for that driver.
+        self.modules = {}
+        self.owners = {}
+        self.modules_driver = None
+
+        # For each cached module, the namespaces its functions and those of every contract it imported read their
+        # globals from, and the runtime environment keys last put into them
+        self.scopes = {}
+
+        # Per phase and per function timing histograms of run, switched on and off with timings.enabled
+        self.timings = EngineTimings(enabled=timings_enabled)
+
     def verify_tx_structure(self, tx: dict, part_of_batch=False):
         expected_keys = expected_tx_keys if not part_of_batch else expected_tx_batch_keys
         if tx.keys() ^ expected_keys != set():
@@ -46,29 +160,117 @@ class Engine:
 
         return True
 
-    @staticmethod
-    def verify_tx_signature(tx: dict):
-        tx_payload = encode(tx['payload'])
-        tx_payload_bytes = tx_payload.encode()
+    def verify_tx_signature(self, tx: dict):
+        return verify_signature(tx, self.key_cache)
 
-        signature = bytes.fromhex(tx['signature'])
-        pk = bytes.fromhex(tx['sender'])
+    # Verifies the signatures of a whole batch of transactions up front across all cores. Returns a list of booleans in
+    # the same order as the transactions which can be passed to run as signature_verified.
+    def verify_tx_signatures(self, txs: list):
+        if len(txs) < MIN_PARALLEL_VERIFY_BATCH or self.verify_workers is None or self.verify_workers < 2:
+            return [verify_signature_or_false(tx, self.key_cache) for tx in txs]
 
-        vk = ecdsa.VerifyingKey.from_string(pk, curve=ecdsa.NIST256p, hashfunc=hashlib.sha256)
-        try:
-            vk.verify(signature, tx_payload_bytes)
-        except ecdsa.BadSignatureError:
-            return False
-        return True
+        if self.verify_pool is None:
+            self.verify_pool = WORKER_CONTEXT.Pool(processes=self.verify_workers)
 
-        # key = nacl.signing.VerifyKey(pk)
-        # try:
-        #     key.verify(tx_payload_bytes, signature)
-        # except nacl.exceptions.BadSignatureError:
-        #     return False
-        # return True
+        chunksize = max(1, len(txs) // (self.verify_workers * 4))
+
+        return self.verify_pool.map(verify_signature_or_false, txs, chunksize=chunksize)
+
+    # Modules and owners are only good for the driver they were read with, so they are dropped when it changes
+    def check_driver(self):
+        if self.modules_driver is not self.driver:
+            self.invalidate()
+            self.modules_driver = self.driver
+
+    # Owners served from the cache are still recorded as read by a speculative driver, so that a transaction that
+    # changes the owner conflicts with the ones that used it.
+    def get_owner(self, contract: str):
+        self.check_driver()
+
+        if contract not in self.owners:
+            self.owners[contract] = self.driver.get_owner(contract)
+        elif self.driver.speculative:
+            self.driver.read_keys.add(self.driver.make_key(contract, OWNER_KEY))
+
+        return self.owners[contract]
+
+    # Imports a contract the first time it is called and reuses the module afterwards. On every later call the runtime
+    # environment is put back into the namespaces of the module and of every contract it imported, the same as the
+    # loader does on import, and environment keys from the last call that aren't set anymore are removed.
+    def get_module(self, contract: str):
+        self.check_driver()
+
+        module = self.modules.get(contract)
+
+        if module is None:
+            loaded = len(runtime.rt.loaded_modules)
+            module = importlib.import_module(contract)
+
+            imported = [sys.modules[name] for name in runtime.rt.loaded_modules[loaded:] if name in sys.modules]
+
+            self.modules[contract] = module
+            self.scopes[contract] = (contract_scopes(imported + [module]), set(runtime.rt.env))
+        else:
+            self.refresh(contract)
+
+        return module
+
+    def refresh(self, contract: str):
+        scopes, keys = self.scopes[contract]
+        stale = keys - runtime.rt.env.keys()
+
+        for scope in scopes:
+            for k in stale:
+                scope.pop(k, None)
+
+            scope.update(runtime.rt.env)
+
+        self.scopes[contract] = (scopes, set(runtime.rt.env))
+
+    # Drops cached state for a contract whose code changed, or for every contract if none is given. All modules are
+    # dropped either way because other contracts may have imported the old one.
+    def invalidate(self, contract: str=None):
+        self.modules = {}
+        self.scopes = {}
+
+        if contract is None:
+            self.owners = {}
+            MODULE_CACHE.clear()
+        else:
+            self.owners.pop(contract, None)
+            MODULE_CACHE.pop(contract, None)
+
+    def invalidate_written(self, updates: dict):
+        for k in updates.keys():
+            if k.endswith(CODE_KEY_SUFFIX):
+                self.invalidate(k[:-len(CODE_KEY_SUFFIX)])
+
+    # Imports contracts ahead of the first transactions that call them, so that they don't pay for the import. Each one
+    # is imported on its own so that it records every contract it imports.
+    def preload(self, contracts: list):
+        for contract in contracts:
+            runtime.rt.env.update({'__Driver': self.driver})
+
+            try:
+                self.get_module(contract)
+            except Exception as e:
+                self.log.warning('Could not preload contract {}: {}'.format(contract, e))
+
+            runtime.rt.clean_up()
+
+        self.log.info('Preloaded {} contracts'.format(len(self.modules)))
+
+    def shutdown(self):
+        if self.verify_pool is not None:
+            self.verify_pool.close()
+            self.verify_pool.join()
+            self.verify_pool = None
+
+    # signature_verified is the result of verify_tx_signatures for this transaction. If it is None, the signature is
+    # checked here.
+    def run(self, tx: dict, environment={}, part_of_batch=False, signature_verified=None):
+        timer = self.timings.timer()
 
-    def run(self, tx: dict, environment={}, part_of_batch=False):
         tx_output = {
             'status': 0,
             'updates': {},
@@ -81,14 +283,24 @@ class Engine:
 
         # Verify the structure of the tx
         if not self.verify_tx_structure(tx, part_of_batch):
-            self.log.error("Malformed transaction {}".format(tx))
+            self.log.error('Malformed transaction %s', Truncated(tx))
             tx_output['status'] = MALFORMED_TX
+            timer.lap('structure')
+            timer.finish()
             return tx_output
 
-        # Verify the signature of the tx
-        if not self.verify_tx_signature(tx):
-            self.log.error("Invalid signature for the transaction {}".format(tx))
+        timer.lap('structure')
+
+        # Verify the signature of the tx unless it has already been checked by the batch verification stage
+        if signature_verified is None:
+            signature_verified = self.verify_tx_signature(tx)
+
+        timer.lap('signature')
+
+        if not signature_verified:
+            self.log.error('Invalid signature for the transaction %s', Truncated(tx))
             tx_output['status'] = INVALID_SIG
+            timer.finish()
             return tx_output
 
         # Extract the payload to pass as execution arguments
@@ -98,32 +310,55 @@ class Engine:
         runtime.rt.env.update({'__Driver': self.driver})
         runtime.rt.env.update(environment)
 
+        timer.lap('environment')
+
+        owner = self.get_owner(tx['payload']['contract'])
+
+        timer.lap('owner')
+
         runtime.rt.context._base_state = {
             'signer': tx['sender'],
             'caller': tx['sender'],
             'this': tx['payload']['contract'],
-            'owner': self.driver.get_owner(tx['payload']['contract'])
+            'owner': owner
         }
 
+        func = None
+
         try:
             # Access the payload values and load them from the database
-            module = importlib.import_module(payload.get('contract'))
+            module = self.get_module(payload.get('contract'))
             func = getattr(module, payload.get('function'))
+            timer.lap('import')
+
             tx_output['result'] = func(**payload.get('arguments'))
 
         except Exception as e:
             tx_output['result'] = str(e)
             tx_output['status'] = PY_EXCEPTION
 
+        timer.lap('call')
+
         # Get the current cache of sets for the tx output
 
         _driver = runtime.rt.env.get('__Driver')
 
         tx_output['updates'] = _driver.sets
 
+        self.invalidate_written(tx_output['updates'])
+
         # Clear them for the next execution
         _driver.clear_sets()
 
+        timer.lap('sets')
+
         runtime.rt.clean_up()
 
+        timer.lap('clean_up')
+        # Only functions that exist are timed by name. Anything else a client sends would add a histogram of its own.
+        if func is not None:
+            timer.finish(payload.get('contract'), payload.get('function'))
+        else:
+            timer.finish()
+
         return tx_output
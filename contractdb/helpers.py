@@ -1,4 +1,5 @@
 from contracting.compilation.compiler import ContractingCompiler
+from contractdb import utils
 import ast
 
 
@@ -70,3 +71,41 @@ class CodeHelper:
 
         print('violations list -> ', violations)
         return return_list
+
+
+# Remembers what CodeHelper works out about each contract so that the code isn't parsed again on every request. Entries
+# are keyed by contract name and carry the hash of the code they were built from. A lookup whose code hash doesn't
+# match rebuilds the entry, so new code under an old name is never served stale metadata.
+class ContractMetadataCache(utils.LRUCache):
+    def __init__(self, driver, helper: CodeHelper, size=1024):
+        super().__init__(size=size)
+
+        self.driver = driver
+        self.helper = helper
+
+    def fill(self, name: str, code: str, owner=None):
+        entry = {
+            'hash': utils.hash_bytes(code.encode()),
+            'variables': self.helper.get_variable_names_for_initialized_classes(code, classes={'Variable', 'Hash'}),
+            'methods': self.helper.get_methods_for_compiled_code(code),
+            'owner': owner
+        }
+
+        self.put(name, entry)
+
+        return entry
+
+    # Returns None if there is no contract with the name
+    def get(self, name: str):
+        code = self.driver.get_contract(name)
+
+        if code is None:
+            return None
+
+        code_hash = utils.hash_bytes(code.encode())
+        entry = super().get(name, fresh=lambda e: e['hash'] == code_hash)
+
+        if entry is not None:
+            return entry
+
+        return self.fill(name, code, owner=self.driver.get_owner(name))
@@ -1,7 +1,11 @@
 from contractdb.engine import Engine
 from contractdb.chain import BlockStorageDriver
-from contractdb.helpers import CodeHelper
+from contractdb.helpers import CodeHelper, ContractMetadataCache
+from contractdb.parallel import ParallelExecutor
+from contractdb.dispatch import READ_COMMANDS, WRITE_COMMANDS
+from contractdb.requestlog import Truncated
 from contractdb import utils
+from contracting.db.encoder import encode
 
 import struct
 import logging
@@ -9,18 +13,34 @@ import logging
 NO_CONTRACT = 1
 NO_VARIABLE = 2
 
+# Most blocks returned by a single get_blocks call
+BLOCK_PAGE_SIZE = 100
+
+# Most keys returned by a single iter_var call
+VAR_PAGE_SIZE = 1000
+
 
 class StateInterface:
-    def __init__(self, driver, compiler, engine: Engine, blocks: BlockStorageDriver=None):
+    def __init__(self, driver, compiler, engine: Engine, blocks: BlockStorageDriver=None, parallel=False,
+                 preload=0):
         self.driver = driver
         self.compiler = compiler
         self.engine = engine
 
         self.helper = CodeHelper(compiler=self.compiler)
 
+        # Contract introspection results, filled as contracts are set and checked against the code hash on every read
+        self.metadata = ContractMetadataCache(driver=self.driver, helper=self.helper)
+        self.driver.after_set_contract = self.metadata.fill
+
         # Set the engine driver
         self.engine.driver = self.driver
 
+        # Optional optimistic parallel execution for run_all
+        self.parallel = None
+        if parallel:
+            self.parallel = ParallelExecutor(engine=self.engine)
+
         # Optional interface into block storage
         self.blocks = blocks
         self.blocks_enabled = False
@@ -29,11 +49,16 @@ class StateInterface:
             'get_contract': self.get_contract,
             'get_var': self.get_var,
             'get_vars': self.get_vars,
+            'get_vars_bulk': self.get_vars_bulk,
+            'iter_var': self.iter_var,
             'run': self.run,
             'run_all': self.run_all,
             'lint': self.lint,
             'compile': self.compile_code,
-            'ping': self.ok
+            'ping': self.ok,
+            'batch': self.batch,
+            'state_root': self.state_root,
+            'stats': self.stats
         }
 
         if self.blocks is not None:
@@ -42,12 +67,18 @@ class StateInterface:
             self.command_map.update({
                 'get_block_by_hash': self.blocks.get_block_by_hash,
                 'get_block_by_index': self.blocks.get_block_by_index,
+                'get_blocks': self.get_blocks,
+                'get_tx_proof': self.blocks.get_tx_proof,
                 'block_height': self.blocks.height,
                 'block_hash': self.blocks.latest_hash,
             })
 
         self.log = logging.getLogger('StateInterface')
 
+        # Optionally import the most used contracts up front so the first transactions after a restart aren't slow
+        if preload > 0 and self.blocks_enabled:
+            self.engine.preload(self.blocks.most_used_contracts(preload))
+
     def ok(self):
         return {'result': 'ok'}
 
@@ -63,16 +94,14 @@ class StateInterface:
         return code
 
     def get_methods(self, contract: str):
-        contract_code = self.driver.get_contract(contract)
+        metadata = self.metadata.get(contract)
 
-        if contract_code is None:
+        if metadata is None:
             return {
                 'status': NO_CONTRACT
             }
 
-        funcs = self.helper.get_methods_for_compiled_code(contract_code)
-
-        return funcs
+        return metadata['methods']
 
     def get_var(self, contract: str, variable: str, key: list=None):
         contract_code = self.driver.get_contract(contract)
@@ -98,7 +127,9 @@ class StateInterface:
 
         return response
 
-    def get_vars(self, contract: str):
+    # Reads many keys of one variable, checking the contract once and fetching every key in a single pass. Returns the
+    # values in the order of keys, with a NO_VARIABLE status in place of each key that isn't set.
+    def get_vars_bulk(self, contract: str, variable: str, keys: list):
         contract_code = self.driver.get_contract(contract)
 
         if contract_code is None:
@@ -106,7 +137,71 @@ class StateInterface:
                 'status': NO_CONTRACT
             }
 
-        return self.helper.get_variable_names_for_initialized_classes(contract_code, classes={'Variable', 'Hash'})
+        ks = [self.driver.make_key(contract=contract, variable=variable, args=key if type(key) is list else [key])
+              for key in keys]
+
+        return [{'status': NO_VARIABLE} if v is None else v for v in self.driver.get_many(ks)]
+
+    # Lists the keys set under a Hash variable one page at a time, in key order. Keys are returned without the
+    # 'contract.variable:' part, so multihash keys look like 'a:b'. 'next' is the start_after for the following page, or
+    # None after the last one. limit is kept between 1 and VAR_PAGE_SIZE, since a limit of 0 means no limit to Mongo.
+    def iter_var(self, contract: str, variable: str, prefix: str='', start_after: str=None, limit: int=VAR_PAGE_SIZE):
+        limit = max(1, min(limit, VAR_PAGE_SIZE))
+
+        contract_code = self.driver.get_contract(contract)
+
+        if contract_code is None:
+            return {
+                'status': NO_CONTRACT
+            }
+
+        base = self.driver.make_key(contract=contract, variable=variable) + ':'
+
+        page, last = self.driver.iter_page(prefix=base + prefix,
+                                           start_after=None if start_after is None else base + start_after,
+                                           limit=limit)
+
+        return {
+            'items': {k[len(base):]: v for k, v in page},
+            'next': None if last is None else last[len(base):]
+        }
+
+    def get_vars(self, contract: str):
+        metadata = self.metadata.get(contract)
+
+        if metadata is None:
+            return {
+                'status': NO_CONTRACT
+            }
+
+        return metadata['variables']
+
+    # Returns one page of blocks starting at start. 'next' is the index to request the following page from, or None once
+    # end or the latest block has been reached. limit is kept between 1 and BLOCK_PAGE_SIZE so that paging always moves
+    # forward.
+    def get_blocks(self, start: int, end: int=None, limit: int=BLOCK_PAGE_SIZE):
+        limit = max(1, min(limit, BLOCK_PAGE_SIZE))
+
+        latest = self.blocks.height() + 1
+        end = latest if end is None else min(end, latest)
+
+        stop = min(end, start + limit)
+
+        return {
+            'blocks': list(self.blocks.get_blocks(start, stop)),
+            'next': stop if stop < end else None
+        }
+
+    # Returns a node of the state tree with the hashes of its children. The default is the root, so two copies of the
+    # state agree if their roots do. If they don't, following the children that differ leads to the buckets that do in
+    # as many calls as the tree is deep.
+    def state_root(self, depth: int=0, index: int=0):
+        node = self.driver.state_node(depth, index)
+
+        if node is not None:
+            node['height'] = self.driver.height
+
+        return node
 
     def run(self, transaction: dict):
         output = self.engine.run(transaction)
@@ -116,15 +211,13 @@ class StateInterface:
         if self.blocks_enabled:
             block_hash = bytes.fromhex(self.blocks.latest_hash())
             index_as_bytes = struct.pack('>H', 0)
-            encoded_tx_in = utils.hash_dict(transaction)
-            encoded_tx_out = utils.hash_dict(output)
 
             new_tx_hash = utils.hash_bytes(block_hash + index_as_bytes +
-                                           encoded_tx_in + encoded_tx_out)
+                                           result.encoded_input + result.encoded_output)
 
             result['hash'] = new_tx_hash
 
-            stored_block = self.blocks.store_txs([result])
+            stored_block = self.blocks.store_txs([result], state_root=self.driver.state_root())
 
             self.log.debug("Stored new block with hash '{}'".format(new_tx_hash))
 
@@ -138,13 +231,27 @@ class StateInterface:
     def run_all(self, transactions: list):
         results = []
 
+        # Add index for ordering purposes
         for i in range(len(transactions)):
-            transaction = transactions[i]
+            transactions[i]['index'] = i
 
-            # Add index for ordering purposes
-            transaction['index'] = i
+        # Check every signature in the batch at once before executing anything
+        verified = self.engine.verify_tx_signatures(transactions)
 
-            output = self.engine.run(transaction, part_of_batch=True)
+        outputs = None
+        if self.parallel is not None:
+            outputs = self.parallel.run_all(transactions, verified)
+
+        # The block's Merkle root is built up as each transaction hash is produced
+        tree = utils.MerkleTree()
+
+        for i in range(len(transactions)):
+            transaction = transactions[i]
+
+            if outputs is not None:
+                output = outputs[i]
+            else:
+                output = self.engine.run(transaction, part_of_batch=True, signature_verified=verified[i])
 
             result = utils.make_finalized_tx(transaction, output)
 
@@ -153,18 +260,17 @@ class StateInterface:
             if self.blocks_enabled:
                 block_hash = bytes.fromhex(self.blocks.latest_hash())
                 index_as_bytes = struct.pack('>H', i)
-                encoded_tx_in = utils.hash_dict(transaction)
-                encoded_tx_out = utils.hash_dict(output)
 
                 new_tx_hash = utils.hash_bytes(block_hash + index_as_bytes +
-                                               encoded_tx_in + encoded_tx_out)
+                                               result.encoded_input + result.encoded_output)
 
                 result['hash'] = new_tx_hash
 
+            tree.append(result['hash'])
             results.append(result)
 
         if self.blocks_enabled:
-            stored_block = self.blocks.store_txs(results)
+            stored_block = self.blocks.store_txs(results, merkle_root=tree.root(), state_root=self.driver.state_root())
 
             self.log.debug("Stored new blocks for {} transactions".format(len(transactions)))
 
@@ -182,6 +288,108 @@ class StateInterface:
     def compile_code(self, code: str):
         return self.compiler.parse_to_code(code)
 
+    # Runs a list of commands in order and returns their results in the same order. A command that fails gets None
+    # instead of failing the whole batch. Identical reads are only evaluated once until something in the batch writes.
+    # The dispatcher holds the state lock for the whole batch, so no other client's write lands between its reads.
+    def batch(self, commands: list):
+        results = []
+        reads = {}
+        prefetched = self.prefetch_vars(commands, 0)
+
+        for i, payload in enumerate(commands):
+            command = payload.get('command') if isinstance(payload, dict) else None
+
+            if command == 'batch':
+                self.log.error('Batches cannot be nested')
+                results.append(None)
+                continue
+
+            key = None
+            if command in READ_COMMANDS:
+                key = encode(payload)
+                if key in reads:
+                    results.append(reads[key])
+                    continue
+            elif command in WRITE_COMMANDS:
+                reads = {}
+
+            try:
+                result = prefetched[i] if i in prefetched else self.process_json_rpc_command(payload)
+            except Exception as e:
+                self.log.error('Batched command %s failed: %s', Truncated(payload), e)
+                result = None
+
+            if key is not None:
+                reads[key] = result
+
+            # Whatever was read ahead of the write may have changed
+            if command in WRITE_COMMANDS:
+                prefetched = self.prefetch_vars(commands, i + 1)
+
+            results.append(result)
+
+        return results
+
+    # Reads every get_var from start up to the next write, one get_vars_bulk per contract and variable, and returns the
+    # results by position in commands. Anything that isn't a well formed get_var is left to run on its own.
+    def prefetch_vars(self, commands: list, start: int):
+        groups = {}
+
+        for i in range(start, len(commands)):
+            payload = commands[i]
+            command = payload.get('command') if isinstance(payload, dict) else None
+
+            if command in WRITE_COMMANDS:
+                break
+
+            arguments = payload.get('arguments') if command == 'get_var' else None
+
+            if not isinstance(arguments, dict) or not set(arguments) <= {'contract', 'variable', 'key'}:
+                continue
+
+            contract, variable, key = arguments.get('contract'), arguments.get('variable'), arguments.get('key')
+
+            if not isinstance(contract, str) or not isinstance(variable, str):
+                continue
+
+            positions, keys = groups.setdefault((contract, variable), ([], []))
+            positions.append(i)
+            keys.append([] if key is None else key if type(key) is list else [key])
+
+        prefetched = {}
+
+        for (contract, variable), (positions, keys) in groups.items():
+            try:
+                values = self.get_vars_bulk(contract=contract, variable=variable, keys=keys)
+            except Exception as e:
+                self.log.error('Batched reads of %s.%s failed: %s', contract, variable, e)
+                continue
+
+            # A missing contract is one status for the whole group
+            if isinstance(values, dict):
+                values = [values] * len(positions)
+
+            prefetched.update(zip(positions, values))
+
+        return prefetched
+
+    # Timing histograms of the engine along with the hit rates of its caches. enabled switches the engine's timing on or
+    # off before reporting and reset clears the histograms.
+    def stats(self, enabled: bool=None, reset: bool=False):
+        timings = self.engine.timings
+
+        if enabled is not None:
+            timings.enabled = enabled
+
+        if reset:
+            timings.reset()
+
+        return {
+            'engine': timings.report(),
+            'key_cache': self.engine.key_cache.stats(),
+            'metadata_cache': self.metadata.stats()
+        }
+
     def process_json_rpc_command(self, payload: dict):
         if payload is None:
             return
@@ -190,7 +398,7 @@ class StateInterface:
         arguments = payload.get('arguments')
 
         if command is None:
-            self.log.error("No command provided with the payload {}".format(payload))
+            self.log.error('No command provided with the payload %s', Truncated(payload))
             return
 
         if arguments is None:
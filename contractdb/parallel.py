@@ -0,0 +1,143 @@
+from contractdb.engine import Engine, CODE_KEY_SUFFIX, WORKER_CONTEXT
+from contractdb.driver import ContractDBDriver
+from contracting.db.driver import Driver
+
+import pymongo
+import logging
+import os
+
+# Batches smaller than this are run serially. Spreading them over worker processes costs more than it saves.
+MIN_PARALLEL_BATCH = 64
+
+# Any write to a contract's code (a key ending in CODE_KEY_SUFFIX) ends speculation for the rest of the batch. Later
+# transactions may import the new code through the module loader, which does not go through the driver that records
+# reads.
+
+# Engine and backing store used by each worker process. Set by init_worker when the pool starts the process.
+worker_engine = None
+worker_store = None
+
+
+# Workers open their own connection to the same Mongo collection as the writer. Returns None for any other backing
+# store, since its state can't be seen from another process.
+def store_names(driver: ContractDBDriver):
+    collection = getattr(driver.driver, 'db', None)
+
+    if not isinstance(collection, pymongo.collection.Collection):
+        return None
+
+    return collection.database.name, collection.name
+
+
+def init_worker(stamps_enabled, timestamps_enabled, db, collection):
+    global worker_engine, worker_store
+    worker_store = Driver(db=db, collection=collection)
+    worker_engine = Engine(stamps_enabled=stamps_enabled,
+                           timestamps_enabled=timestamps_enabled,
+                           driver=ContractDBDriver(driver=worker_store),
+                           verify_workers=None)
+
+
+# Runs a contiguous chunk of transactions against the last committed state. Returns (output, read keys) per
+# transaction. Transactions in the chunk do not see each other's writes.
+def run_speculatively(chunk: list):
+    driver = ContractDBDriver(driver=worker_store)
+    driver.speculative = True
+
+    worker_engine.driver = driver
+
+    results = []
+    for tx, verified in chunk:
+        driver.read_keys = set()
+        output = worker_engine.run(tx, part_of_batch=True, signature_verified=verified)
+        results.append((output, driver.read_keys))
+
+    return results
+
+
+# Optimistic concurrent execution for a batch of transactions. Every transaction is first run in parallel against the
+# same snapshot while its reads and writes are recorded. Results are then accepted in index order. A transaction that
+# read a key written by an earlier transaction in the batch is run again on top of the accepted state, so the final
+# outputs are the same as running the batch serially.
+class ParallelExecutor:
+    def __init__(self, engine: Engine, workers=os.cpu_count()):
+        self.engine = engine
+        self.workers = workers
+        self.pool = None
+
+        # Transactions whose speculative result was used, and ones that had to be run again, over all batches
+        self.accepted = 0
+        self.reexecuted = 0
+
+        self.log = logging.getLogger('ParallelExecutor')
+
+    def speculate(self, transactions: list, verified: list, store: tuple):
+        if self.pool is None:
+            initargs = (self.engine.stamps_enabled, self.engine.timestamps_enabled) + store
+            self.pool = WORKER_CONTEXT.Pool(processes=self.workers, initializer=init_worker, initargs=initargs)
+
+        size = max(1, -(-len(transactions) // (self.workers * 4)))
+        work = list(zip(transactions, verified))
+
+        chunks = [work[i:i + size] for i in range(0, len(work), size)]
+        futures = [self.pool.apply_async(run_speculatively, (chunk,)) for chunk in chunks]
+
+        results = []
+        for chunk, future in zip(chunks, futures):
+            try:
+                results.extend(future.get())
+            # If a chunk fails for any reason, all of its transactions are run serially instead
+            except Exception as e:
+                self.log.error('Speculative execution failed: {}'.format(e))
+                results.extend([None] * len(chunk))
+
+        return results
+
+    def run_all(self, transactions: list, verified: list):
+        store = store_names(self.engine.driver)
+
+        if len(transactions) < MIN_PARALLEL_BATCH or self.workers is None or self.workers < 2 or store is None:
+            return [self.engine.run(tx, part_of_batch=True, signature_verified=v)
+                    for tx, v in zip(transactions, verified)]
+
+        # Workers read committed state, so anything pending has to be committed for them to see it
+        self.engine.driver.commit()
+
+        speculative = self.speculate(transactions, verified, store)
+
+        outputs = []
+        written = set()
+        conflicts = 0
+        speculating = True
+
+        for i in range(len(transactions)):
+            result = speculative[i]
+
+            if speculating and result is not None and result[1].isdisjoint(written):
+                output = result[0]
+                self.engine.driver.apply_sets(output['updates'])
+                self.engine.invalidate_written(output['updates'])
+            else:
+                output = self.engine.run(transactions[i], part_of_batch=True, signature_verified=verified[i])
+                conflicts += 1
+
+            for k in output['updates'].keys():
+                written.add(k)
+
+                if k.endswith(CODE_KEY_SUFFIX):
+                    speculating = False
+
+            outputs.append(output)
+
+        self.accepted += len(transactions) - conflicts
+        self.reexecuted += conflicts
+
+        self.log.debug('Ran {} transactions with {} re-executed'.format(len(transactions), conflicts))
+
+        return outputs
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,107 @@
+from contractdb.interfaces import StateInterface
+from contractdb.chain import SQLLiteBlockStorageDriver
+from contractdb.engine import Engine
+from contractdb.driver import ContractDBDriver
+from contracting.compilation.compiler import ContractingCompiler
+from contractdb import wire
+from contractdb.requestlog import Truncated
+
+import logging
+import time
+import zmq
+
+
+# Format frame of a reply sent back in place of a result when the replica couldn't catch up to the writer's height.
+# The original message comes back with it so that the server can run it itself.
+STALE = b'stale'
+
+# How long a replica waits for its state to reach the writer's height, and how often it checks, in seconds
+SYNC_TIMEOUT = 0.5
+SYNC_POLL = 0.01
+
+
+class StaleReplicaError(Exception):
+    pass
+
+
+# Serves read commands from its own state and block storage handles. Every request carries the height the writer has
+# committed. When it moves, the replica drops the state it has read and its block tip, then reads the '__H' key until it
+# sees that height. One interface, engine and metadata cache are kept for the life of the replica.
+class Replica:
+    def __init__(self, blocks_filename=None, sync_timeout=SYNC_TIMEOUT):
+        self.blocks = SQLLiteBlockStorageDriver() if blocks_filename is None else \
+            SQLLiteBlockStorageDriver(filename=blocks_filename)
+
+        self.driver = ContractDBDriver()
+
+        self.interface = StateInterface(driver=self.driver,
+                                        compiler=ContractingCompiler(),
+                                        engine=Engine(driver=self.driver, verify_workers=None),
+                                        blocks=self.blocks)
+
+        self.height = None
+        self.sync_timeout = sync_timeout
+
+        self.log = logging.getLogger('Replica')
+
+    def sync(self, height: int):
+        if height == self.height:
+            return
+
+        deadline = time.monotonic() + self.sync_timeout
+
+        while True:
+            self.driver.refresh()
+
+            if self.driver.height == height:
+                break
+
+            if time.monotonic() >= deadline:
+                self.log.warning('Replica state is at height {} but the writer committed {}'.format(
+                    self.driver.height, height))
+                raise StaleReplicaError
+
+            time.sleep(SYNC_POLL)
+
+        self.blocks.tip = self.blocks.load_tip()
+        self.height = height
+
+    # Raises StaleReplicaError if the state doesn't reach height in time. Anything else that goes wrong is a None result.
+    def process(self, height: int, msg: bytes, fmt=wire.JSON):
+        self.sync(height)
+
+        try:
+            result = self.interface.process_json_rpc_command(wire.unpack(msg, fmt))
+        except Exception as e:
+            self.log.error('Replica failed to process %s: %s', Truncated(msg), e)
+            result = None
+
+        try:
+            return wire.pack(result, fmt)
+        except Exception as e:
+            self.log.error('Replica failed to pack result %s: %s', Truncated(result), e)
+            return wire.pack(None, fmt)
+
+
+# Entry point of a replica process. Requests arrive as [height, header, message] and the reply is
+# [header, format, result], with the header passed back as it came so the server knows how to frame the reply. A stale
+# replica replies [header, STALE, message] instead.
+def run_replica(address: str, blocks_filename=None):
+    replica = Replica(blocks_filename=blocks_filename)
+
+    ctx = zmq.Context()
+    socket = ctx.socket(zmq.REP)
+    socket.connect(address)
+
+    try:
+        while True:
+            height, header, msg = socket.recv_multipart()
+            fmt = wire.negotiate(header)
+
+            try:
+                socket.send_multipart([header, fmt, replica.process(int(height), msg, fmt)])
+            except StaleReplicaError:
+                socket.send_multipart([header, STALE, msg])
+    finally:
+        socket.close()
+        ctx.term()
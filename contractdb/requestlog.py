@@ -0,0 +1,90 @@
+from collections import deque
+
+import reprlib
+import random
+import time
+
+# Longest payload text kept in a log line or a request log entry
+MAX_PAYLOAD_CHARS = 256
+
+# Share of requests of a command that are kept in the request log, unless a rate is set for the command
+DEFAULT_SAMPLE_RATE = 0.01
+
+
+# Formats containers only down to a fixed depth and width, so the cost of formatting a payload doesn't grow with it
+PAYLOAD_REPR = reprlib.Repr()
+PAYLOAD_REPR.maxlevel = 4
+PAYLOAD_REPR.maxdict = 16
+PAYLOAD_REPR.maxlist = 16
+PAYLOAD_REPR.maxstring = MAX_PAYLOAD_CHARS
+PAYLOAD_REPR.maxother = MAX_PAYLOAD_CHARS
+
+
+# Wraps a payload for logging. Nothing is formatted until the logger actually emits the line, so disabled levels cost
+# nothing, and the text is cut off at limit characters so a large block can't flood the log.
+class Truncated:
+    def __init__(self, payload, limit=MAX_PAYLOAD_CHARS):
+        self.payload = payload
+        self.limit = limit
+
+    def __str__(self):
+        if isinstance(self.payload, bytes):
+            text = self.payload[:self.limit + 1].decode(errors='replace')
+        elif isinstance(self.payload, str):
+            text = self.payload[:self.limit + 1]
+        else:
+            text = PAYLOAD_REPR.repr(self.payload)
+
+        if len(text) <= self.limit:
+            return text
+
+        return text[:self.limit] + '...'
+
+
+# Keeps a sample of recent requests in a ring buffer that can be dumped on demand. Each command is sampled at its own
+# rate so that rare writes can all be kept while frequent reads are thinned out.
+class RequestLog:
+    def __init__(self, size=1000, sample_rates: dict=None, default_rate=DEFAULT_SAMPLE_RATE,
+                 max_payload=MAX_PAYLOAD_CHARS):
+        self.entries = deque(maxlen=size)
+
+        self.sample_rates = sample_rates or {}
+        self.default_rate = default_rate
+        self.max_payload = max_payload
+
+        self.seen = 0
+        self.sampled = 0
+
+    def sampling(self, command):
+        rate = self.sample_rates.get(command, self.default_rate)
+
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    # payload is only formatted if the request is sampled. seconds is None for requests handed off elsewhere.
+    def record(self, command, payload, size: int, seconds: float=None):
+        self.seen += 1
+
+        if not self.sampling(command):
+            return
+
+        self.sampled += 1
+
+        self.entries.append({
+            'time': time.time(),
+            'command': command,
+            'bytes': size,
+            'ms': None if seconds is None else seconds * 1000,
+            'payload': str(Truncated(payload, self.max_payload))
+        })
+
+    def recent(self, limit: int=None):
+        entries = list(self.entries)
+
+        if limit is not None:
+            entries = entries[-limit:] if limit > 0 else []
+
+        return {
+            'seen': self.seen,
+            'sampled': self.sampled,
+            'requests': entries
+        }
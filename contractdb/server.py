@@ -2,17 +2,49 @@ import asyncio
 import zmq
 import zmq.asyncio
 from contractdb.interfaces import StateInterface
+from contractdb.dispatch import Dispatcher, READ
+from contractdb.replicas import run_replica, STALE
 from contractdb.chain import SQLLiteBlockStorageDriver
 from contractdb.engine import Engine
 from contractdb.driver import ContractDBDriver
 from contracting.compilation.compiler import ContractingCompiler
-from contracting.db.encoder import encode, decode
+from contractdb import wire
+from contractdb.requestlog import RequestLog, Truncated
 
+import multiprocessing
 import logging
+import time
+import os
+
+
+# Clients send [message], [format, message] or [correlation id, format, message]. The ROUTER puts the client id in
+# front of all of them. The correlation id lets a client keep several requests in flight on one socket and match the
+# replies, which can come back in any order, to them.
+def split_frames(frames):
+    if len(frames) > 3:
+        return frames[0], frames[1] or None, frames[2] or None, frames[3]
+    if len(frames) > 2:
+        return frames[0], None, frames[1] or None, frames[2]
+    return frames[0], None, None, frames[1]
+
+
+def command_name(payload):
+    return payload.get('command') if isinstance(payload, dict) else None
+
+
+# Replies carry the format actually used so that a client asking for one the server doesn't know sees the JSON fallback
+def reply_frames(_id, corr, header, fmt, msg):
+    if header is None:
+        return [_id, msg]
+    if corr is None:
+        return [_id, fmt, msg]
+    return [_id, corr, fmt, msg]
 
 
 class Server:
-    def __init__(self, port: int, ctx: zmq.Context=zmq.asyncio.Context(), linger=2000, poll_timeout=2000):
+    # driver is the state driver, a ContractDBDriver over contracting's default database when it isn't given
+    def __init__(self, port: int, ctx: zmq.Context=zmq.asyncio.Context(), linger=2000, poll_timeout=2000, preload=0,
+                 blocks_filename=None, driver=None):
         self.port = port
 
         self.address = 'tcp://*:{}'.format(port)
@@ -26,10 +58,27 @@ class Server:
 
         self.running = False
 
-        self.interface = StateInterface(driver=ContractDBDriver(),
+        # Replicas are started with the same blocks file
+        self.blocks_filename = blocks_filename
+        blocks = SQLLiteBlockStorageDriver() if blocks_filename is None else \
+            SQLLiteBlockStorageDriver(filename=blocks_filename)
+
+        self.interface = StateInterface(driver=ContractDBDriver() if driver is None else driver,
                                         compiler=ContractingCompiler(),
                                         engine=Engine(),
-                                        blocks=SQLLiteBlockStorageDriver())
+                                        blocks=blocks,
+                                        preload=preload)
+
+        # Building a missing state tree reads the whole state, which is better done now than in the first transaction
+        self.interface.driver.prepare_state_tree()
+
+        # Runs commands off the event loop so a long run_all doesn't stop the socket from being polled
+        self.dispatcher = Dispatcher(interface=self.interface)
+        self.interface.command_map['latency'] = self.dispatcher.latency.percentiles
+
+        # Sampled record of recent requests, dumped with the 'recent_requests' command
+        self.requests = RequestLog(sample_rates={'run': 1, 'run_all': 1})
+        self.interface.command_map['recent_requests'] = self.requests.recent
 
         self.log = logging.getLogger('Server')
         self.log.info("Server init")
@@ -46,12 +95,9 @@ class Server:
                 event = await self.socket.poll(timeout=self.poll_timeout, flags=zmq.POLLIN)
                 if event:
                     m = await self.socket.recv_multipart()
-                    self.log.info(f'got {m}')
-                    _id = m[0]
-                    msg = m[1]
-                    self.log.info("id : {}".format(_id))
-                    self.log.info("msg : {}".format(msg))
-                    asyncio.ensure_future(self.handle_msg(_id, msg))
+                    _id, corr, header, msg = split_frames(m)
+                    self.log.debug('id: %s, msg: %s', _id, Truncated(msg))
+                    asyncio.ensure_future(self.handle_msg(_id, msg, header, corr))
                     await asyncio.sleep(0)
 
             except zmq.error.ZMQError:
@@ -61,28 +107,41 @@ class Server:
 
         self.socket.close()
 
-    async def handle_msg(self, _id, msg):
+    # A header of None means the client sent a bare JSON message and gets a bare JSON reply back
+    async def handle_msg(self, _id, msg, header=None, corr=None):
+        fmt = wire.negotiate(header)
+
         # Try to deserialize the message and run it through the rpc service
+        json_command = None
+        start = time.perf_counter()
+
         try:
-            json_command = decode(msg.decode())
+            json_command = wire.unpack(msg, fmt)
 
-            self.log.info('Received command: {}'.format(json_command))
+            self.log.debug('Received command: %s', Truncated(json_command))
 
-            result = self.interface.process_json_rpc_command(json_command)
+            result = await self.dispatcher.dispatch(json_command)
 
         # If this fails, just set the result to None
         except Exception as e:
-            self.log.info('EXCEPTION!! -> ', str(e))
+            self.log.error('Failed to process message: %s', e)
             result = None
 
+        self.requests.record(command_name(json_command), json_command, len(msg), time.perf_counter() - start)
+
+        # A result the format can't carry is replied to with None rather than leaving the client without a reply
+        try:
+            msg = wire.pack(result, fmt)
+        except Exception as e:
+            self.log.error('Failed to pack result %s: %s', Truncated(result), e)
+            msg = wire.pack(None, fmt)
+
         # Try to send the message now. This persists if the socket fails.
         sent = False
         while not sent:
             try:
-                msg = encode(result).encode()
-
-                self.log.info('result sent: {}, {}'.format(msg, result))
-                await self.socket.send_multipart([_id, msg])
+                self.log.debug('result sent: %s', Truncated(result))
+                await self.socket.send_multipart(reply_frames(_id, corr, header, fmt, msg))
                 sent = True
 
             except zmq.error.ZMQError:
@@ -99,8 +158,109 @@ class Server:
         self.running = False
 
 
-def start_server(port=2020, ctx=zmq.asyncio.Context()):
-    server = Server(port=port, ctx=ctx)
+# Serves read commands from a set of replica processes and everything else from this process, which is the only
+# writer. Reads are spread over the replicas by a DEALER socket. The height committed by the writer goes out with each
+# read so that replicas can tell when their view of state is out of date.
+class ReplicatedServer(Server):
+    def __init__(self, port: int, ctx: zmq.Context=zmq.asyncio.Context(), linger=2000, poll_timeout=2000,
+                 replicas=os.cpu_count(), preload=0, blocks_filename=None):
+        super().__init__(port=port, ctx=ctx, linger=linger, poll_timeout=poll_timeout, preload=preload,
+                         blocks_filename=blocks_filename)
+
+        self.replicas = replicas
+        self.processes = []
+
+        self.backend = None
+        self.backend_address = None
+
+        # Commit after every write so that replicas reading from the database see it
+        self.dispatcher.after_write = self.commit
+        self.height = self.interface.driver.height
+
+    def commit(self):
+        self.interface.driver.commit()
+        self.height = self.interface.driver.height
+
+    def setup_backend(self):
+        self.backend = self.ctx.socket(zmq.DEALER)
+        self.backend.setsockopt(zmq.LINGER, self.linger)
+
+        port = self.backend.bind_to_random_port('tcp://127.0.0.1')
+        self.backend_address = 'tcp://127.0.0.1:{}'.format(port)
+
+        # Spawn rather than fork so that replicas don't inherit this process's ZMQ context
+        spawn = multiprocessing.get_context('spawn')
+
+        for _ in range(self.replicas):
+            p = spawn.Process(target=run_replica, args=(self.backend_address, self.blocks_filename), daemon=True)
+            p.start()
+            self.processes.append(p)
+
+    def stop_backend(self):
+        for p in self.processes:
+            p.terminate()
+            p.join()
+
+        self.processes = []
+        self.backend.close()
+
+    async def serve(self):
+        self.log.info("ContractDB replicated server is starting with {} replicas .. ".format(self.replicas))
+
+        self.setup_socket()
+        self.setup_backend()
+
+        poller = zmq.asyncio.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+
+        self.running = True
+
+        while self.running:
+            events = dict(await poller.poll(timeout=self.poll_timeout))
+
+            if self.socket in events:
+                _id, corr, header, msg = split_frames(await self.socket.recv_multipart())
+                asyncio.ensure_future(self.route(_id, msg, header, corr))
+
+            # Replies from replicas come back with the client id, and correlation id if there is one, in front of the
+            # empty delimiter frame. The header frame is empty when the client didn't send one.
+            if self.backend in events:
+                frames = await self.backend.recv_multipart()
+                envelope, (header, fmt, result) = frames[:-4], frames[-3:]
+                corr = envelope[1] if len(envelope) > 1 else None
+
+                # A replica that couldn't catch up sends the message back to be run here
+                if fmt == STALE:
+                    asyncio.ensure_future(self.handle_msg(envelope[0], result, header or None, corr))
+                else:
+                    await self.socket.send_multipart(reply_frames(envelope[0], corr, header or None, fmt, result))
+
+        self.stop_backend()
+        self.socket.close()
+
+    # Anything that can't be classified goes to the writer, which replies None to a message it can't read
+    async def route(self, _id, msg, header=None, corr=None):
+        try:
+            payload = wire.unpack(msg, wire.negotiate(header))
+            read = Dispatcher.command_class(payload) == READ
+        except Exception as e:
+            self.log.error('Failed to route message: %s', e)
+            read = False
+
+        if read:
+            self.requests.record(command_name(payload), payload, len(msg))
+            envelope = [_id] if corr is None else [_id, corr]
+            await self.backend.send_multipart(envelope + [b'', str(self.height).encode(), header or b'', msg])
+        else:
+            await self.handle_msg(_id, msg, header, corr)
+
+
+def start_server(port=2020, ctx=zmq.asyncio.Context(), replicas=0, preload=0):
+    if replicas > 0:
+        server = ReplicatedServer(port=port, ctx=ctx, replicas=replicas, preload=preload)
+    else:
+        server = Server(port=port, ctx=ctx, preload=preload)
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(server.serve())
@@ -0,0 +1,181 @@
+from contracting.db.encoder import encode
+from contractdb.utils import hash_bytes, merkle_node, LEAF_PREFIX
+
+import hashlib
+
+# Number of levels of the tree. State keys are spread over 2 ** STATE_TREE_DEPTH buckets by the hash of the key, so two
+# copies of the state can find the buckets they disagree on in STATE_TREE_DEPTH steps. Each bucket is LANES * 2 bytes,
+# which keeps the whole tree at half a megabyte.
+STATE_TREE_DEPTH = 8
+
+# Buckets are LtHash16 lattice hashes. Every entry hashes to LANES 16 bit lanes and a bucket is the lane by lane sum of
+# its entries modulo 2 ** 16, so an entry can be added or taken out without reading the rest of its bucket. Finding
+# entries that sum to a chosen bucket is a lattice problem, which a sum of single 256 bit hashes is not.
+LANES = 1024
+
+# In memory the lanes are packed into one int with four bytes per lane. Adding two buckets can't carry out of the two
+# spare bytes of a lane, and masking them off afterwards takes the sum modulo 2 ** 16 in every lane at once.
+LANE_MASK = int.from_bytes(b'\xff\xff\x00\x00' * LANES, 'little')
+LANE_MODULUS = int.from_bytes(b'\x00\x00\x01\x00' * LANES, 'little')
+
+# Stored in the backing store next to the buckets so that buckets written with another hash or depth are never loaded
+STATE_TREE_LAYOUT = 'lthash16x{}'.format(LANES)
+
+
+def pack_lanes(lanes: bytes) -> int:
+    slots = bytearray(4 * LANES)
+    slots[0::4] = lanes[0::2]
+    slots[1::4] = lanes[1::2]
+
+    return int.from_bytes(slots, 'little')
+
+
+def unpack_lanes(bucket: int) -> bytes:
+    slots = bucket.to_bytes(4 * LANES, 'little')
+
+    lanes = bytearray(2 * LANES)
+    lanes[0::2] = slots[0::4]
+    lanes[1::2] = slots[1::4]
+
+    return bytes(lanes)
+
+
+def add_lanes(a: int, b: int):
+    return (a + b) & LANE_MASK
+
+
+# Every lane of LANE_MODULUS is at least the lane of b, so nothing borrows from the next lane
+def subtract_lanes(a: int, b: int):
+    return (a + LANE_MODULUS - b) & LANE_MASK
+
+
+def entry_hash(key: str, value):
+    if value is None:
+        return 0
+
+    digest = hashlib.shake_256(key.encode() + b'\x00' + encode(value).encode()).digest(2 * LANES)
+    return pack_lanes(digest)
+
+
+def bucket_hash(bucket: int):
+    return hash_bytes(LEAF_PREFIX + unpack_lanes(bucket))
+
+
+# Authenticated summary of the state. Every write takes the hash of the old value out of one bucket and adds the hash of
+# the new one, and a Merkle tree over the buckets gives the root. Nodes are kept in heap order (the root is 1 and the
+# children of n are 2n and 2n + 1) and only the paths above buckets that changed are hashed again when the root is read.
+class StateTree:
+    def __init__(self, depth=STATE_TREE_DEPTH):
+        self.depth = depth
+        self.size = 1 << depth
+
+        self.buckets = [0] * self.size
+        self.nodes = [None] * (2 * self.size)
+        self.dirty = set(range(self.size))
+
+        # Values buckets had at the last commit, for the buckets written since then
+        self.previous = {}
+
+    def bucket(self, key: str):
+        digest = hashlib.sha3_256(key.encode()).digest()
+        return int.from_bytes(digest[:4], 'big') >> (32 - self.depth)
+
+    @property
+    def layout(self):
+        return '{}:{}'.format(STATE_TREE_LAYOUT, self.depth)
+
+    def update(self, key: str, old, new):
+        removed, added = entry_hash(key, old), entry_hash(key, new)
+
+        if removed == added:
+            return
+
+        b = self.bucket(key)
+
+        if b not in self.previous:
+            self.previous[b] = self.buckets[b]
+
+        self.buckets[b] = add_lanes(subtract_lanes(self.buckets[b], removed), added)
+        self.dirty.add(b)
+
+    def load(self, buckets: list):
+        self.buckets = list(buckets)
+        self.previous = {}
+        self.dirty = set(range(self.size))
+
+    # Returns the buckets changed since the last commit along with their new values
+    def commit(self):
+        changed = {b: self.buckets[b] for b in self.previous}
+        self.previous = {}
+
+        return changed
+
+    def rollback(self):
+        for b, v in self.previous.items():
+            self.buckets[b] = v
+            self.dirty.add(b)
+
+        self.previous = {}
+
+    def refresh(self):
+        level = {self.size + b for b in self.dirty}
+
+        for n in level:
+            self.nodes[n] = bucket_hash(self.buckets[n - self.size])
+
+        while 1 not in level:
+            level = {n >> 1 for n in level}
+
+            for n in level:
+                self.nodes[n] = merkle_node(self.nodes[2 * n], self.nodes[2 * n + 1])
+
+        self.dirty = set()
+
+    def root(self):
+        if len(self.dirty) > 0:
+            self.refresh()
+
+        return self.nodes[1]
+
+    # The node at index within depth (0 is the root) and the hashes of its two children. Buckets are at self.depth and
+    # have no children.
+    def node(self, depth: int, index: int):
+        if not (0 <= depth <= self.depth and 0 <= index < (1 << depth)):
+            return None
+
+        if len(self.dirty) > 0:
+            self.refresh()
+
+        n = (1 << depth) + index
+
+        return {
+            'depth': depth,
+            'index': index,
+            'hash': self.nodes[n],
+            'children': None if depth == self.depth else [self.nodes[2 * n], self.nodes[2 * n + 1]]
+        }
+
+
+# Walks two trees of the same depth from the root down, only following children whose hashes differ, and returns the
+# indexes of the buckets that differ. local and remote are called with (depth, index) and return what StateTree.node
+# does, so remote can be a state_root RPC call. k differing buckets take O(k log n) calls.
+def differing_buckets(local, remote):
+    found = []
+    pending = [(0, 0)]
+
+    while len(pending) > 0:
+        depth, index = pending.pop()
+        a, b = local(depth, index), remote(depth, index)
+
+        if a['hash'] == b['hash']:
+            continue
+
+        if a['children'] is None:
+            found.append(index)
+            continue
+
+        for i in (0, 1):
+            if a['children'][i] != b['children'][i]:
+                pending.append((depth + 1, 2 * index + i))
+
+    return sorted(found)
@@ -0,0 +1,138 @@
+from bisect import bisect_left
+
+import threading
+import time
+
+# Upper bounds of the histogram buckets in seconds, doubling from 1 microsecond to about 67 seconds. Anything slower
+# lands in one last bucket.
+BUCKET_BOUNDS = [2 ** i / 1000000 for i in range(27)]
+
+# Functions past this many are counted together under OTHER_FUNCTION, so names sent by clients can't grow the report
+# without bound
+MAX_FUNCTIONS = 1000
+OTHER_FUNCTION = 'other'
+
+# Phases of Engine.run in the order they happen
+PHASES = [
+    'structure',
+    'signature',
+    'environment',
+    'owner',
+    'import',
+    'call',
+    'sets',
+    'clean_up'
+]
+
+
+# Counts samples into fixed log scale buckets, so recording is one bisect and memory doesn't grow with the number of
+# samples. Percentiles are reported as the upper bound of the bucket they fall in.
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds: float):
+        self.counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float):
+        rank = p * self.count
+        seen = 0
+
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n > 0:
+                return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+
+        return 0
+
+    # Times in milliseconds. Buckets are [upper bound, count] pairs, leaving out the empty ones.
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total * 1000,
+            'mean_ms': self.total / self.count * 1000 if self.count > 0 else 0,
+            'max_ms': self.max * 1000,
+            'p50_ms': self.percentile(0.50) * 1000,
+            'p90_ms': self.percentile(0.90) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+            'buckets': [[BUCKET_BOUNDS[i] * 1000 if i < len(BUCKET_BOUNDS) else None, n]
+                        for i, n in enumerate(self.counts) if n > 0]
+        }
+
+
+# Times one transaction. Every lap closes the phase that started at the previous one.
+class PhaseTimer:
+    def __init__(self, timings):
+        self.timings = timings
+        self.start = self.last = time.perf_counter()
+        self.laps = []
+
+    def lap(self, phase: str):
+        now = time.perf_counter()
+        self.laps.append((phase, now - self.last))
+        self.last = now
+
+    def finish(self, contract: str=None, function: str=None):
+        self.timings.record(self.laps, None if contract is None else '{}.{}'.format(contract, function),
+                            self.last - self.start)
+
+
+# Stands in for PhaseTimer while timing is off, so the hot path costs a few no-op calls
+class NullTimer:
+    def lap(self, phase: str):
+        pass
+
+    def finish(self, contract: str=None, function: str=None):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+# Histograms of how long each phase of Engine.run takes and of the whole run per contract function. Off by default and
+# can be switched on and off while running.
+class EngineTimings:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+
+        self.phases = {}
+        self.functions = {}
+
+    def timer(self):
+        return PhaseTimer(self) if self.enabled else NULL_TIMER
+
+    def record(self, laps: list, function: str, seconds: float):
+        with self.lock:
+            for phase, elapsed in laps:
+                if phase not in self.phases:
+                    self.phases[phase] = Histogram()
+                self.phases[phase].record(elapsed)
+
+            if function is not None:
+                if function not in self.functions:
+                    if len(self.functions) >= MAX_FUNCTIONS:
+                        function = OTHER_FUNCTION
+                    self.functions.setdefault(function, Histogram())
+                self.functions[function].record(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.functions = {}
+
+    def report(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'phases': {phase: self.phases[phase].summary() for phase in PHASES if phase in self.phases},
+                'functions': {function: h.summary() for function, h in self.functions.items()}
+            }
@@ -1,5 +1,7 @@
 import ecdsa
 from contracting.db.encoder import encode
+from collections import OrderedDict
+import threading
 import hashlib
 
 
@@ -43,10 +45,182 @@ def generate_tx_hash(tx_input: dict, tx_output: dict):
     return hash_bytes(encoded_input + encoded_output)
 
 
+# The separators encode puts between items and after keys. They differ between contracting versions, so they are read
+# off a sample encoding.
+SAMPLE_ENCODING = encode({'a': 0, 'b': 0})
+KEY_SEPARATOR = SAMPLE_ENCODING[len('{"a"'):SAMPLE_ENCODING.index('0')]
+ITEM_SEPARATOR = SAMPLE_ENCODING[SAMPLE_ENCODING.index('0') + 1:SAMPLE_ENCODING.index('"b"')]
+
+
+# Builds the JSON object text for already encoded values, the same as encode would for a dict of the raw values
+def join_fields(fields: dict) -> str:
+    return '{' + ITEM_SEPARATOR.join(encode(k) + KEY_SEPARATOR + v for k, v in fields.items()) + '}'
+
+
+# A finalized transaction that remembers its canonical encoding. The input and output are encoded exactly once, field
+# by field, and the results are reused for the tx hash, the block hash and the stored row. The encodings are attributes
+# rather than keys, so they never show up when the transaction is serialized. Mutating the input or output after
+# finalizing leaves them stale.
+class FinalizedTx(dict):
+    def __init__(self, tx_input: dict, tx_output: dict):
+        super().__init__(input=tx_input, output=tx_output)
+
+        # Nested dicts keep their own key order in hash_dict, so the payload is joined in insertion order
+        payload = tx_input.get('payload')
+        self.payload_fields = {k: encode(v) for k, v in payload.items()} if isinstance(payload, dict) else None
+
+        input_fields = {}
+        for k, v in sorted(tx_input.items()):
+            input_fields[k] = join_fields(self.payload_fields) if k == 'payload' and self.payload_fields is not None \
+                else encode(v)
+
+        self.output_fields = {k: encode(v) for k, v in sorted(tx_output.items())}
+
+        # Byte for byte the same as hash_dict(tx_input) and hash_dict(tx_output)
+        self.encoded_input = join_fields(input_fields).encode()
+        self.encoded_output = join_fields(self.output_fields).encode()
+
+        self['hash'] = hash_bytes(self.encoded_input + self.encoded_output)
+
+
 # Standard method for turning tx input and tx output into final data to be stored into a block
 def make_finalized_tx(tx_input, tx_output):
-    return {
-        'input': tx_input,
-        'output': tx_output,
-        'hash': generate_tx_hash(tx_input, tx_output)
-    }
+    return FinalizedTx(tx_input, tx_output)
+
+
+# Merkle tree over the transaction hashes of a block. Leaves and inner nodes are hashed with different prefixes so that
+# an inner node can't be passed off as a leaf. A node without a sibling is carried up to the next level as is.
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+EMPTY_MERKLE_ROOT = hash_bytes(b'')
+
+
+def merkle_leaf(tx_hash: str):
+    return hash_bytes(LEAF_PREFIX + tx_hash.encode())
+
+
+def merkle_node(left: str, right: str):
+    return hash_bytes(NODE_PREFIX + left.encode() + right.encode())
+
+
+# Builds the root as transaction hashes are appended. Only the last unpaired node of each level is kept, so a block of
+# n transactions needs O(log n) memory.
+class MerkleTree:
+    def __init__(self):
+        self.pending = []
+        self.size = 0
+
+    def append(self, tx_hash: str):
+        level, node = 0, merkle_leaf(tx_hash)
+
+        while len(self.pending) > 0 and self.pending[-1][0] == level:
+            _, left = self.pending.pop()
+            level, node = level + 1, merkle_node(left, node)
+
+        self.pending.append((level, node))
+        self.size += 1
+
+    def root(self):
+        if len(self.pending) == 0:
+            return EMPTY_MERKLE_ROOT
+
+        root = self.pending[-1][1]
+        for _, left in reversed(self.pending[:-1]):
+            root = merkle_node(left, root)
+
+        return root
+
+
+def merkle_root(tx_hashes: list):
+    tree = MerkleTree()
+
+    for tx_hash in tx_hashes:
+        tree.append(tx_hash)
+
+    return tree.root()
+
+
+# Returns the sibling hashes on the path from the transaction at index up to the root, as ['left' or 'right', hash]
+# pairs from the bottom up. A level where the node has no sibling adds nothing.
+def merkle_proof(tx_hashes: list, index: int):
+    level = [merkle_leaf(tx_hash) for tx_hash in tx_hashes]
+    proof = []
+
+    while len(level) > 1:
+        sibling = index ^ 1
+
+        if sibling < len(level):
+            proof.append(['left' if sibling < index else 'right', level[sibling]])
+
+        level = [merkle_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        index //= 2
+
+    return proof
+
+
+# Checks a proof from get_tx_proof without needing the rest of the block
+def verify_tx_proof(tx_hash: str, proof: list, root: str):
+    node = merkle_leaf(tx_hash)
+
+    for side, sibling in proof:
+        node = merkle_node(sibling, node) if side == 'left' else merkle_node(node, sibling)
+
+    return node == root
+
+
+# A block's hash commits to the hash of the block before it, its own index, the Merkle root of its transactions and,
+# when there is one, the state root after it
+def block_hash(previous_hash: str, index: int, root: str, state_root: str=None):
+    b = previous_hash.encode() + index.to_bytes(8, 'big') + root.encode()
+
+    if state_root is not None:
+        b += state_root.encode()
+
+    return hash_bytes(b)
+
+
+# Bounded mapping that drops the least recently used entry once it holds more than size of them, counting hits and
+# misses as it is read. fresh, if given, decides whether a stored value can still be used. One that can't is a miss.
+# Reads reorder the entries, so every access holds the lock. Caches are read from the dispatcher's read threads.
+class LRUCache:
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, fresh=None):
+        with self.lock:
+            value = self.entries.get(key)
+
+            if value is not None and (fresh is None or fresh(value)):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+            self.misses += 1
+
+        return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
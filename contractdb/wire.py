@@ -0,0 +1,75 @@
+from contracting.db.encoder import encode, decode
+from contracting.stdlib.bridge.time import Datetime, Timedelta
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+
+import decimal
+import msgpack
+
+# Wire formats a client can ask for by putting a header frame in front of its message. Messages without a header, or
+# with one the server doesn't know, are JSON.
+JSON = b'json'
+MSGPACK = b'msgpack'
+
+FORMATS = {JSON, MSGPACK}
+
+# MessagePack extension type codes for the types contracting passes around that MessagePack has no native type for.
+# bytes are native so they don't need one.
+DECIMAL_EXT = 1
+DATETIME_EXT = 2
+TIMEDELTA_EXT = 3
+
+
+def negotiate(header: bytes):
+    return header if header in FORMATS else JSON
+
+
+# Decimals go as their string so that they come back exactly, unlike JSON which sends them as floats. ContractingDecimal
+# wraps a Decimal rather than subclassing it, and is matched by name as well, the same as contracting's encoder does.
+def _default(o):
+    if isinstance(o, decimal.Decimal):
+        return msgpack.ExtType(DECIMAL_EXT, str(o).encode())
+    if isinstance(o, ContractingDecimal) or o.__class__.__name__ == ContractingDecimal.__name__:
+        return msgpack.ExtType(DECIMAL_EXT, str(o._d).encode())
+    if isinstance(o, Datetime):
+        return msgpack.ExtType(DATETIME_EXT, msgpack.packb([o.year, o.month, o.day, o.hour, o.minute, o.second,
+                                                            o.microsecond]))
+    if isinstance(o, Timedelta):
+        return msgpack.ExtType(TIMEDELTA_EXT, msgpack.packb([o._timedelta.days, o._timedelta.seconds]))
+
+    raise TypeError('Cannot serialize {} to msgpack'.format(type(o)))
+
+
+# Decimals come back as ContractingDecimal, the same type contracting's JSON decoder gives
+def _ext_hook(code, data):
+    if code == DECIMAL_EXT:
+        return ContractingDecimal(decimal.Decimal(data.decode()))
+    if code == DATETIME_EXT:
+        return Datetime(*msgpack.unpackb(data))
+    if code == TIMEDELTA_EXT:
+        days, seconds = msgpack.unpackb(data)
+        return Timedelta(days=days, seconds=seconds)
+
+    return msgpack.ExtType(code, data)
+
+
+def pack(data, fmt=JSON) -> bytes:
+    if fmt == MSGPACK:
+        return msgpack.packb(data, default=_default, use_bin_type=True)
+
+    return encode(data).encode()
+
+
+# Errors a decoder or one of its object hooks can raise on a malformed payload. Bad utf-8 is a ValueError, and a bad
+# decimal string or the wrong shape for a time type is one of the other two.
+DECODE_ERRORS = (ValueError, TypeError, decimal.InvalidOperation)
+
+
+# Both decoders return None for a payload they can't read, the same as contracting's JSON decoder does for bad JSON
+def unpack(data: bytes, fmt=JSON):
+    try:
+        if fmt == MSGPACK:
+            return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+        return decode(data)
+    except DECODE_ERRORS:
+        return None
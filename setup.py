@@ -11,7 +11,8 @@ requirements = [
     'Click',
     'zmq',
     'PyNaCl',
-    'PyYAML'
+    'PyYAML',
+    'msgpack'
 ]
 
 setup(
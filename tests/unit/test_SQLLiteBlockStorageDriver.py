@@ -3,17 +3,23 @@ from contractdb.chain import SQLLiteBlockStorageDriver, \
     BlockIndexNotSequentialError, \
     BlockHashAlreadyExistsError, \
     BlockIndexAlreadyExistsError, \
-    TransactionHashAlreadyExistsError
+    TransactionHashAlreadyExistsError, \
+    SCHEMA_MIGRATIONS, \
+    BLOCK_QUERY
 from contractdb.driver import ContractDBDriver
+from contractdb import utils
+from contracting.db.encoder import encode
+import sqlite3
+import decimal
+import json
+import os
+import time
 
 class TestSQLLiteBlockStorageDriver(TestCase):
     def setUp(self):
         self.chain = SQLLiteBlockStorageDriver(filename='blocks.db')
 
-        self.chain.cursor.execute('drop table blocks')
-        self.chain.cursor.execute('drop table transaction_inputs')
-        self.chain.cursor.execute('drop table transaction_outputs')
-
+        self.chain.flush()
         self.chain.setup()
 
         self.b = {
@@ -38,8 +44,8 @@ class TestSQLLiteBlockStorageDriver(TestCase):
                     'output': {
                         'status': 0,
                         'updates': {
-                            'stu': 'cool',
-                            'monica': 'lame'
+                            'stu': encode('cool'),
+                            'monica': encode('lame')
                         },
                         'result': {}
                     }
@@ -62,8 +68,8 @@ class TestSQLLiteBlockStorageDriver(TestCase):
                     'output': {
                         'status': 0,
                         'updates': {
-                            'hello': 'there',
-                            'obj': [1, 2, 3]
+                            'hello': encode('there'),
+                            'obj': encode([1, 2, 3])
                         },
                         'result': {}
                     }
@@ -94,8 +100,8 @@ class TestSQLLiteBlockStorageDriver(TestCase):
                     'output': {
                         'status': 0,
                         'updates': {
-                            'another': 'one',
-                            'true': False
+                            'another': encode('one'),
+                            'true': encode(False)
                         },
                         'result': {}
                     }
@@ -118,8 +124,8 @@ class TestSQLLiteBlockStorageDriver(TestCase):
                     'output': {
                         'status': 0,
                         'updates': {
-                            'dict': {'hi': 123},
-                            'blah': 'blah'
+                            'dict': encode({'hi': 123}),
+                            'blah': encode('blah')
                         },
                         'result': {}
                     }
@@ -148,6 +154,217 @@ class TestSQLLiteBlockStorageDriver(TestCase):
     def test_latest_hash(self):
         self.assertEqual(self.chain.latest_hash(), 'hello2')
 
+    def test_tip_is_stored_in_chain_tip_table(self):
+        self.chain.cursor.execute('select height, hash from chain_tip')
+        self.assertEqual(self.chain.cursor.fetchall(), [(1, 'hello2')])
+
+    def test_tip_is_loaded_on_startup(self):
+        chain = SQLLiteBlockStorageDriver(filename='blocks.db')
+
+        self.assertEqual(chain.height(), 1)
+        self.assertEqual(chain.latest_hash(), 'hello2')
+
+        chain.conn.close()
+
+    def test_tip_is_rebuilt_if_missing_or_stale(self):
+        self.chain.cursor.execute('delete from chain_tip')
+        self.chain.conn.commit()
+        self.chain.setup()
+
+        self.assertEqual(self.chain.height(), 1)
+        self.assertEqual(self.chain.latest_hash(), 'hello2')
+
+        self.chain.cursor.execute('update chain_tip set height = 0, hash = ?', ('hello',))
+        self.chain.conn.commit()
+        self.chain.setup()
+
+        self.assertEqual(self.chain.height(), 1)
+        self.assertEqual(self.chain.latest_hash(), 'hello2')
+
+    def test_tip_of_empty_chain(self):
+        self.chain.flush()
+        self.chain.setup()
+
+        self.assertEqual(self.chain.height(), -1)
+        self.assertEqual(self.chain.latest_hash(), '0' * 64)
+
+    def test_setup_migrates_to_latest_schema_version(self):
+        self.assertEqual(self.chain.schema_version(), len(SCHEMA_MIGRATIONS))
+
+        self.chain.cursor.execute("select name from sqlite_master where type = 'index' and name like 'transactions_%'")
+        indexes = {row[0] for row in self.chain.cursor.fetchall()}
+
+        self.assertEqual(indexes, {'transactions_parent_block',
+                                   'transactions_sender',
+                                   'transactions_contract'})
+
+    def test_setup_upgrades_split_table_database_in_place(self):
+        filename = 'blocks_legacy.db'
+
+        # Write a block in the original layout with separate input and output tables and no schema version
+        conn = sqlite3.connect(filename)
+        cursor = conn.cursor()
+        cursor.execute('create table blocks (hash text primary key, idx integer unique)')
+        cursor.execute('create table transaction_inputs (hash text primary key, parent_block text, '
+                       'block_index integer, sender text, signature text, contract text, function text, '
+                       'arguments text)')
+        cursor.execute('create table transaction_outputs (hash text primary key, parent_block text, '
+                       'block_index integer, status integer, updates text, result text)')
+
+        cursor.execute('insert into blocks values (?, ?)', (self.b['hash'], self.b['index']))
+
+        for tx in reversed(self.b['transactions']):
+            payload = tx['input']['payload']
+            cursor.execute('insert into transaction_inputs values (?, ?, ?, ?, ?, ?, ?, ?)',
+                           (tx['hash'], self.b['hash'], tx['input']['index'], tx['input']['sender'],
+                            tx['input']['signature'], payload['contract'], payload['function'],
+                            json.dumps(payload['arguments'])))
+
+            cursor.execute('insert into transaction_outputs values (?, ?, ?, ?, ?, ?)',
+                           (tx['hash'], self.b['hash'], tx['input']['index'], tx['output']['status'],
+                            json.dumps(tx['output']['updates']), json.dumps(tx['output']['result'])))
+
+        conn.commit()
+        conn.close()
+
+        chain = SQLLiteBlockStorageDriver(filename=filename)
+
+        try:
+            self.assertEqual(chain.schema_version(), len(SCHEMA_MIGRATIONS))
+            self.assertEqual(chain.height(), 0)
+            self.assertEqual(chain.get_block_by_hash('hello'), self.b)
+
+            chain.cursor.execute("select name from sqlite_master where type = 'table'")
+            tables = {row[0] for row in chain.cursor.fetchall()}
+
+            self.assertNotIn('transaction_inputs', tables)
+            self.assertNotIn('transaction_outputs', tables)
+        finally:
+            chain.conn.close()
+            os.remove(filename)
+
+    def test_block_is_read_with_one_indexed_query(self):
+        self.chain.cursor.execute('explain query plan ' + BLOCK_QUERY.format('idx'), (1,))
+        plan = ' '.join(str(row) for row in self.chain.cursor.fetchall())
+
+        self.assertIn('transactions_parent_block', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_get_empty_block(self):
+        b = {
+            'hash': 'empty',
+            'index': 2,
+            'transactions': []
+        }
+
+        self.chain.insert_block(b)
+
+        self.assertEqual(self.chain.get_block_by_index(2), b)
+
+    def test_get_block_that_doesnt_exist_returns_none(self):
+        self.assertIsNone(self.chain.get_block_by_index(100))
+        self.assertIsNone(self.chain.get_block_by_hash('nope'))
+
+    def test_get_blocks_returns_range_in_order(self):
+        self.assertEqual(list(self.chain.get_blocks(0)), [self.b, self.b2])
+        self.assertEqual(list(self.chain.get_blocks(1)), [self.b2])
+        self.assertEqual(list(self.chain.get_blocks(0, 1)), [self.b])
+        self.assertEqual(list(self.chain.get_blocks(2)), [])
+
+    def test_get_blocks_splits_blocks_across_batches(self):
+        empty = {
+            'hash': 'empty',
+            'index': 2,
+            'transactions': []
+        }
+
+        self.chain.insert_block(empty)
+
+        for batch_size in (1, 2, 3, 100):
+            self.assertEqual(list(self.chain.get_blocks(0, batch_size=batch_size)), [self.b, self.b2, empty])
+
+    def test_get_blocks_is_lazy(self):
+        blocks = self.chain.get_blocks(0)
+
+        self.assertEqual(next(blocks), self.b)
+
+        # Reads on the main cursor don't disturb the stream
+        self.assertEqual(self.chain.get_block_by_index(0), self.b)
+
+        self.assertEqual(next(blocks), self.b2)
+
+    def test_store_txs_sets_merkle_root_and_chains_hash(self):
+        txs = [dict(self.b['transactions'][0], hash='t{}'.format(i)) for i in range(5)]
+
+        previous = self.chain.latest_hash()
+        block = self.chain.store_txs(txs)
+
+        self.assertEqual(block['merkle_root'], utils.merkle_root(['t{}'.format(i) for i in range(5)]))
+        self.assertEqual(block['hash'], utils.block_hash(previous, block['index'], block['merkle_root']))
+        self.assertEqual(self.chain.get_block_by_index(block['index']), block)
+
+    def test_store_txs_with_state_root(self):
+        txs = [dict(self.b['transactions'][0], hash='t{}'.format(i)) for i in range(2)]
+
+        previous = self.chain.latest_hash()
+        block = self.chain.store_txs(txs, state_root='ab' * 32)
+
+        self.assertEqual(block['hash'], utils.block_hash(previous, block['index'], block['merkle_root'], 'ab' * 32))
+        self.assertNotEqual(block['hash'], utils.block_hash(previous, block['index'], block['merkle_root']))
+        self.assertEqual(self.chain.get_block_by_index(block['index'])['state_root'], 'ab' * 32)
+
+    def test_tx_proof_verifies_against_block_root(self):
+        txs = [dict(self.b['transactions'][0], hash='t{}'.format(i)) for i in range(7)]
+        block = self.chain.store_txs(txs)
+
+        for i in range(7):
+            proof = self.chain.get_tx_proof('t{}'.format(i))
+
+            self.assertEqual(proof['block_hash'], block['hash'])
+            self.assertEqual(proof['merkle_root'], block['merkle_root'])
+            self.assertLessEqual(len(proof['proof']), 3)
+            self.assertTrue(utils.verify_tx_proof('t{}'.format(i), proof['proof'], proof['merkle_root']))
+
+    def test_tx_proof_for_block_without_stored_root(self):
+        proof = self.chain.get_tx_proof('xxy')
+
+        self.assertEqual(proof['block_hash'], 'hello')
+        self.assertTrue(utils.verify_tx_proof('xxy', proof['proof'], proof['merkle_root']))
+
+    def test_tx_proof_for_missing_tx(self):
+        self.assertIsNone(self.chain.get_tx_proof('nope'))
+
+    def test_finalized_and_plain_transactions_are_stored_the_same_way(self):
+        tx_input = {
+            'index': 0,
+            'sender': 'stu',
+            'signature': 'asd',
+            'payload': {'contract': 'currency', 'function': 'transfer', 'arguments': {'amount': decimal.Decimal('1.5')}}
+        }
+        tx_output = {'status': 0, 'updates': {'currency.balances:stu': encode(decimal.Decimal('8.5'))}, 'result': None}
+
+        finalized = utils.make_finalized_tx(tx_input, tx_output)
+        plain = {'hash': 'plain', 'input': tx_input, 'output': tx_output}
+
+        self.chain.store_txs([finalized])
+        self.chain.store_txs([plain])
+
+        rows = self.chain.cursor.execute('select arguments, updates, result from transactions where hash in (?, ?)',
+                                         (finalized['hash'], 'plain')).fetchall()
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0], rows[1])
+
+        for tx_hash in (finalized['hash'], 'plain'):
+            tx = self.chain.get_transaction_by_hash(tx_hash)
+
+            self.assertEqual(str(tx['input']['payload']['arguments']['amount']), '1.5')
+            self.assertEqual(tx['output']['updates'], tx_output['updates'])
+
+    def test_most_used_contracts(self):
+        self.assertEqual(self.chain.most_used_contracts(2), ['stustu', 'absfsd'])
+        self.assertEqual(self.chain.most_used_contracts(1), ['stustu'])
+
     def test_get_tx_by_hash(self):
         tx = self.chain.get_transaction_by_hash('uuu')
         self.assertEqual(tx, self.b2['transactions'][1])
@@ -210,6 +427,28 @@ class TestSQLLiteBlockStorageDriver(TestCase):
         with self.assertRaises(TransactionHashAlreadyExistsError):
             self.chain.insert_block(b)
 
+    def test_storing_block_reports_every_duplicate_tx_hash(self):
+        b = {
+            'hash': 'helloxxx',
+            'index': 2,
+            'transactions': [
+                {'hash': 'xxx'},
+                {'hash': 'new'},
+                {'hash': 'uuu'},
+                {'hash': 'new'}
+            ]
+        }
+
+        with self.assertRaises(TransactionHashAlreadyExistsError) as e:
+            self.chain.insert_block(b)
+
+        self.assertEqual(e.exception.hashes, ['xxx', 'new', 'uuu'])
+
+    def test_existing_transaction_hashes_over_many_chunks(self):
+        hashes = ['missing{}'.format(i) for i in range(2500)] + ['yyy', 'xxy']
+
+        self.assertEqual(self.chain.existing_transaction_hashes(hashes), {'yyy', 'xxy'})
+
     def test_sync_works_as_expected(self):
         c = ContractDBDriver()
 
@@ -223,3 +462,129 @@ class TestSQLLiteBlockStorageDriver(TestCase):
         self.assertEqual(c.get('true'), False)
         self.assertEqual(c.get('dict'), {'hi': 123})
         self.assertEqual(c.get('blah'), 'blah')
+
+
+    def test_rebuild_state_matches_sync(self):
+        c = ContractDBDriver()
+        c.flush()
+
+        progress = []
+        self.chain.rebuild_state(c, progress=lambda h, t: progress.append((h, t)))
+
+        self.assertEqual(c.get('stu'), 'cool')
+        self.assertEqual(c.get('monica'), 'lame')
+        self.assertEqual(c.get('hello'), 'there')
+        self.assertEqual(c.get('obj'), [1, 2, 3])
+        self.assertEqual(c.get('another'), 'one')
+        self.assertEqual(c.get('true'), False)
+        self.assertEqual(c.get('dict'), {'hi': 123})
+        self.assertEqual(c.get('blah'), 'blah')
+
+        self.assertEqual(c.height, 1)
+        self.assertEqual(c.latest_hash, 'hello2')
+        self.assertEqual(progress, [(1, 1)])
+
+    def test_rebuild_state_keeps_last_write_and_resumes_from_checkpoint(self):
+        b3 = {
+            'hash': 'hello3',
+            'index': 2,
+            'transactions': [
+                {
+                    'hash': 'zzz',
+                    'input': {
+                        'index': 0,
+                        'sender': 'stu',
+                        'signature': 'asd',
+                        'payload': {
+                            'contract': 'stustu',
+                            'function': 'send',
+                            'arguments': {}
+                        }
+                    },
+                    'output': {
+                        'status': 0,
+                        'updates': {
+                            'stu': encode('cooler')
+                        },
+                        'result': {}
+                    }
+                }
+            ]
+        }
+
+        self.chain.insert_block(b3)
+
+        c = ContractDBDriver()
+        c.flush()
+
+        # Pretend an earlier rebuild was checkpointed at block 0
+        c.set_many({'stu': 'cool', 'monica': 'lame', 'hello': 'there', 'obj': [1, 2, 3],
+                    c.height_key: 0, c.latest_hash_key: 'hello'})
+
+        progress = []
+        self.chain.rebuild_state(c, checkpoint_interval=2, progress=lambda h, t: progress.append((h, t)))
+
+        self.assertEqual(progress, [(1, 2), (2, 2)])
+
+        self.assertEqual(c.get('stu'), 'cooler')
+        self.assertEqual(c.get('monica'), 'lame')
+        self.assertEqual(c.get('blah'), 'blah')
+        self.assertEqual(c.height, 2)
+        self.assertEqual(c.latest_hash, 'hello3')
+
+class TestSQLLiteBlockStorageDriverInsertBenchmark(TestCase):
+    def setUp(self):
+        self.filename = 'blocks_benchmark.db'
+        self.chain = SQLLiteBlockStorageDriver(filename=self.filename)
+
+    def tearDown(self):
+        self.chain.conn.close()
+        os.remove(self.filename)
+
+    @staticmethod
+    def make_block(index, size):
+        return {
+            'hash': 'block{}'.format(index),
+            'index': index,
+            'transactions': [
+                {
+                    'hash': 'tx{}_{}'.format(index, i),
+                    'input': {
+                        'index': i,
+                        'sender': 'stu',
+                        'signature': 'asd',
+                        'payload': {
+                            'contract': 'currency',
+                            'function': 'transfer',
+                            'arguments': {
+                                'to': 'raghu',
+                                'amount': i
+                            }
+                        }
+                    },
+                    'output': {
+                        'status': 0,
+                        'updates': {
+                            'currency.balances:stu': str(i),
+                            'currency.balances:raghu': str(i)
+                        },
+                        'result': None
+                    }
+                } for i in range(size)
+            ]
+        }
+
+    def test_insert_block_rows_per_second(self):
+        for index, size in enumerate([1, 10, 100, 1000, 10000]):
+            b = self.make_block(index, size)
+
+            start = time.perf_counter()
+            self.chain.insert_block(b)
+            elapsed = time.perf_counter() - start
+
+            # One row for the block plus one per transaction
+            rows = 1 + size
+            print('insert_block: {} txs, {} rows, {:.0f} rows/sec'.format(size, rows, rows / elapsed))
+
+            self.assertEqual(self.chain.height(), index)
+            self.assertEqual(len(self.chain.get_block_by_index(index)['transactions']), size)
@@ -0,0 +1,163 @@
+from unittest import TestCase
+from contractdb.server import Server
+from contractdb.client.network import ChainCmds, AsyncChainCmds, backoff_delay
+from contractdb import wire
+from zcomm import services
+import asyncio
+import time
+import zmq
+import zmq.asyncio
+
+
+async def stop_server(s, timeout):
+    await asyncio.sleep(timeout)
+    s.stop()
+
+
+class TestBackoff(TestCase):
+    def test_backoff_doubles(self):
+        self.assertEqual([backoff_delay(a, 100, 10000) for a in range(4)], [100, 200, 400, 800])
+
+    def test_backoff_is_capped(self):
+        self.assertEqual(backoff_delay(20, 100, 2000), 2000)
+
+
+class TestChainCmds(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+        self.client_ctx = zmq.Context()
+
+    def tearDown(self):
+        self.ctx.destroy()
+        self.client_ctx.destroy()
+
+    def test_pipelined_calls_are_matched_to_replies(self):
+        m = Server(port=2020, ctx=self.ctx)
+
+        for i in range(5):
+            m.interface.driver.set_contract('c{}'.format(i), 'def f():\n    return {}\n'.format(i))
+
+        cmds = ChainCmds(ctx=self.client_ctx, pool_size=2)
+        msgs = [{'command': 'get_contract', 'arguments': {'name': 'c{}'.format(i)}} for i in range(5)]
+
+        async def call():
+            return await asyncio.get_event_loop().run_in_executor(None, cmds.server_calls, msgs)
+
+        tasks = asyncio.gather(
+            m.serve(),
+            call(),
+            stop_server(m, 0.5),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)[1]
+        cmds.close()
+
+        self.assertEqual(res, [m.interface.get_contract('c{}'.format(i)) for i in range(5)])
+
+    def test_connections_are_reused(self):
+        m = Server(port=2020, ctx=self.ctx)
+
+        cmds = ChainCmds(ctx=self.client_ctx, pool_size=2)
+
+        def calls():
+            return [cmds.server_call({'command': 'ping', 'arguments': {}}) for _ in range(3)]
+
+        async def call():
+            return await asyncio.get_event_loop().run_in_executor(None, calls)
+
+        tasks = asyncio.gather(
+            m.serve(),
+            call(),
+            stop_server(m, 0.5),
+        )
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(tasks)
+
+        self.assertEqual(cmds.pool.opened, 1)
+        cmds.close()
+
+    def test_timeout_retries_with_backoff_then_returns_none(self):
+        cmds = ChainCmds(socket_id=services._socket('tcp://127.0.0.1:2021'), ctx=self.client_ctx,
+                         timeout=50, retries=2, backoff=20, max_backoff=40)
+
+        start = time.monotonic()
+        res = cmds.server_call({'command': 'ping', 'arguments': {}})
+        elapsed = time.monotonic() - start
+        cmds.close()
+
+        self.assertIsNone(res)
+
+        # Three timeouts of 50ms plus backoffs of 20ms and 40ms
+        self.assertGreaterEqual(elapsed, 0.21)
+        self.assertEqual(cmds.pool.opened, 0)
+
+    def test_writes_are_not_retried(self):
+        cmds = ChainCmds(socket_id=services._socket('tcp://127.0.0.1:2021'), ctx=self.client_ctx,
+                         timeout=50, retries=2, backoff=200, max_backoff=200)
+
+        start = time.monotonic()
+        res = cmds.server_calls([{'command': 'ping', 'arguments': {}},
+                                 {'command': 'run', 'arguments': {'transaction': {}}}])
+        elapsed = time.monotonic() - start
+        cmds.close()
+
+        self.assertEqual(res, [None, None])
+
+        # One timeout and no backoff
+        self.assertLess(elapsed, 0.2)
+
+
+class TestAsyncChainCmds(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_many_calls_in_flight(self):
+        m = Server(port=2020, ctx=self.ctx)
+
+        for i in range(20):
+            m.interface.driver.set_contract('c{}'.format(i), 'def f():\n    return {}\n'.format(i))
+
+        cmds = AsyncChainCmds(ctx=self.ctx, fmt=wire.MSGPACK)
+        msgs = [{'command': 'get_contract', 'arguments': {'name': 'c{}'.format(i)}} for i in range(20)]
+
+        tasks = asyncio.gather(
+            m.serve(),
+            cmds.server_calls(msgs),
+            stop_server(m, 0.5),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)[1]
+        cmds.close()
+
+        self.assertEqual(res, [m.interface.get_contract('c{}'.format(i)) for i in range(20)])
+
+    def test_timeout_returns_none(self):
+        cmds = AsyncChainCmds(socket_id=services._socket('tcp://127.0.0.1:2021'), ctx=self.ctx,
+                              timeout=50, retries=1, backoff=10)
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(cmds.server_call({'command': 'ping', 'arguments': {}}))
+        cmds.close()
+
+        self.assertIsNone(res)
+        self.assertEqual(cmds.pending, {})
+
+    def test_writes_are_not_retried(self):
+        cmds = AsyncChainCmds(socket_id=services._socket('tcp://127.0.0.1:2021'), ctx=self.ctx,
+                              timeout=50, retries=2, backoff=200, max_backoff=200)
+
+        loop = asyncio.get_event_loop()
+
+        start = time.monotonic()
+        res = loop.run_until_complete(cmds.server_call({'command': 'run_all', 'arguments': {'transactions': []}}))
+        elapsed = time.monotonic() - start
+        cmds.close()
+
+        self.assertIsNone(res)
+        self.assertLess(elapsed, 0.2)
@@ -0,0 +1,141 @@
+from unittest import TestCase
+from contractdb.dispatch import Dispatcher, LatencyTracker, ReadWriteLock, READ, WRITE, OTHER
+import threading
+import asyncio
+import time
+
+
+class SlowInterface:
+    def __init__(self, write_time=0.2):
+        self.write_time = write_time
+        self.calls = []
+
+    def process_json_rpc_command(self, payload):
+        self.calls.append((payload['command'], threading.current_thread().name))
+
+        if payload['command'] == 'run_all':
+            time.sleep(self.write_time)
+
+        return payload['command']
+
+
+def run(*coroutines):
+    async def gather():
+        return await asyncio.gather(*coroutines)
+
+    loop = asyncio.new_event_loop()
+    results = loop.run_until_complete(gather())
+    loop.close()
+
+    return results
+
+
+class TestDispatcher(TestCase):
+    def setUp(self):
+        self.interface = SlowInterface()
+        self.dispatcher = Dispatcher(interface=self.interface)
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+
+    def test_command_classes(self):
+        self.assertEqual(self.dispatcher.command_class({'command': 'run'}), WRITE)
+        self.assertEqual(self.dispatcher.command_class({'command': 'run_all'}), WRITE)
+        self.assertEqual(self.dispatcher.command_class({'command': 'get_var'}), READ)
+        self.assertEqual(self.dispatcher.command_class({'command': 'get_block_by_index'}), READ)
+        self.assertEqual(self.dispatcher.command_class({'command': 'ping'}), OTHER)
+        self.assertEqual(self.dispatcher.command_class(None), OTHER)
+
+    def test_batch_takes_strongest_class(self):
+        def batch(*commands):
+            return {'command': 'batch', 'arguments': {'commands': [{'command': c} for c in commands]}}
+
+        self.assertEqual(self.dispatcher.command_class(batch('ping', 'get_var', 'run')), WRITE)
+        self.assertEqual(self.dispatcher.command_class(batch('ping', 'get_var')), READ)
+        self.assertEqual(self.dispatcher.command_class(batch('ping')), OTHER)
+        self.assertEqual(self.dispatcher.command_class({'command': 'batch', 'arguments': {}}), OTHER)
+
+    def test_ping_is_not_blocked_by_write(self):
+        async def ping_after_write_starts():
+            await asyncio.sleep(0.05)
+            start = time.perf_counter()
+            result = await self.dispatcher.dispatch({'command': 'ping', 'arguments': {}})
+            return result, time.perf_counter() - start
+
+        write, (ping, elapsed) = run(self.dispatcher.dispatch({'command': 'run_all', 'arguments': {}}),
+                                     ping_after_write_starts())
+
+        self.assertEqual(write, 'run_all')
+        self.assertEqual(ping, 'ping')
+        self.assertLess(elapsed, 0.1)
+
+    def test_reads_wait_for_write_in_progress(self):
+        async def read_after_write_starts():
+            await asyncio.sleep(0.05)
+            return await self.dispatcher.dispatch({'command': 'get_var', 'arguments': {}})
+
+        run(self.dispatcher.dispatch({'command': 'run_all', 'arguments': {}}), read_after_write_starts())
+
+        self.assertEqual([c[0] for c in self.interface.calls], ['run_all', 'get_var'])
+
+    def test_latency_is_recorded_per_class(self):
+        run(self.dispatcher.dispatch({'command': 'get_var', 'arguments': {}}))
+        run(self.dispatcher.dispatch({'command': 'run', 'arguments': {}}))
+
+        report = self.dispatcher.latency.percentiles()
+
+        self.assertEqual(report[READ]['count'], 1)
+        self.assertEqual(report[WRITE]['count'], 1)
+        self.assertNotIn(OTHER, report)
+
+
+class TestLatencyTracker(TestCase):
+    def test_percentiles(self):
+        tracker = LatencyTracker()
+
+        for i in range(100):
+            tracker.record(READ, i / 1000)
+
+        report = tracker.percentiles()[READ]
+
+        self.assertEqual(report['count'], 100)
+        self.assertAlmostEqual(report['p50'], 50)
+        self.assertAlmostEqual(report['p90'], 90)
+        self.assertAlmostEqual(report['p99'], 99)
+
+    def test_only_keeps_recent_samples(self):
+        tracker = LatencyTracker(size=10)
+
+        for i in range(100):
+            tracker.record(WRITE, 1)
+
+        self.assertEqual(tracker.percentiles()[WRITE]['count'], 10)
+
+
+class TestReadWriteLock(TestCase):
+    def test_readers_share_lock(self):
+        lock = ReadWriteLock()
+
+        with lock.read():
+            with lock.read():
+                self.assertEqual(lock.readers, 2)
+
+        self.assertEqual(lock.readers, 0)
+
+    def test_writer_excludes_readers(self):
+        lock = ReadWriteLock()
+        order = []
+
+        def reader():
+            with lock.read():
+                order.append('read')
+
+        with lock.write():
+            t = threading.Thread(target=reader)
+            t.start()
+            time.sleep(0.05)
+            order.append('write')
+
+        t.join()
+
+        self.assertEqual(order, ['write', 'read'])
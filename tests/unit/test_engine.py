@@ -5,10 +5,20 @@ from contractdb.engine import Engine
 from contractdb.driver import ContractDBDriver
 from contractdb.utils import make_tx
 from contracting.db.encoder import encode
+from contracting.compilation.compiler import ContractingCompiler
 import ecdsa
 import hashlib
 driver = ContractDBDriver()
 
+COUNTER = ContractingCompiler().parse_to_code('''
+count = Variable()
+
+@export
+def inc():
+    count.set((count.get() or 0) + 1)
+    return count.get()
+''')
+
 
 class TestEngine(TestCase):
     def tearDown(self):
@@ -343,4 +353,240 @@ def get_owner():
 
         output = e.run(tx)
 
-        self.assertEqual(output['status'], 3)
\ No newline at end of file
+        self.assertEqual(output['status'], 3)
+
+    def test_verify_tx_signatures_returns_result_per_tx(self):
+        nakey = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+
+        good = make_tx(nakey, contract='string', func='string', arguments={'string': 123})
+        bad = make_tx(nakey, contract='string', func='string', arguments={'string': 123})
+        bad['signature'] = 'a' * 128
+
+        e = Engine()
+
+        self.assertEqual(e.verify_tx_signatures([good, bad, good]), [True, False, True])
+
+    def test_verify_tx_signatures_in_pool_matches_in_process(self):
+        nakey = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+
+        txs = [make_tx(nakey, contract='string', func='string', arguments={'i': i}) for i in range(100)]
+        txs[10]['signature'] = 'a' * 128
+        txs[50]['sender'] = 'not hex'
+
+        e = Engine(verify_workers=2)
+        pooled = e.verify_tx_signatures(txs)
+        e.shutdown()
+
+        serial = Engine(verify_workers=None).verify_tx_signatures(txs)
+
+        self.assertEqual(pooled, serial)
+        self.assertFalse(pooled[10])
+        self.assertFalse(pooled[50])
+        self.assertEqual(pooled.count(True), 98)
+
+    def test_engine_skips_signature_check_if_already_verified(self):
+        nakey = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+
+        tx = make_tx(nakey, contract='string', func='string', arguments={'string': 123})
+        tx['signature'] = 'a' * 128
+
+        e = Engine()
+
+        output = e.run(tx, signature_verified=True)
+        self.assertNotEqual(output['status'], 2)
+
+        output = e.run(tx, signature_verified=False)
+        self.assertEqual(output['status'], 2)
+
+    def test_verifying_keys_are_cached_per_sender(self):
+        nakey = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+        other = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+
+        e = Engine()
+
+        for i in range(5):
+            tx = make_tx(nakey, contract='string', func='string', arguments={'i': i})
+            self.assertTrue(e.verify_tx_signature(tx))
+
+        tx = make_tx(other, contract='string', func='string', arguments={})
+        self.assertTrue(e.verify_tx_signature(tx))
+
+        self.assertEqual(e.key_cache.stats(), {'size': 2, 'hits': 4, 'misses': 2})
+
+    def test_verifying_key_cache_evicts_least_recently_used(self):
+        keys = [ecdsa.SigningKey.generate(curve=ecdsa.NIST256p) for _ in range(3)]
+        senders = [k.get_verifying_key().to_string().hex() for k in keys]
+
+        e = Engine(key_cache_size=2)
+
+        e.key_cache.get(senders[0])
+        e.key_cache.get(senders[1])
+        e.key_cache.get(senders[0])
+        e.key_cache.get(senders[2])
+
+        self.assertIn(senders[0], e.key_cache)
+        self.assertNotIn(senders[1], e.key_cache)
+        self.assertIn(senders[2], e.key_cache)
+
+    def test_contract_modules_and_owners_are_cached_between_runs(self):
+        driver.flush()
+        driver.set_contract('counter', COUNTER, owner='stu')
+        driver.clear_sets()
+
+        e = Engine(driver=driver)
+        tx = {'sender': 'x', 'signature': 'x', 'payload': {'contract': 'counter', 'function': 'inc', 'arguments': {}}}
+
+        self.assertEqual(e.run(tx, signature_verified=True)['result'], 1)
+        module = e.modules['counter']
+
+        self.assertEqual(e.run(tx, signature_verified=True)['result'], 2)
+        self.assertIs(e.modules['counter'], module)
+        self.assertEqual(e.owners, {'counter': 'stu'})
+
+    def test_cached_modules_and_their_imports_see_the_current_environment(self):
+        clock = ContractingCompiler(module_name='clock').parse_to_code('''
+@export
+def read():
+    return now
+''')
+
+        reader = ContractingCompiler(module_name='reader').parse_to_code('''
+import clock
+
+@export
+def read():
+    return clock.read()
+''')
+
+        driver.flush()
+        driver.set_contract('clock', clock)
+        driver.set_contract('reader', reader)
+        driver.clear_sets()
+
+        e = Engine(driver=driver)
+        tx = {'sender': 'x', 'signature': 'x', 'payload': {'contract': 'reader', 'function': 'read', 'arguments': {}}}
+
+        results = [e.run(tx, environment={'now': i}, signature_verified=True)['result'] for i in range(3)]
+        self.assertEqual(results, [0, 1, 2])
+
+        # now isn't left over from the last transaction
+        self.assertEqual(e.run(tx, signature_verified=True)['status'], 3)
+
+    def test_writing_contract_code_invalidates_cache(self):
+        driver.flush()
+        driver.set_contract('counter', COUNTER, owner='stu')
+        driver.clear_sets()
+
+        e = Engine(driver=driver)
+        tx = {'sender': 'x', 'signature': 'x', 'payload': {'contract': 'counter', 'function': 'inc', 'arguments': {}}}
+        e.run(tx, signature_verified=True)
+
+        e.invalidate_written({'counter.__code__': '""', 'other.x': '1'})
+
+        self.assertEqual(e.modules, {})
+        self.assertEqual(e.owners, {})
+
+    def test_modules_are_dropped_when_driver_changes(self):
+        driver.flush()
+        driver.set_contract('counter', COUNTER, owner='stu')
+        driver.clear_sets()
+
+        e = Engine(driver=driver)
+        e.preload(['counter'])
+
+        e.driver = ContractDBDriver()
+        e.get_module('counter')
+
+        self.assertEqual(list(e.modules.keys()), ['counter'])
+        self.assertIs(e.modules_driver, e.driver)
+
+    def test_owners_are_dropped_when_driver_changes(self):
+        driver.flush()
+        driver.set_contract('counter', COUNTER, owner='stu')
+        driver.clear_sets()
+
+        e = Engine(driver=driver)
+        e.get_owner('counter')
+
+        other = ContractDBDriver()
+        other.flush()
+        other.set_contract('counter', COUNTER, owner='raghu')
+        other.clear_sets()
+
+        e.driver = other
+
+        self.assertEqual(e.get_owner('counter'), 'raghu')
+
+    def test_cached_owner_is_recorded_as_read_by_speculative_driver(self):
+        driver.flush()
+        driver.set_contract('counter', COUNTER, owner='stu')
+        driver.clear_sets()
+
+        e = Engine(driver=driver)
+        driver.speculative = True
+
+        try:
+            e.get_owner('counter')
+            driver.read_keys = set()
+
+            self.assertEqual(e.get_owner('counter'), 'stu')
+            self.assertEqual(driver.read_keys, {'counter.__owner__'})
+        finally:
+            driver.speculative = False
+            driver.read_keys = set()
+
+    def test_preload_imports_contracts_and_skips_missing(self):
+        driver.flush()
+        driver.set_contract('counter', COUNTER, owner='stu')
+        driver.clear_sets()
+
+        e = Engine(driver=driver)
+        e.preload(['counter', 'doesnt_exist'])
+
+        self.assertEqual(list(e.modules.keys()), ['counter'])
+
+    def test_timings_record_phases_and_functions_when_enabled(self):
+        driver.flush()
+        driver.set_contract('counter', COUNTER, owner='stu')
+        driver.clear_sets()
+
+        e = Engine(driver=driver)
+        tx = {'sender': 'x', 'signature': 'x', 'payload': {'contract': 'counter', 'function': 'inc', 'arguments': {}}}
+
+        e.run(tx, signature_verified=True)
+        self.assertEqual(e.timings.report()['phases'], {})
+
+        e.timings.enabled = True
+        e.run(tx, signature_verified=True)
+        e.run(tx, signature_verified=True)
+
+        report = e.timings.report()
+
+        self.assertEqual(list(report['phases'].keys()), ['structure', 'signature', 'environment', 'owner', 'import',
+                                                         'call', 'sets', 'clean_up'])
+        self.assertTrue(all(p['count'] == 2 for p in report['phases'].values()))
+        self.assertEqual(report['functions']['counter.inc']['count'], 2)
+
+    def test_timings_skip_function_for_rejected_tx(self):
+        e = Engine(driver=driver, timings_enabled=True)
+
+        e.run({'sender': 'x'})
+
+        report = e.timings.report()
+        self.assertEqual(report['phases']['structure']['count'], 1)
+        self.assertEqual(report['functions'], {})
+
+    def test_timings_skip_function_that_doesnt_exist(self):
+        driver.flush()
+        driver.set_contract('counter', COUNTER, owner='stu')
+        driver.clear_sets()
+
+        e = Engine(driver=driver, timings_enabled=True)
+
+        for name in ('nope', 'missing', 'inc'):
+            payload = {'contract': 'counter', 'function': name, 'arguments': {}}
+            e.run({'sender': 'x', 'signature': 'x', 'payload': payload}, signature_verified=True)
+
+        report = e.timings.report()
+        self.assertEqual(report['phases']['call']['count'], 3)
+        self.assertEqual(list(report['functions'].keys()), ['counter.inc'])
@@ -0,0 +1,69 @@
+from unittest import TestCase
+from contractdb.requestlog import RequestLog, Truncated
+
+
+class TestTruncated(TestCase):
+    def test_short_payload_is_unchanged(self):
+        self.assertEqual(str(Truncated(b'hello')), 'hello')
+        self.assertEqual(str(Truncated('hello')), 'hello')
+
+    def test_long_payload_is_cut_off(self):
+        self.assertEqual(str(Truncated('a' * 100, limit=10)), 'a' * 10 + '...')
+        self.assertEqual(str(Truncated(b'a' * 100, limit=10)), 'a' * 10 + '...')
+
+    def test_large_containers_are_bounded(self):
+        block = {'transactions': [{'payload': {'arguments': {'x': 'y' * 1000}}} for _ in range(10000)]}
+
+        self.assertLessEqual(len(str(Truncated(block, limit=100))), 103)
+
+    def test_nothing_is_formatted_until_str(self):
+        class Exploding:
+            def __repr__(self):
+                raise AssertionError('formatted')
+
+        Truncated(Exploding())
+
+
+class TestRequestLog(TestCase):
+    def test_records_at_full_rate(self):
+        log = RequestLog(default_rate=1)
+
+        log.record('ping', {'command': 'ping'}, 10, 0.002)
+
+        recent = log.recent()
+
+        self.assertEqual(recent['seen'], 1)
+        self.assertEqual(recent['sampled'], 1)
+        self.assertEqual(recent['requests'][0]['command'], 'ping')
+        self.assertEqual(recent['requests'][0]['bytes'], 10)
+        self.assertAlmostEqual(recent['requests'][0]['ms'], 2)
+
+    def test_per_command_rates(self):
+        log = RequestLog(sample_rates={'run': 1, 'get_var': 0}, default_rate=0)
+
+        for _ in range(10):
+            log.record('get_var', {}, 1)
+            log.record('ping', {}, 1)
+        log.record('run', {}, 1)
+
+        recent = log.recent()
+
+        self.assertEqual(recent['seen'], 21)
+        self.assertEqual([r['command'] for r in recent['requests']], ['run'])
+
+    def test_ring_buffer_keeps_most_recent(self):
+        log = RequestLog(size=3, default_rate=1)
+
+        for i in range(5):
+            log.record('c{}'.format(i), {}, 1)
+
+        self.assertEqual([r['command'] for r in log.recent()['requests']], ['c2', 'c3', 'c4'])
+        self.assertEqual([r['command'] for r in log.recent(limit=1)['requests']], ['c4'])
+        self.assertEqual(log.recent(limit=0)['requests'], [])
+
+    def test_payload_is_capped(self):
+        log = RequestLog(default_rate=1, max_payload=8)
+
+        log.record('run', 'x' * 100, 100)
+
+        self.assertEqual(log.recent()['requests'][0]['payload'], 'x' * 8 + '...')
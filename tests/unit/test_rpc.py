@@ -7,6 +7,7 @@ from contracting.compilation.compiler import ContractingCompiler
 from contractdb.driver import ContractDBDriver
 from contractdb.chain import SQLLiteBlockStorageDriver
 from contractdb.utils import make_tx
+from contractdb import utils
 import json
 import ecdsa
 import hashlib
@@ -156,6 +157,101 @@ def stu():
     def test_get_var_multihash_that_doesnt_exist(self):
         pass
 
+    def test_get_vars_bulk_returns_values_in_order(self):
+        self.rpc.driver.set_contract('bank', 'balances = Hash()\n')
+
+        for i in range(0, 100, 2):
+            self.rpc.driver.set('bank.balances:acct{}'.format(i), i)
+        self.rpc.driver.commit()
+
+        keys = ['acct{}'.format(i) for i in range(100)]
+
+        response = self.rpc.get_vars_bulk('bank', 'balances', keys)
+
+        expected = [i if i % 2 == 0 else {'status': 2} for i in range(100)]
+
+        self.assertEqual(response, expected)
+
+    def test_get_vars_bulk_multihash_keys(self):
+        self.rpc.driver.set_contract('bank', 'allowances = Hash()\n')
+
+        self.rpc.driver.set('bank.allowances:a:b', 5)
+        self.rpc.driver.commit()
+
+        response = self.rpc.get_vars_bulk('bank', 'allowances', [['a', 'b'], ['b', 'a']])
+
+        self.assertEqual(response, [5, {'status': 2}])
+
+    def test_get_vars_bulk_no_contract(self):
+        response = self.rpc.get_vars_bulk('nope', 'balances', ['a'])
+
+        self.assertEqual(response, {'status': 1})
+
+    def test_get_vars_bulk_reads_cached_writes(self):
+        self.rpc.driver.set_contract('bank', 'balances = Hash()\n')
+
+        self.rpc.driver.set('bank.balances:a', 1)
+
+        response = self.rpc.get_vars_bulk('bank', 'balances', ['a', 'a'])
+
+        self.assertEqual(response, [1, 1])
+
+    def test_iter_var_pages_through_hash(self):
+        self.rpc.driver.set_contract('bank', 'balances = Hash()\n')
+
+        for i in range(25):
+            self.rpc.driver.set('bank.balances:acct{:02}'.format(i), i)
+        self.rpc.driver.commit()
+
+        # Another variable sharing the prefix must not show up
+        self.rpc.driver.set('bank.balances_old:acct00', 0)
+        self.rpc.driver.commit()
+
+        items = {}
+        start_after = None
+        pages = 0
+
+        while True:
+            page = self.rpc.iter_var('bank', 'balances', start_after=start_after, limit=10)
+            items.update(page['items'])
+            pages += 1
+
+            start_after = page['next']
+            if start_after is None:
+                break
+
+        self.assertEqual(items, {'acct{:02}'.format(i): i for i in range(25)})
+        self.assertEqual(pages, 3)
+
+    def test_iter_var_filters_prefix_and_merges_cache(self):
+        self.rpc.driver.set_contract('bank', 'allowances = Hash()\n')
+
+        self.rpc.driver.set('bank.allowances:a:x', 1)
+        self.rpc.driver.set('bank.allowances:a:y', 2)
+        self.rpc.driver.set('bank.allowances:b:x', 3)
+        self.rpc.driver.commit()
+
+        # Uncommitted write and delete
+        self.rpc.driver.set('bank.allowances:a:z', 4)
+        self.rpc.driver.set('bank.allowances:a:x', None)
+
+        page = self.rpc.iter_var('bank', 'allowances', prefix='a:')
+
+        self.assertEqual(page, {'items': {'a:y': 2, 'a:z': 4}, 'next': None})
+
+    def test_iter_var_with_no_limit_still_moves_forward(self):
+        self.rpc.driver.set_contract('bank', 'balances = Hash()\n')
+
+        self.rpc.driver.set('bank.balances:a', 1)
+        self.rpc.driver.set('bank.balances:b', 2)
+        self.rpc.driver.commit()
+
+        for limit in (0, -5):
+            self.assertEqual(self.rpc.iter_var('bank', 'balances', limit=limit), {'items': {'a': 1}, 'next': 'a'})
+
+    def test_iter_var_no_contract(self):
+        self.assertEqual(self.rpc.iter_var('nope', 'balances'), {'status': 1})
+
     def test_get_vars_returns_correctly(self):
         expected = ['xrate', 'seed_amount', 'balances', 'allowed']
 
@@ -163,6 +259,42 @@ def stu():
 
         self.assertEqual(response, expected)
 
+    def test_contract_metadata_is_filled_on_set_contract(self):
+        self.rpc.driver.set_contract('bank', 'balances = Hash()\ndef pay(to, amount):\n    pass\n', owner='stu')
+
+        self.assertEqual(self.rpc.get_vars('bank'), ['balances'])
+        self.assertEqual(self.rpc.get_methods('bank'), [{'name': 'pay', 'arguments': ['to', 'amount']}])
+        self.assertEqual(self.rpc.metadata.get('bank')['owner'], 'stu')
+
+        self.assertEqual(self.rpc.metadata.misses, 0)
+        self.assertEqual(self.rpc.metadata.hits, 3)
+
+    def test_contract_metadata_is_rebuilt_when_code_changes(self):
+        self.rpc.driver.set_contract('bank', 'balances = Hash()\n')
+
+        self.assertEqual(self.rpc.get_vars('bank'), ['balances'])
+
+        # Change the code behind the cache's back
+        self.rpc.driver.set(self.rpc.driver.make_key('bank', '__code__'), 'owner = Variable()\n')
+
+        self.assertEqual(self.rpc.get_vars('bank'), ['owner'])
+        self.assertEqual(self.rpc.metadata.misses, 1)
+
+    def test_stats_switches_engine_timings(self):
+        stats = self.rpc.process_json_rpc_command({'command': 'stats', 'arguments': {'enabled': True}})
+
+        self.assertTrue(stats['engine']['enabled'])
+        self.assertTrue(self.rpc.engine.timings.enabled)
+        self.assertIn('hits', stats['key_cache'])
+        self.assertIn('hits', stats['metadata_cache'])
+
+        self.rpc.engine.run({'sender': 'x'})
+        self.assertEqual(self.rpc.stats()['engine']['phases']['structure']['count'], 1)
+
+        stats = self.rpc.stats(enabled=False, reset=True)
+        self.assertFalse(stats['engine']['enabled'])
+        self.assertEqual(stats['engine']['phases'], {})
+
     def test_get_vars_on_contract_doesnt_exist(self):
         response = self.rpc.get_vars('xxx')
 
@@ -262,6 +394,54 @@ def get_owner():
         self.assertEqual(owner, json.dumps(pk))
         self.assertEqual(accessed_owner, pk)
 
+    def test_run_all_parallel_matches_serial(self):
+        self.rpc.driver.flush()
+
+        with open('../../contractdb/contracts/submission.s.py') as f:
+            submission = f.read()
+
+        contract = '''
+owner = Variable()
+
+@construct
+def seed():
+    owner.set(ctx.caller)
+
+@export
+def get_owner():
+    return owner.get()
+                '''
+
+        nakey = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+        pk = nakey.get_verifying_key().to_string().hex()
+
+        txs = [make_tx(nakey,
+                       contract='submission',
+                       func='submit_contract',
+                       arguments={
+                           'code': contract,
+                           'name': 'stu_bucks'
+                       })]
+
+        txs.extend([make_tx(nakey, contract='stu_bucks', func='get_owner') for _ in range(99)])
+
+        from copy import deepcopy
+
+        self.rpc.driver.set_contract(name='submission', code=submission)
+        serial = self.rpc.run_all(deepcopy(txs))
+
+        self.rpc.driver.flush()
+
+        parallel_rpc = rpc.StateInterface(driver=ContractDBDriver(), engine=Engine(),
+                                          compiler=ContractingCompiler(), parallel=True)
+
+        parallel_rpc.driver.set_contract(name='submission', code=submission)
+        parallel = parallel_rpc.run_all(deepcopy(txs))
+        parallel_rpc.parallel.shutdown()
+
+        self.assertEqual(serial, parallel)
+        self.assertEqual(parallel[99]['output']['result'], pk)
+
     def test_lint_code(self):
         code = '''
 @export
@@ -345,6 +525,79 @@ def stu():
 
         self.assertIsNone(rpc_result)
 
+    def test_batch_returns_results_in_order(self):
+        contract = '''
+def stu():
+    print('howdy partner')
+'''
+
+        self.rpc.driver.set_contract('stustu', contract)
+
+        command = {'command': 'batch',
+                   'arguments': {
+                       'commands': [
+                           {'command': 'get_contract', 'arguments': {'name': 'stustu'}},
+                           {'command': 'ping', 'arguments': {}},
+                           {'command': 'get_contract', 'arguments': {'name': 'nope'}},
+                           {'command': 'get_stu', 'arguments': {}},
+                           {'command': 'batch', 'arguments': {'commands': []}},
+                           {'command': 'get_contract', 'arguments': {'name': 'stustu'}},
+                       ]
+                   }}
+
+        rpc_result = self.rpc.process_json_rpc_command(command)
+
+        self.assertEqual(rpc_result, [contract, {'result': 'ok'}, {'status': 1}, None, None, contract])
+
+    def test_batch_evaluates_identical_reads_once(self):
+        self.rpc.driver.set_contract('stustu', 'def stu():\n    return 1\n')
+
+        calls = []
+        get_contract = self.rpc.command_map['get_contract']
+
+        def counted(**kwargs):
+            calls.append(kwargs)
+            return get_contract(**kwargs)
+
+        self.rpc.command_map['get_contract'] = counted
+
+        read = {'command': 'get_contract', 'arguments': {'name': 'stustu'}}
+
+        rpc_result = self.rpc.batch([read] * 10)
+
+        self.assertEqual(len(rpc_result), 10)
+        self.assertEqual(len(calls), 1)
+
+    def test_batch_reads_each_variable_in_one_pass(self):
+        self.rpc.driver.set_contract('stustu', 'def stu():\n    return 1\n')
+        self.rpc.driver.set('stustu.balances:a', 1)
+        self.rpc.driver.set('stustu.balances:b', 2)
+        self.rpc.driver.set('stustu.owner', 'stu')
+        self.rpc.driver.commit()
+
+        passes = []
+        get_many = self.rpc.driver.get_many
+
+        def counted(keys):
+            passes.append(keys)
+            return get_many(keys)
+
+        self.rpc.driver.get_many = counted
+
+        def get_var(variable, key=None):
+            return {'command': 'get_var', 'arguments': {'contract': 'stustu', 'variable': variable, 'key': key}}
+
+        rpc_result = self.rpc.batch([
+            get_var('balances', 'a'),
+            get_var('owner'),
+            {'command': 'get_var', 'arguments': {'contract': 'nope', 'variable': 'balances', 'key': 'a'}},
+            get_var('balances', 'c'),
+            get_var('balances', ['b']),
+        ])
+
+        self.assertEqual(rpc_result, [1, 'stu', {'status': 1}, {'status': 2}, 2])
+        self.assertEqual(sorted(len(keys) for keys in passes), [1, 3])
+
 
 class TestRPCBlockDriver(TestCase):
     def setUp(self):
@@ -371,6 +624,44 @@ class TestRPCBlockDriver(TestCase):
     def test_init(self):
         self.assertTrue(self.rpc.blocks_enabled)
 
+    def test_get_blocks_pages_through_chain(self):
+        for i in range(5):
+            self.rpc.blocks.insert_block({
+                'hash': 'block{}'.format(i),
+                'index': i,
+                'transactions': []
+            })
+
+        page = self.rpc.process_json_rpc_command({'command': 'get_blocks',
+                                                  'arguments': {'start': 0, 'limit': 2}})
+
+        self.assertEqual([b['index'] for b in page['blocks']], [0, 1])
+        self.assertEqual(page['next'], 2)
+
+        page = self.rpc.get_blocks(start=page['next'], limit=2)
+
+        self.assertEqual([b['index'] for b in page['blocks']], [2, 3])
+        self.assertEqual(page['next'], 4)
+
+        page = self.rpc.get_blocks(start=page['next'], limit=2)
+
+        self.assertEqual([b['index'] for b in page['blocks']], [4])
+        self.assertIsNone(page['next'])
+
+    def test_get_blocks_with_no_limit_still_moves_forward(self):
+        for i in range(2):
+            self.rpc.blocks.insert_block({
+                'hash': 'block{}'.format(i),
+                'index': i,
+                'transactions': []
+            })
+
+        for limit in (0, -5):
+            page = self.rpc.get_blocks(start=0, limit=limit)
+
+            self.assertEqual([b['index'] for b in page['blocks']], [0])
+            self.assertEqual(page['next'], 1)
+
     def test_run_works_same_as_blocks_not_stored(self):
         self.rpc.driver.flush()
 
@@ -511,3 +802,140 @@ def get_owner():
         got_block = self.rpc.blocks.get_block_by_index(self.rpc.blocks.height())
 
         self.assertDictEqual(block, got_block)
+
+    def test_run_all_block_proves_each_tx(self):
+        self.rpc.driver.flush()
+
+        nakey = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+
+        txs = [make_tx(nakey, contract='stu_bucks', func='get_owner', arguments={'i': i}) for i in range(5)]
+
+        block = self.rpc.run_all(txs)
+
+        self.assertEqual(block['merkle_root'], utils.merkle_root([tx['hash'] for tx in block['transactions']]))
+
+        for tx in block['transactions']:
+            proof = self.rpc.process_json_rpc_command({'command': 'get_tx_proof',
+                                                       'arguments': {'tx_hash': tx['hash']}})
+
+            self.assertEqual(proof['block_hash'], block['hash'])
+            self.assertTrue(utils.verify_tx_proof(tx['hash'], proof['proof'], block['merkle_root']))
+
+    def test_run_all_block_stores_state_root(self):
+        nakey = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+
+        txs = [make_tx(nakey, contract='stu_bucks', func='get_owner', arguments={'i': i}) for i in range(3)]
+
+        block = self.rpc.run_all(txs)
+
+        node = self.rpc.process_json_rpc_command({'command': 'state_root', 'arguments': {}})
+
+        self.assertEqual(block['state_root'], node['hash'])
+        self.assertEqual(self.rpc.blocks.get_block_by_index(block['index'])['state_root'], block['state_root'])
+
+        left = self.rpc.state_root(depth=1, index=0)
+        self.assertEqual(left['hash'], node['children'][0])
+
+    def test_rebuilt_state_matches_live_state(self):
+        counter = ContractingCompiler(module_name='counter').parse_to_code('''
+counts = Hash()
+total = Variable()
+
+@export
+def add(key: str, amount: int):
+    counts[key] = (counts[key] or 0) + amount
+    total.set((total.get() or 0) + amount)
+''')
+
+        def genesis(driver):
+            driver.flush()
+            driver.set_contract(name='counter', code=counter)
+            driver.clear_sets()
+
+        genesis(self.rpc.driver)
+
+        nakey = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+
+        for b in range(3):
+            self.rpc.run_all([make_tx(nakey, contract='counter', func='add', arguments={'key': k, 'amount': b + 1})
+                              for k in ('a', 'b')])
+
+        self.rpc.driver.commit()
+
+        keys = ['counter.counts:a', 'counter.counts:b', 'counter.total']
+        live = [self.rpc.driver.get(k) for k in keys]
+        root = self.rpc.driver.state_root()
+
+        self.assertEqual(live, [6, 6, 12])
+        self.assertEqual(self.rpc.blocks.get_block_by_index(2)['state_root'], root)
+
+        rebuilt = ContractDBDriver()
+        genesis(rebuilt)
+
+        self.rpc.blocks.rebuild_state(rebuilt)
+
+        self.assertEqual([rebuilt.get(k) for k in keys], live)
+        self.assertEqual(rebuilt.state_root(), root)
+
+    def test_block_height_and_hash_are_not_tx_updates(self):
+        nakey = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+
+        self.rpc.run_all([make_tx(nakey, contract='stu_bucks', func='get_owner', arguments={'i': 0})])
+        block = self.rpc.run_all([make_tx(nakey, contract='stu_bucks', func='get_owner', arguments={'i': 1})])
+
+        self.assertEqual(block['transactions'][0]['output']['updates'], {})
+        self.assertEqual(self.rpc.driver.height, block['index'])
+        self.assertEqual(self.rpc.driver.latest_hash, block['hash'])
+
+    def test_run_all_parallel_speculation_matches_serial(self):
+        from contractdb.parallel import MIN_PARALLEL_BATCH
+        from copy import deepcopy
+        import tempfile
+        import os
+
+        with open('./test_sys_contracts/currency.s.py') as f:
+            currency = ContractingCompiler(module_name='currency').parse_to_code(f.read(), lint=False)
+
+        keys = [ecdsa.SigningKey.generate(curve=ecdsa.NIST256p) for _ in range(MIN_PARALLEL_BATCH)]
+        senders = [k.get_verifying_key().to_string().hex() for k in keys]
+
+        # Every fourth transfer goes to the same account, so it reads a balance an earlier one wrote. The rest touch
+        # disjoint balances.
+        recipients = ['hub' if i % 4 == 0 else 'r{}'.format(i) for i in range(len(keys))]
+        txs = [make_tx(k, contract='currency', func='transfer', arguments={'to': to, 'amount': 1})
+               for k, to in zip(keys, recipients)]
+
+        directory = tempfile.TemporaryDirectory()
+
+        # Several blocks in a row, so that whatever one block leaves behind shows up in the next
+        def execute(parallel):
+            driver = ContractDBDriver()
+            driver.flush()
+            driver.set_contract(name='currency', code=currency)
+            driver.clear_sets()
+            driver.set_many({'currency.balances:{}'.format(a): 100 for a in senders + recipients})
+
+            blocks = SQLLiteBlockStorageDriver(filename=os.path.join(directory.name, '{}.db'.format(parallel)))
+
+            interface = rpc.StateInterface(driver=driver, engine=Engine(verify_workers=None),
+                                           compiler=ContractingCompiler(), blocks=blocks, parallel=parallel)
+
+            # Speculate even on a single core machine
+            if parallel:
+                interface.parallel.workers = 2
+
+            return interface, [interface.run_all(deepcopy(txs)) for _ in range(3)]
+
+        _, serial = execute(False)
+        parallel_rpc, parallel = execute(True)
+        parallel_rpc.parallel.shutdown()
+        directory.cleanup()
+
+        for s, p in zip(serial, parallel):
+            self.assertTrue(all(tx['output']['status'] == 0 for tx in s['transactions']))
+            self.assertEqual(s['transactions'], p['transactions'])
+            self.assertEqual(s['state_root'], p['state_root'])
+            self.assertEqual(s['hash'], p['hash'])
+
+        self.assertGreater(parallel_rpc.parallel.accepted, 0)
+        self.assertGreater(parallel_rpc.parallel.reexecuted, 0)
@@ -1,5 +1,9 @@
 from unittest import TestCase
-from contractdb.server import Server
+from contractdb.server import Server, ReplicatedServer
+from contractdb.replicas import Replica, StaleReplicaError
+from contractdb.driver import ContractDBDriver
+from contractdb import wire
+import tempfile
 import asyncio
 import zmq
 import json
@@ -26,6 +30,17 @@ async def get(msg, ctx, _json=True):
     return res
 
 
+async def get_framed(msg, ctx, fmt):
+    socket = ctx.socket(zmq.DEALER)
+    socket.connect('tcp://127.0.0.1:2020')
+
+    await socket.send_multipart([fmt, wire.pack(msg, fmt)])
+
+    header, res = await socket.recv_multipart()
+
+    return header, wire.unpack(res, header)
+
+
 class TestServer(TestCase):
     def setUp(self):
         self.ctx = zmq.asyncio.Context()
@@ -110,3 +125,212 @@ def stu():
         res = loop.run_until_complete(tasks)[1]
 
         self.assertIsNone(res)
+
+    def test_msgpack_header_gets_msgpack_reply(self):
+        m = Server(port=2020, ctx=self.ctx)
+
+        m.interface.driver.set_contract('stustu', 'def stu():\n    return 1\n')
+
+        command = {'command': 'get_contract',
+                   'arguments': {
+                       'name': 'stustu'
+                   }}
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get_framed(command, self.ctx, wire.MSGPACK),
+            stop_server(m, 0.2),
+        )
+
+        loop = asyncio.get_event_loop()
+        header, res = loop.run_until_complete(tasks)[1]
+
+        self.assertEqual(header, wire.MSGPACK)
+        self.assertEqual(res, m.interface.get_contract('stustu'))
+
+    def test_result_that_cannot_be_packed_gets_none_reply(self):
+        m = Server(port=2020, ctx=self.ctx)
+        m.interface.command_map['opaque'] = lambda: object()
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get_framed({'command': 'opaque', 'arguments': {}}, self.ctx, wire.MSGPACK),
+            stop_server(m, 0.2),
+        )
+
+        loop = asyncio.get_event_loop()
+        header, res = loop.run_until_complete(tasks)[1]
+
+        self.assertEqual(header, wire.MSGPACK)
+        self.assertIsNone(res)
+
+    def test_unknown_header_falls_back_to_json(self):
+        m = Server(port=2020, ctx=self.ctx)
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get_framed({'command': 'ping', 'arguments': {}}, self.ctx, b'cbor'),
+            stop_server(m, 0.2),
+        )
+
+        loop = asyncio.get_event_loop()
+        header, _ = loop.run_until_complete(tasks)[1]
+
+        self.assertEqual(header, wire.JSON)
+
+
+    def test_recent_requests_are_recorded(self):
+        m = Server(port=2020, ctx=self.ctx)
+        m.requests.default_rate = 1
+
+        async def requests():
+            await get({'command': 'ping', 'arguments': {}}, self.ctx)
+            return await get({'command': 'recent_requests', 'arguments': {}}, self.ctx)
+
+        tasks = asyncio.gather(
+            m.serve(),
+            requests(),
+            stop_server(m, 0.2),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)[1]
+
+        self.assertEqual(res['requests'][0]['command'], 'ping')
+        # The recent_requests call itself is recorded after it answers
+        self.assertEqual(res['seen'], 1)
+
+
+class TestReplicatedServer(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+
+    def tearDown(self):
+        self.ctx.destroy()
+
+    def test_reads_are_served_by_replicas(self):
+        m = ReplicatedServer(port=2020, ctx=self.ctx, replicas=2)
+
+        contract = '''
+def stu():
+    print('howdy partner')
+        '''
+
+        m.interface.driver.set_contract('stustu', contract)
+
+        command = {'command': 'get_contract',
+                   'arguments': {
+                       'name': 'stustu'
+                   }}
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(command, self.ctx),
+            get({'command': 'ping', 'arguments': {}}, self.ctx),
+            stop_server(m, 2),
+        )
+
+        loop = asyncio.get_event_loop()
+        res = loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], contract)
+        self.assertEqual(res[2], {'result': 'ok'})
+
+    def test_writes_commit_and_advance_height(self):
+        m = ReplicatedServer(port=2020, ctx=self.ctx, replicas=1)
+
+        m.interface.driver.height = 10
+        m.commit()
+
+        self.assertEqual(m.height, 10)
+
+    def test_commit_only_writes_the_latest_block(self):
+        m = ReplicatedServer(port=2020, ctx=self.ctx, replicas=1)
+        driver = m.interface.driver
+
+        driver.set('con.v:a', 1)
+        driver.height = 1
+        m.commit()
+
+        written = []
+        store_set = driver.driver.set
+
+        def recorded(k, v):
+            written.append(k)
+            store_set(k, v)
+
+        driver.driver.set = recorded
+
+        driver.set('con.v:b', 2)
+        driver.height = 2
+        m.commit()
+
+        driver.driver.set = store_set
+
+        self.assertEqual(driver.pending_writes, {})
+        self.assertNotIn('con.v:a', written)
+        self.assertEqual(written[0], 'con.v:b')
+        self.assertEqual(written[-1], driver.height_key)
+        self.assertEqual(m.height, 2)
+
+
+class TestReplica(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.replica = Replica(blocks_filename=self.directory.name + '/blocks.db', sync_timeout=0.05)
+
+        self.writer = ContractDBDriver()
+        self.writer.flush()
+
+    def tearDown(self):
+        self.writer.flush()
+        self.directory.cleanup()
+
+    def commit_height(self, height):
+        self.writer.height = height
+        self.writer.commit()
+
+    def test_sync_sees_state_committed_after_it_was_read(self):
+        self.commit_height(1)
+        self.replica.sync(1)
+
+        self.writer.set_contract('stustu', 'def stu():\n    pass\n')
+        self.commit_height(2)
+        self.replica.sync(2)
+
+        self.assertEqual(self.replica.driver.get_contract('stustu'), 'def stu():\n    pass\n')
+
+    def test_sync_keeps_the_same_interface(self):
+        interface = self.replica.interface
+
+        self.commit_height(1)
+        self.replica.sync(1)
+        self.commit_height(2)
+        self.replica.sync(2)
+
+        self.assertIs(self.replica.interface, interface)
+
+    def test_state_root_right_after_commit(self):
+        self.commit_height(1)
+        self.replica.sync(1)
+        self.assertEqual(self.replica.interface.state_root()['hash'], self.writer.state_root())
+
+        self.writer.set('con.v:a', 1)
+        self.commit_height(2)
+        self.replica.sync(2)
+
+        self.assertEqual(self.replica.interface.state_root(), {**self.writer.state_node(0, 0), 'height': 2})
+
+    def test_sync_raises_if_height_never_reached(self):
+        self.commit_height(1)
+
+        with self.assertRaises(StaleReplicaError):
+            self.replica.sync(2)
+
+        self.assertIsNone(self.replica.height)
+
+    def test_process_raises_if_stale(self):
+        msg = json.dumps({'command': 'ping', 'arguments': {}}).encode()
+
+        with self.assertRaises(StaleReplicaError):
+            self.replica.process(5, msg)
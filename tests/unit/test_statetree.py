@@ -0,0 +1,168 @@
+from unittest import TestCase
+from contractdb.statetree import StateTree, differing_buckets
+from contractdb.driver import ContractDBDriver, StateTreeMissingError, STATE_TREE_KEY, STATE_BUCKET_PREFIX
+
+
+class TestStateTree(TestCase):
+    def test_root_does_not_depend_on_write_order(self):
+        a, b = StateTree(depth=4), StateTree(depth=4)
+
+        for i in range(20):
+            a.update('k{}'.format(i), None, i)
+
+        for i in reversed(range(20)):
+            b.update('k{}'.format(i), None, 0)
+            b.update('k{}'.format(i), 0, i)
+
+        self.assertEqual(a.root(), b.root())
+
+    def test_removing_an_entry_restores_the_root(self):
+        tree = StateTree(depth=4)
+        empty = tree.root()
+
+        tree.update('a', None, 'x')
+        self.assertNotEqual(tree.root(), empty)
+
+        tree.update('a', 'x', None)
+        self.assertEqual(tree.root(), empty)
+
+    def test_rollback_restores_last_commit(self):
+        tree = StateTree(depth=4)
+        tree.update('a', None, 1)
+        tree.commit()
+        committed = tree.root()
+
+        tree.update('a', 1, 2)
+        tree.update('b', None, 3)
+        tree.rollback()
+
+        self.assertEqual(tree.root(), committed)
+
+    def test_differing_buckets_finds_changed_keys(self):
+        a, b = StateTree(depth=6), StateTree(depth=6)
+
+        for i in range(100):
+            a.update('k{}'.format(i), None, i)
+            b.update('k{}'.format(i), None, i)
+
+        b.update('k7', 7, 'changed')
+        b.update('new', None, 1)
+
+        calls = []
+
+        def remote(depth, index):
+            calls.append((depth, index))
+            return b.node(depth, index)
+
+        self.assertEqual(differing_buckets(a.node, remote), sorted({b.bucket('k7'), b.bucket('new')}))
+        self.assertLessEqual(len(calls), 2 * (b.depth + 1))
+
+    def test_lanes_wrap_around(self):
+        tree = StateTree(depth=0)
+        empty = tree.root()
+
+        # Enough entries that most lanes of the bucket go past 2 ** 16
+        for i in range(100):
+            tree.update('k{}'.format(i), None, i)
+
+        for i in range(100):
+            tree.update('k{}'.format(i), i, None)
+
+        self.assertEqual(tree.buckets, [0])
+        self.assertEqual(tree.root(), empty)
+
+    def test_node_out_of_range_is_none(self):
+        tree = StateTree(depth=2)
+
+        self.assertIsNone(tree.node(3, 0))
+        self.assertIsNone(tree.node(1, 2))
+        self.assertIsNone(tree.node(2, 0)['children'])
+
+
+class TestDriverStateRoot(TestCase):
+    def setUp(self):
+        self.driver = ContractDBDriver()
+        self.driver.flush()
+
+    def tearDown(self):
+        self.driver.flush()
+
+    def test_internal_keys_do_not_change_root(self):
+        root = self.driver.state_root()
+
+        self.driver.height = 10
+        self.driver.latest_hash = 'a' * 64
+
+        self.assertEqual(self.driver.state_root(), root)
+
+    def test_root_is_reloaded_from_backing_store(self):
+        self.driver.set('con.v:a', 1)
+        self.driver.set('con.v:b', 'x')
+        self.driver.commit()
+
+        root = self.driver.state_root()
+
+        other = ContractDBDriver()
+        self.assertEqual(other.driver.get(STATE_TREE_KEY), other.get_state_tree().layout)
+        self.assertEqual(other.state_root(), root)
+
+    def test_missing_tree_is_only_built_explicitly(self):
+        self.driver.set_many({'con.v:a': 1, 'con.v:b': 'x'})
+        root = self.driver.state_root()
+
+        self.driver.driver.delete(STATE_TREE_KEY)
+
+        with self.assertRaises(StateTreeMissingError):
+            ContractDBDriver().set('con.v:c', 2)
+
+        other = ContractDBDriver()
+        other.prepare_state_tree()
+        self.assertEqual(other.state_root(), root)
+
+        self.assertEqual(ContractDBDriver().state_root(), root)
+
+    def test_empty_store_starts_with_empty_tree(self):
+        self.assertEqual(self.driver.state_root(), StateTree().root())
+
+    def test_commit_writes_height_after_state_and_buckets(self):
+        self.driver.set('con.v:a', 1)
+        self.driver.commit()
+
+        written = []
+        store_set = self.driver.driver.set
+
+        def recorded(k, v):
+            written.append(k)
+            store_set(k, v)
+
+        self.driver.driver.set = recorded
+
+        self.driver.height = 5
+        self.driver.set('con.v:a', 2)
+        self.driver.commit()
+
+        self.driver.driver.set = store_set
+
+        self.assertEqual(written[0], 'con.v:a')
+        self.assertTrue(written[1].startswith(STATE_BUCKET_PREFIX))
+        self.assertEqual(written[-1], self.driver.height_key)
+
+    def test_clear_pending_state_rolls_root_back(self):
+        self.driver.set('con.v:a', 1)
+        self.driver.commit()
+        root = self.driver.state_root()
+
+        self.driver.set('con.v:a', 2)
+        self.assertNotEqual(self.driver.state_root(), root)
+
+        self.driver.clear_pending_state()
+        self.assertEqual(self.driver.state_root(), root)
+
+    def test_apply_sets_matches_set(self):
+        self.driver.set('con.v:a', 5)
+        root = self.driver.state_root()
+        self.driver.flush()
+
+        self.driver.apply_sets({'con.v:a': '5'})
+
+        self.assertEqual(self.driver.state_root(), root)
@@ -0,0 +1,67 @@
+from unittest import TestCase
+from contractdb.timing import Histogram, EngineTimings, NULL_TIMER, BUCKET_BOUNDS, MAX_FUNCTIONS, OTHER_FUNCTION
+
+
+class TestHistogram(TestCase):
+    def test_percentiles_are_bucket_upper_bounds(self):
+        h = Histogram()
+
+        for _ in range(98):
+            h.record(0.0000015)
+        h.record(0.003)
+        h.record(0.003)
+
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.percentile(0.5), BUCKET_BOUNDS[1])
+        self.assertEqual(h.percentile(0.99), BUCKET_BOUNDS[12])
+        self.assertAlmostEqual(h.summary()['max_ms'], 3)
+
+    def test_slow_samples_land_in_last_bucket(self):
+        h = Histogram()
+        h.record(1000)
+
+        self.assertEqual(h.counts[-1], 1)
+        self.assertEqual(h.percentile(0.5), 1000)
+        self.assertEqual(h.summary()['buckets'], [[None, 1]])
+
+    def test_empty_summary(self):
+        summary = Histogram().summary()
+
+        self.assertEqual(summary['count'], 0)
+        self.assertEqual(summary['p99_ms'], 0)
+        self.assertEqual(summary['buckets'], [])
+
+
+class TestEngineTimings(TestCase):
+    def test_disabled_gives_null_timer(self):
+        self.assertIs(EngineTimings().timer(), NULL_TIMER)
+
+    def test_timer_records_laps_and_function(self):
+        timings = EngineTimings(enabled=True)
+
+        timer = timings.timer()
+        timer.lap('structure')
+        timer.lap('call')
+        timer.finish('currency', 'transfer')
+
+        report = timings.report()
+
+        self.assertEqual(list(report['phases'].keys()), ['structure', 'call'])
+        self.assertEqual(report['functions']['currency.transfer']['count'], 1)
+
+        timings.reset()
+        self.assertEqual(timings.report()['phases'], {})
+
+    def test_functions_past_the_limit_are_counted_as_other(self):
+        timings = EngineTimings(enabled=True)
+
+        for i in range(MAX_FUNCTIONS + 5):
+            timings.record([], 'con.f{}'.format(i), 0.001)
+
+        timings.record([], 'con.f0', 0.001)
+
+        functions = timings.report()['functions']
+
+        self.assertEqual(len(functions), MAX_FUNCTIONS + 1)
+        self.assertEqual(functions[OTHER_FUNCTION]['count'], 5)
+        self.assertEqual(functions['con.f0']['count'], 2)
@@ -0,0 +1,124 @@
+from unittest import TestCase
+from contractdb import utils
+from contracting.db.encoder import encode
+import threading
+import decimal
+
+
+def make_io():
+    tx_input = {
+        'sender': 'stu',
+        'signature': 'ff',
+        'payload': {
+            'contract': 'currency',
+            'function': 'transfer',
+            'arguments': {'to': 'raghu', 'amount': decimal.Decimal('1.5')}
+        },
+        'index': 3
+    }
+
+    tx_output = {
+        'status': 0,
+        'updates': {'currency.balances:raghu': '1.5'},
+        'result': None
+    }
+
+    return tx_input, tx_output
+
+
+class TestFinalizedTx(TestCase):
+    def test_encoding_matches_hash_dict(self):
+        tx_input, tx_output = make_io()
+
+        tx = utils.make_finalized_tx(tx_input, tx_output)
+
+        self.assertEqual(tx.encoded_input, utils.hash_dict(tx_input))
+        self.assertEqual(tx.encoded_output, utils.hash_dict(tx_output))
+        self.assertEqual(tx['hash'], utils.generate_tx_hash(tx_input, tx_output))
+
+    def test_serializes_as_plain_dict(self):
+        tx_input, tx_output = make_io()
+
+        tx = utils.make_finalized_tx(tx_input, tx_output)
+
+        expected = {'input': tx_input, 'output': tx_output, 'hash': tx['hash']}
+
+        self.assertEqual(tx, expected)
+        self.assertEqual(encode(tx), encode(expected))
+
+    def test_malformed_payload_still_finalizes(self):
+        tx = utils.make_finalized_tx({'payload': 'junk'}, {'status': 1})
+
+        self.assertIsNone(tx.payload_fields)
+        self.assertEqual(tx['hash'], utils.generate_tx_hash({'payload': 'junk'}, {'status': 1}))
+
+
+# Reference root built a whole level at a time
+def level_root(tx_hashes):
+    level = [utils.merkle_leaf(h) for h in tx_hashes]
+
+    if len(level) == 0:
+        return utils.EMPTY_MERKLE_ROOT
+
+    while len(level) > 1:
+        level = [utils.merkle_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+
+    return level[0]
+
+
+class TestMerkle(TestCase):
+    def test_incremental_root_matches_level_by_level(self):
+        for n in range(0, 40):
+            hashes = [utils.hash_bytes(str(i).encode()) for i in range(n)]
+
+            self.assertEqual(utils.merkle_root(hashes), level_root(hashes))
+
+    def test_every_proof_verifies(self):
+        for n in (1, 2, 3, 7, 8, 13):
+            hashes = [utils.hash_bytes(str(i).encode()) for i in range(n)]
+            root = utils.merkle_root(hashes)
+
+            for i, h in enumerate(hashes):
+                proof = utils.merkle_proof(hashes, i)
+
+                self.assertTrue(utils.verify_tx_proof(h, proof, root))
+                self.assertLessEqual(len(proof), max(0, (n - 1).bit_length()))
+
+    def test_wrong_tx_or_root_fails(self):
+        hashes = [utils.hash_bytes(str(i).encode()) for i in range(5)]
+        root = utils.merkle_root(hashes)
+        proof = utils.merkle_proof(hashes, 2)
+
+        self.assertFalse(utils.verify_tx_proof(hashes[3], proof, root))
+        self.assertFalse(utils.verify_tx_proof(hashes[2], proof, utils.merkle_root(hashes[:4])))
+
+    def test_inner_node_is_not_a_leaf(self):
+        hashes = ['a', 'b']
+        inner = utils.merkle_node(utils.merkle_leaf('a'), utils.merkle_leaf('b'))
+
+        self.assertNotEqual(utils.merkle_root([inner]), utils.merkle_root(hashes))
+
+
+class TestLRUCache(TestCase):
+    def test_concurrent_reads_and_writes_keep_size_and_counts(self):
+        cache = utils.LRUCache(size=16)
+
+        def work(n):
+            for i in range(2000):
+                key = (n * 7 + i) % 40
+                if cache.get(key) is None:
+                    cache.put(key, i + 1)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        stats = cache.stats()
+
+        self.assertEqual(stats['size'], 16)
+        self.assertEqual(stats['hits'] + stats['misses'], 8 * 2000)
@@ -0,0 +1,62 @@
+from unittest import TestCase
+from contractdb import wire
+from contracting.stdlib.bridge.time import Datetime, Timedelta
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+import decimal
+import msgpack
+
+
+class TestWire(TestCase):
+    def test_msgpack_round_trips_contracting_types(self):
+        data = {
+            'amount': decimal.Decimal('123.456789012345678901'),
+            'when': Datetime(2019, 10, 1, 12, 30, 15, 500),
+            'delta': Timedelta(days=2, seconds=30),
+            'raw': b'\x00\x01\xff',
+            'nested': [1, 'two', {'three': None}]
+        }
+
+        res = wire.unpack(wire.pack(data, wire.MSGPACK), wire.MSGPACK)
+
+        self.assertEqual(res['amount'], data['amount'])
+        self.assertEqual(res['when'], data['when'])
+        self.assertEqual(res['delta'], data['delta'])
+        self.assertEqual(res['raw'], data['raw'])
+        self.assertEqual(res['nested'], data['nested'])
+
+    def test_msgpack_keeps_decimals_exact(self):
+        d = decimal.Decimal('0.1000000000000000000000000001')
+
+        self.assertEqual(wire.unpack(wire.pack(d, wire.MSGPACK), wire.MSGPACK), d)
+
+    def test_msgpack_round_trips_contracting_decimal(self):
+        d = ContractingDecimal('1.5')
+
+        res = wire.unpack(wire.pack({'balance': d}, wire.MSGPACK), wire.MSGPACK)
+
+        self.assertIsInstance(res['balance'], ContractingDecimal)
+        self.assertEqual(res['balance'], d)
+        self.assertEqual(str(res['balance']), '1.5')
+
+    def test_json_is_default(self):
+        self.assertEqual(wire.unpack(wire.pack({'a': 1})), {'a': 1})
+        self.assertEqual(wire.unpack(wire.pack({'a': 1}), wire.JSON), {'a': 1})
+
+    def test_bad_msgpack_returns_none(self):
+        self.assertIsNone(wire.unpack(b'\xc1', wire.MSGPACK))
+
+    def test_bad_msgpack_extension_returns_none(self):
+        bad_decimal = msgpack.packb(msgpack.ExtType(wire.DECIMAL_EXT, b'abc'))
+        bad_datetime = msgpack.packb(msgpack.ExtType(wire.DATETIME_EXT, msgpack.packb(5)))
+
+        self.assertIsNone(wire.unpack(bad_decimal, wire.MSGPACK))
+        self.assertIsNone(wire.unpack(bad_datetime, wire.MSGPACK))
+
+    def test_bad_json_returns_none(self):
+        self.assertIsNone(wire.unpack(b'\xff\xfe'))
+        self.assertIsNone(wire.unpack(b'{"__fixed__": "abc"}'))
+
+    def test_negotiate_unknown_header_is_json(self):
+        self.assertEqual(wire.negotiate(b'cbor'), wire.JSON)
+        self.assertEqual(wire.negotiate(None), wire.JSON)
+        self.assertEqual(wire.negotiate(wire.MSGPACK), wire.MSGPACK)